@@ -0,0 +1,165 @@
+"""
+The asyncio counterparts of the twitter streams, used with --asyncio.
+
+"""
+import asyncio
+import logging
+import signal
+import tweepy.asynchronous
+
+from . import json
+from .output_streams import AsyncDedupeOutputStream
+from .tweet_stream import (
+    FilterStreamSupervisor,
+    TweetStream,
+    is_retweet,
+    is_status,
+    make_output_stream,
+    make_reporter,
+    twitter_credentials,
+)
+
+log = logging.getLogger(__name__)
+
+class AsyncTweetStream(tweepy.asynchronous.AsyncStream):
+    """
+    The asyncio counterpart of :class:`TweetStream`.
+
+    Writes to an asyncio output stream from the event loop.
+
+    """
+    report_interval = TweetStream.report_interval
+
+    def __init__(
+        self,
+        *args,
+        output_stream,
+        report_interval=None,
+        drop_retweets=True,
+        name=None,
+        **kw
+    ):
+        super().__init__(*args, **kw)
+        self.output_stream = output_stream
+        self.drop_retweets = drop_retweets
+        if report_interval is not None:
+            self.report_interval = report_interval
+        self.reporter = make_reporter(output_stream, self.report_interval, name)
+
+    async def on_disconnect(self):
+        await super().on_disconnect()
+        self.reporter.report()
+
+    async def on_data(self, raw_data):
+        self.reporter.record()
+
+        if isinstance(raw_data, str):
+            raw_data = raw_data.encode('utf8')
+        raw_data = raw_data.strip()
+
+        if is_status(raw_data):
+            if self.drop_retweets and is_retweet(raw_data):
+                return
+            try:
+                await self.output_stream.on_raw(raw_data)
+            except Exception:
+                log.exception('received exception writing status to output stream')
+        else:
+            await self.on_control_message(raw_data)
+
+    async def on_control_message(self, raw_data):
+        data = json.loads(raw_data)
+
+        if 'warning' in data:
+            await self.on_warning(data['warning'])
+        elif 'limit' in data:
+            await self.on_limit(data['limit']['track'])
+        elif 'disconnect' in data:
+            await self.on_disconnect_message(data['disconnect'])
+        else:
+            log.debug(f'ignoring unknown message={raw_data}')
+
+class AsyncFilterStreamSupervisor(FilterStreamSupervisor):
+    """
+    Run an :class:`AsyncTweetStream` per filter file as a task.
+
+    """
+    def make_stream(self, name, credentials):
+        twitter = twitter_credentials(self.profile, credentials)
+        return AsyncTweetStream(
+            twitter['consumer_key'],
+            twitter['consumer_secret'],
+            twitter['access_token'],
+            twitter['access_token_secret'],
+            output_stream=self.output_stream,
+            report_interval=self.report_interval,
+            drop_retweets=self.drop_retweets,
+            name=name,
+        )
+
+    def connect(self, stream, filters):
+        stream.filter(**filters, stall_warnings=True)
+
+    def is_running(self, stream):
+        return stream.task is not None and not stream.task.done()
+
+    async def run(self):
+        self.reload()
+        while not self.stopping:
+            self.step()
+            await asyncio.sleep(self.poll_interval)
+
+        for supervised in self.supervised.values():
+            self.stop(supervised)
+        # disconnecting cancels the task so this does not wait on the network
+        await asyncio.gather(
+            *(
+                stream.task
+                for _, stream in self.stopped_streams
+                if stream.task is not None
+            ),
+            return_exceptions=True,
+        )
+
+async def main_async(profile, args, router):
+    output_stream = make_output_stream(profile, args, router, asynchronous=True)
+    if args.dedupe:
+        output_stream = AsyncDedupeOutputStream(
+            output_stream,
+            window=args.dedupe_window,
+            max_size=args.dedupe_max_size,
+            path=args.dedupe_path,
+        )
+
+    supervisor = AsyncFilterStreamSupervisor(
+        profile,
+        args.filter_files,
+        output_stream=output_stream,
+        report_interval=args.report_interval,
+        drop_retweets=not args.keep_retweets,
+    )
+    rotations = set()
+
+    def on_sighup():
+        log.info('received SIGHUP, rotating and reloading filters')
+        task = asyncio.create_task(output_stream.rotate())
+        rotations.add(task)
+        task.add_done_callback(rotations.discard)
+        supervisor.reload_requested = True
+
+    def on_stop(name):
+        log.info(f'received {name}, stopping')
+        supervisor.stopping = True
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, on_sighup)
+    loop.add_signal_handler(signal.SIGTERM, on_stop, 'SIGTERM')
+    loop.add_signal_handler(signal.SIGINT, on_stop, 'SIGINT')
+    try:
+        await supervisor.run()
+    finally:
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+        if rotations:
+            await asyncio.wait(rotations)
+        await output_stream.close()
@@ -0,0 +1,732 @@
+import argparse
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+import httpx
+import logging
+import multiprocessing
+import os
+import pika
+import random
+import resource
+import sys
+import tempfile
+import time
+
+from . import json, zstd
+from .output_streams.file import FileOutputStream
+from .output_streams.gcp_firestore import GCPFirestoreOutputStream
+from .output_streams.gcp_image_storage import GCPImageStorageOutputStream
+from .output_streams.rabbitmq import RabbitMqOutputStream
+from .output_streams.sqlite import SqliteOutputStream
+
+log = logging.getLogger(__name__)
+
+def sample_status(n):
+    return {
+        'id': 1400000000000000000 + n,
+        'id_str': str(1400000000000000000 + n),
+        'created_at': 'Mon Oct 18 12:00:00 +0000 2021',
+        'text': f'sample status number {n} with a little bit of text #potus',
+        'lang': 'en',
+        'user': {
+            'id': 1000 + n % 5000,
+            'screen_name': f'user{n % 5000}',
+        },
+        'in_reply_to_status_id': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_screen_name': None,
+        'entities': {'hashtags': [{'text': 'potus', 'indices': [42, 48]}]},
+    }
+
+words = (
+    'the a to of and in is it you that he was for on are with as his they '
+    'be at one have this from or had by hot word but what some we can out '
+    'other were all there when up use your how said an each she which do '
+    'their time if will way about many then them write would like so these'
+).split()
+
+hashtags = ('potus', 'news', 'breaking', 'election', 'sports', 'music')
+
+def synthetic_user(rng):
+    user_id = rng.randrange(1, 50000)
+    return {
+        'id': user_id,
+        'id_str': str(user_id),
+        'name': f'User {user_id}',
+        'screen_name': f'user{user_id}',
+        'location': rng.choice(['', 'New York, NY', 'London', 'Berlin']),
+        'description': ' '.join(rng.choices(words, k=rng.randrange(0, 20))),
+        'verified': rng.random() < 0.01,
+        'followers_count': rng.randrange(0, 100000),
+        'friends_count': rng.randrange(0, 5000),
+        'statuses_count': rng.randrange(0, 100000),
+        'created_at': 'Wed Mar 04 18:00:00 +0000 2015',
+        'profile_image_url_https': (
+            f'https://pbs.twimg.com/profile_images/{user_id}/normal.jpg'),
+    }
+
+def synthetic_media(rng, status_id):
+    media = []
+    for i in range(rng.choice([1, 1, 1, 2, 4])):
+        media_id = status_id * 10 + i
+        m = {
+            'id': media_id,
+            'id_str': str(media_id),
+            'media_url_https': (
+                f'https://pbs.twimg.com/media/{media_id}.jpg'),
+            'type': 'photo',
+        }
+        if rng.random() < 0.2:
+            m['type'] = 'video'
+            m['video_info'] = {'variants': [
+                {
+                    'bitrate': bitrate,
+                    'content_type': 'video/mp4',
+                    'url': (
+                        f'https://video.twimg.com/ext_tw_video/{media_id}/'
+                        f'{bitrate}.mp4'),
+                }
+                for bitrate in (256000, 832000, 2176000)
+            ]}
+        media.append(m)
+    return media
+
+def synthetic_status(n, rng=None, *, nested=True):
+    """
+    A status shaped like the ones delivered by the v1.1 filter stream.
+
+    Roughly 20% are retweets, 15% replies, 10% quotes and 15% carry
+    photos or videos.
+
+    """
+    if rng is None:
+        rng = random.Random(n)
+    status_id = 1400000000000000000 + n
+    tags = rng.sample(hashtags, rng.randrange(0, 3))
+    text = ' '.join(rng.choices(words, k=rng.randrange(3, 40)))
+    text += ''.join(f' #{tag}' for tag in tags)
+    status = {
+        'created_at': 'Mon Oct 18 12:00:00 +0000 2021',
+        'id': status_id,
+        'id_str': str(status_id),
+        'text': text,
+        'source': '<a href="https://mobile.twitter.com">Twitter Web App</a>',
+        'truncated': False,
+        'in_reply_to_status_id': None,
+        'in_reply_to_status_id_str': None,
+        'in_reply_to_user_id': None,
+        'in_reply_to_user_id_str': None,
+        'in_reply_to_screen_name': None,
+        'user': synthetic_user(rng),
+        'geo': None,
+        'coordinates': None,
+        'place': None,
+        'is_quote_status': False,
+        'quote_count': 0,
+        'reply_count': 0,
+        'retweet_count': 0,
+        'favorite_count': 0,
+        'entities': {
+            'hashtags': [{'text': tag, 'indices': [0, 0]} for tag in tags],
+            'urls': [],
+            'user_mentions': [],
+            'symbols': [],
+        },
+        'favorited': False,
+        'retweeted': False,
+        'filter_level': 'low',
+        'lang': rng.choice(['en', 'en', 'en', 'es', 'de', 'ja']),
+        'timestamp_ms': '1634558400000',
+    }
+
+    kind = rng.random()
+    if kind < 0.15:
+        parent_id = status_id - rng.randrange(1, 100000)
+        status['in_reply_to_status_id'] = parent_id
+        status['in_reply_to_status_id_str'] = str(parent_id)
+        status['in_reply_to_user_id'] = rng.randrange(1, 50000)
+        status['in_reply_to_user_id_str'] = str(status['in_reply_to_user_id'])
+        status['in_reply_to_screen_name'] = (
+            f'user{status["in_reply_to_user_id"]}')
+    elif kind < 0.25 and nested:
+        quoted = synthetic_status(n - rng.randrange(1, 100000), nested=False)
+        status['is_quote_status'] = True
+        status['quoted_status_id'] = quoted['id']
+        status['quoted_status_id_str'] = quoted['id_str']
+        status['quoted_status'] = quoted
+    elif kind < 0.45 and nested:
+        retweeted = synthetic_status(n - rng.randrange(1, 100000), nested=False)
+        status['text'] = f'RT @{retweeted["user"]["screen_name"]}: ' + (
+            retweeted['text'])
+        status['retweeted_status'] = retweeted
+
+    if rng.random() < 0.15:
+        media = synthetic_media(rng, status_id)
+        status['entities']['media'] = media[:1]
+        status['extended_entities'] = {'media': media}
+    return status
+
+def synthetic_firehose(count, *, seed=0):
+    rng = random.Random(seed)
+    for n in range(count):
+        yield json.dumps(synthetic_status(n, rng))
+
+class FakeBrokerConnection:
+    """
+    An in-process stand-in for the ``pika.BlockingConnection`` and
+    ``pika.SelectConnection`` used by :class:`RabbitMqOutputStream`.
+
+    Every socket flush costs ``write_latency`` seconds and every run of the
+    ioloop costs an additional ``rtt`` seconds, after which all outstanding
+    publishes are confirmed. Publishes of the bodies in ``reject`` are
+    nacked.
+
+    """
+    def __init__(self, *, rtt, write_latency):
+        self.rtt = rtt
+        self.write_latency = write_latency
+        self.num_messages = 0
+        self.num_round_trips = 0
+        self.reject = set()
+        self.is_closed = False
+        self.ioloop = self
+        self._channel = None
+        self.callbacks = []
+
+    def open(self, on_open):
+        self.is_closed = False
+        self.callbacks.append(lambda: on_open(self))
+        return self
+
+    def add_on_connection_blocked_callback(self, callback):
+        pass
+
+    def add_on_connection_unblocked_callback(self, callback):
+        pass
+
+    def channel(self, on_open_callback=None):
+        self._channel = FakeBrokerChannel(self)
+        if on_open_callback is None:
+            return self._channel
+        channel = self._channel
+        self.callbacks.append(lambda: on_open_callback(channel))
+
+    def call_later(self, delay, callback):
+        return None
+
+    def remove_timeout(self, timeout):
+        pass
+
+    def start(self):
+        time.sleep(self.write_latency + self.rtt)
+        self.num_round_trips += 1
+        callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback()
+        if self._channel is not None:
+            self._channel.deliver_confirms()
+
+    def stop(self):
+        pass
+
+    def close(self):
+        self.is_closed = True
+
+class FakeBrokerChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.ack_nack_callback = None
+        self.unconfirmed = []
+        self.last_delivery_tag = 0
+
+    def add_on_close_callback(self, callback):
+        pass
+
+    def confirm_delivery(self, ack_nack_callback, callback):
+        self.ack_nack_callback = ack_nack_callback
+        self.connection.callbacks.append(lambda: callback(
+            pika.frame.Method(1, pika.spec.Confirm.SelectOk())))
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        self.connection.num_messages += 1
+        if self.ack_nack_callback is None:
+            # the blocking channel flushes the socket on every publish
+            time.sleep(self.connection.write_latency)
+        else:
+            self.last_delivery_tag += 1
+            self.unconfirmed.append((self.last_delivery_tag, body))
+
+    def deliver_confirms(self):
+        unconfirmed, self.unconfirmed = self.unconfirmed, []
+        if not unconfirmed:
+            return
+        if not self.connection.reject:
+            self.ack_nack_callback(pika.frame.Method(1, pika.spec.Basic.Ack(
+                delivery_tag=unconfirmed[-1][0],
+                multiple=True,
+            )))
+            return
+        for tag, body in unconfirmed:
+            if body in self.connection.reject:
+                method = pika.spec.Basic.Nack(delivery_tag=tag)
+            else:
+                method = pika.spec.Basic.Ack(delivery_tag=tag)
+            self.ack_nack_callback(pika.frame.Method(1, method))
+
+    def close(self):
+        pass
+
+class FakeBrokerOutputStream(RabbitMqOutputStream):
+    def __init__(self, connection, **kw):
+        super().__init__(None, '', 'bench', **kw)
+        self.fake_connection = connection
+
+    def connect(self):
+        return self.fake_connection
+
+    def connect_select(self, on_open):
+        return self.fake_connection.open(on_open)
+
+def main_rabbitmq(cli, args):
+    statuses = [sample_status(n) for n in range(args.count)]
+    for batch_size in args.batch_size:
+        connection = FakeBrokerConnection(
+            rtt=args.rtt / 1000,
+            write_latency=args.write_latency / 1000,
+        )
+        output_stream = FakeBrokerOutputStream(
+            connection,
+            batch_size=batch_size,
+        )
+        start = time.perf_counter()
+        for status in statuses:
+            output_stream.on_status(status)
+        output_stream.close()
+        dt = time.perf_counter() - start
+        log.info(
+            f'batch_size={batch_size} published {connection.num_messages} '
+            f'messages in {dt:.2f} seconds ({args.count / dt:.0f}/s) with '
+            f'{connection.num_round_trips} round-trips'
+        )
+
+def main_passthrough(cli, args):
+    lines = [
+        json.dumps(sample_status(n))
+        for n in range(args.count)
+    ]
+
+    def run(output_stream, raw):
+        start = time.process_time()
+        if raw:
+            for line in lines:
+                output_stream.on_raw(line)
+        else:
+            for line in lines:
+                output_stream.on_status(json.loads(line))
+        output_stream.close()
+        return time.process_time() - start
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        sinks = {
+            'file': lambda: FileOutputStream(
+                tempfile.mkdtemp(dir=tmpdir) + '/bench'),
+            'rabbitmq': lambda: FakeBrokerOutputStream(
+                FakeBrokerConnection(rtt=0, write_latency=0),
+                batch_size=1000,
+            ),
+        }
+        for name, factory in sinks.items():
+            parsed = run(factory(), raw=False)
+            raw = run(factory(), raw=True)
+            per_100k = 100000 / args.count
+            log.info(
+                f'sink={name} parsed={parsed * per_100k:.2f}s '
+                f'raw={raw * per_100k:.2f}s cpu per 100k statuses, '
+                f'saved {(parsed - raw) * per_100k:.2f}s'
+            )
+
+def main_json(cli, args):
+    if args.file:
+        with cli.input_file(args.file, text=False) as fp:
+            lines = []
+            for line in zstd.iter_raw_lines(fp):
+                lines.append(line)
+                if len(lines) >= args.count:
+                    break
+    else:
+        lines = [
+            json.dumps(sample_status(n))
+            for n in range(args.count)
+        ]
+    num_bytes = sum(len(line) for line in lines)
+
+    outputs = {}
+    for backend in args.backend:
+        json.use(backend)
+        start = time.perf_counter()
+        statuses = [json.loads(line) for line in lines]
+        loads_dt = time.perf_counter() - start
+
+        start = time.perf_counter()
+        outputs[backend] = [json.dumps(status) for status in statuses]
+        dumps_dt = time.perf_counter() - start
+
+        log.info(
+            f'backend={backend} loads={len(lines) / loads_dt:.0f}/s '
+            f'({num_bytes / loads_dt / 1e6:.1f} MB/s) '
+            f'dumps={len(lines) / dumps_dt:.0f}/s'
+        )
+    json.use(args.json_backend or 'auto')
+
+    backends = list(outputs)
+    for backend in backends[1:]:
+        if outputs[backend] != outputs[backends[0]]:
+            log.info(
+                f'backend={backend} output is not byte-identical to '
+                f'backend={backends[0]}'
+            )
+
+class FakeConsumerConnection:
+    """
+    An in-process stand-in for the ``pika.BlockingConnection`` consumed by
+    ``mq:archive``, delivering ``messages`` and then stopping.
+
+    The latency of every delivery callback is appended to ``latencies``.
+
+    """
+    def __init__(self, messages, *, rate_limiter=None):
+        self.messages = messages
+        self.rate_limiter = rate_limiter
+        self.latencies = []
+        self.on_message = None
+        self.stopped = False
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def basic_consume(self, queue, on_message):
+        self.on_message = on_message
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        pass
+
+    def call_later(self, delay, callback):
+        pass
+
+    def start_consuming(self):
+        perf_counter = time.perf_counter
+        for n, body in enumerate(self.messages, 1):
+            if self.stopped:
+                break
+            if self.rate_limiter is not None:
+                self.rate_limiter.wait()
+            method_frame = pika.spec.Basic.Deliver(delivery_tag=n)
+            start = perf_counter()
+            self.on_message(self, method_frame, None, body)
+            self.latencies.append(perf_counter() - start)
+
+    def stop_consuming(self):
+        self.stopped = True
+
+    def close(self):
+        pass
+
+class FakeFirestoreClient:
+    """
+    Stands in for ``firestore.Client``, every commit costs ``rtt`` seconds.
+
+    """
+    def __init__(self, *, rtt):
+        self.rtt = rtt
+        self.num_writes = 0
+        self.num_commits = 0
+
+    def collection(self, name):
+        return FakeFirestoreCollection(self)
+
+    def batch(self):
+        return FakeFirestoreBatch(self)
+
+class FakeFirestoreCollection:
+    def __init__(self, client):
+        self.client = client
+
+    def document(self, name):
+        return FakeFirestoreDocument(self.client, name)
+
+class FakeFirestoreDocument:
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
+
+    def set(self, data):
+        time.sleep(self.client.rtt)
+        self.client.num_writes += 1
+
+class FakeFirestoreBatch:
+    def __init__(self, client):
+        self.client = client
+        self.num_writes = 0
+
+    def set(self, doc, data):
+        self.num_writes += 1
+
+    def commit(self):
+        time.sleep(self.client.rtt)
+        self.client.num_writes += self.num_writes
+        self.client.num_commits += 1
+
+class FakeStorageClient:
+    """
+    Stands in for ``storage.Client``, uploads read the whole file and then
+    cost ``rtt`` seconds.
+
+    """
+    def __init__(self, *, rtt):
+        self.rtt = rtt
+        self.num_uploads = 0
+        self.num_bytes = 0
+
+    def bucket(self, name):
+        return FakeStorageBucket(self)
+
+class FakeStorageBucket:
+    def __init__(self, client):
+        self.client = client
+
+    def blob(self, name, chunk_size=None):
+        return FakeStorageBlob(self.client, name)
+
+    def copy_blob(self, source, bucket, name):
+        time.sleep(self.client.rtt)
+
+class FakeStorageBlob:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+
+    def upload_from_file(self, fp, size=None, content_type=None):
+        while True:
+            chunk = fp.read(256 * 1024)
+            if not chunk:
+                break
+            self.client.num_bytes += len(chunk)
+        time.sleep(self.client.rtt)
+        self.client.num_uploads += 1
+
+def fake_media_http_client(*, latency, size):
+    body = os.urandom(size)
+
+    def handler(request):
+        time.sleep(latency)
+        return httpx.Response(
+            200,
+            headers={'content-length': str(size)},
+            content=body,
+        )
+
+    return httpx.Client(transport=httpx.MockTransport(handler))
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0
+    index = min(len(sorted_values) - 1, int(len(sorted_values) * p))
+    return sorted_values[index]
+
+def timed(lines, rate_limiter, latencies):
+    # the latency of a record is the time until the next one is requested
+    perf_counter = time.perf_counter
+    for line in lines:
+        rate_limiter.wait()
+        start = perf_counter()
+        yield line
+        latencies.append(perf_counter() - start)
+
+def make_sink(name, options, tmpdir):
+    rtt = options['rtt'] / 1000
+    if name == 'file':
+        return FileOutputStream(
+            os.path.join(tmpdir, 'archive'),
+            frame_records=options['frame_records'],
+        )
+    if name == 'sqlite':
+        return SqliteOutputStream(os.path.join(tmpdir, 'store.db'))
+    if name == 'rabbitmq':
+        return FakeBrokerOutputStream(
+            FakeBrokerConnection(rtt=rtt, write_latency=0),
+            batch_size=options['rabbitmq_batch_size'],
+        )
+    if name == 'firestore':
+        return GCPFirestoreOutputStream(
+            collection='bench',
+            client=FakeFirestoreClient(rtt=rtt),
+        )
+    if name == 'gcs':
+        return GCPImageStorageOutputStream(
+            bucket='bench',
+            prefix='',
+            client=FakeStorageClient(rtt=rtt),
+            http_client=fake_media_http_client(
+                latency=options['media_latency'] / 1000,
+                size=options['media_size'],
+            ),
+        )
+    raise ValueError(f'unknown sink={name}')
+
+def make_output_stream(options, tmpdir):
+    from .output_streams import CompositeOutputStream
+
+    sinks = [make_sink(name, options, tmpdir) for name in options['sinks']]
+    if len(sinks) == 1:
+        return sinks[0]
+    return CompositeOutputStream(sinks, queue_size=options['fanout_queue_size'])
+
+def archive_args(**kw):
+    # the output stream options are unused as the stream is passed in
+    args = argparse.Namespace(
+        queue='bench',
+        report_interval=timedelta(seconds=5),
+        prefetch=None,
+        ack_batch_size=1,
+        ack_interval=timedelta(seconds=1),
+        output_path_prefix=None,
+        sqlite_path=None,
+        dedupe_path=None,
+        fanout_spill_path_prefix=None,
+    )
+    vars(args).update(kw)
+    return args
+
+def run_target(target, options):
+    from . import mq_archiver, mq_replay
+    from .tweet_stream import TweetStream
+
+    lines = list(synthetic_firehose(options['count'], seed=options['seed']))
+    rate_limiter = mq_replay.RateLimiter(options['rate'])
+    latencies = []
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        start = time.perf_counter()
+        if target == 'tweet-stream':
+            output_stream = make_output_stream(options, tmpdir)
+            tweet_stream = TweetStream(
+                'key', 'secret', 'token', 'token-secret',
+                output_stream=output_stream,
+                report_interval=timedelta(days=1),
+            )
+            for line in timed(lines, rate_limiter, latencies):
+                tweet_stream.on_data(line)
+            output_stream.close()
+
+        elif target == 'mq-archive':
+            output_stream = make_output_stream(options, tmpdir)
+            connection = FakeConsumerConnection(
+                lines, rate_limiter=rate_limiter)
+            mq_archiver.consume(
+                {},
+                archive_args(ack_batch_size=options['ack_batch_size']),
+                connection=connection,
+                output_stream=output_stream,
+            )
+            latencies = connection.latencies
+
+        elif target == 'mq-replay':
+            path = os.path.join(tmpdir, 'replay.zstd')
+            with open(path, 'wb') as fp, open(zstd.index_path_for(path), 'wb') as index_fp:
+                writer = zstd.FramedWriter(fp, index_fp)
+                for line in lines:
+                    writer.write_record(line)
+                writer.close()
+            output_stream = FakeBrokerOutputStream(
+                FakeBrokerConnection(rtt=options['rtt'] / 1000, write_latency=0),
+                batch_size=options['rabbitmq_batch_size'],
+            )
+            start = time.perf_counter()
+            units = mq_replay.units_for_file(path)
+            replayed = (
+                line
+                for unit in units
+                for line in mq_replay.iter_unit(unit)
+            )
+            mq_replay.publish(
+                output_stream,
+                timed(replayed, rate_limiter, latencies),
+                mq_replay.RateLimiter(None),
+            )
+            output_stream.close()
+
+        else:
+            output_stream = make_output_stream(options, tmpdir)
+            for line in timed(lines, rate_limiter, latencies):
+                output_stream.on_raw(line)
+            output_stream.close()
+
+        dt = time.perf_counter() - start
+
+    latencies.sort()
+    return {
+        'target': target,
+        'sinks': options['sinks'] if target != 'mq-replay' else ['rabbitmq'],
+        'records': len(lines),
+        'bytes': sum(len(line) for line in lines),
+        'seconds': dt,
+        'rate': len(lines) / dt,
+        'p50_us': percentile(latencies, 0.5) * 1e6,
+        'p99_us': percentile(latencies, 0.99) * 1e6,
+        'max_us': (latencies[-1] if latencies else 0) * 1e6,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+def peak_rss_mb():
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macos, kilobytes everywhere else
+    if sys.platform == 'darwin':
+        return max_rss / (1024 * 1024)
+    return max_rss / 1024
+
+def main_pipeline(cli, args):
+    options = {
+        'count': args.count,
+        'rate': args.rate,
+        'seed': args.seed,
+        'sinks': args.sink,
+        'rtt': args.rtt,
+        'media_latency': args.media_latency,
+        'media_size': args.media_size,
+        'frame_records': args.frame_records,
+        'rabbitmq_batch_size': args.rabbitmq_batch_size,
+        'fanout_queue_size': args.fanout_queue_size,
+        'ack_batch_size': args.ack_batch_size,
+    }
+
+    # every target runs in a fresh process so its peak rss is its own
+    context = multiprocessing.get_context('spawn')
+    for target in args.target:
+        with ProcessPoolExecutor(
+            max_workers=1,
+            mp_context=context,
+            initializer=json.use,
+            initargs=(json.backend,),
+        ) as pool:
+            result = pool.submit(run_target, target, options).result()
+        log.info(
+            f'target={target} sinks={",".join(result["sinks"])} '
+            f'records={result["records"]} in {result["seconds"]:.2f} '
+            f'seconds ({result["rate"]:.0f}/s, '
+            f'{result["bytes"] / result["seconds"] / 1e6:.1f} MB/s) '
+            f'p50={result["p50_us"]:.0f}us p99={result["p99_us"]:.0f}us '
+            f'max={result["max_us"]:.0f}us '
+            f'peak_rss={result["peak_rss_mb"]:.0f}MB'
+        )
+        if args.results_file:
+            with open(args.results_file, 'ab') as fp:
+                fp.write(json.dumps(result) + b'\n')
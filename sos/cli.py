@@ -1,11 +1,12 @@
 from cached_property import cached_property
 from contextlib import contextmanager
 import logging
+import os
 import subparse
 import sys
 import yaml
 
-from . import commands
+from . import commands, json, metrics
 
 class AbortCLI(Exception):
     def __init__(self, message, code):
@@ -75,11 +76,23 @@ def context_factory(cli, args, with_db=False):
 
     app = App(args.profile)
 
+    json_backend = args.json_backend
+    if json_backend is None and os.path.exists(app.profile_file):
+        json_backend = (app.profile or {}).get('json_backend')
+    json.use(json_backend or 'auto')
+
     logging.basicConfig(
         level=logging.DEBUG if args.verbose else logging.INFO,
         format='%(asctime)-15s %(levelname)-8s [%(name)s] %(message)s',
     )
 
+    if args.metrics_port or args.metrics_file:
+        metrics.enable(
+            port=args.metrics_port,
+            path=args.metrics_file,
+            interval=args.metrics_interval,
+        )
+
     yield app
 
 def main(argv=sys.argv):
@@ -1,6 +1,7 @@
 from datetime import timedelta
 from subparse import command
 
+from . import json
 from .settings import asduration
 
 default_report_interval = timedelta(seconds=5)
@@ -8,6 +9,177 @@ default_report_interval = timedelta(seconds=5)
 def generic_options(parser):
     parser.add_argument('-v', '--verbose', action='store_true')
     parser.add_argument('--profile', default='profile.yml')
+    parser.add_argument(
+        '--json-backend',
+        choices=json.backends,
+        help=(
+            'Force the json library used to encode and decode statuses. '
+            'Defaults to the json_backend profile setting or "auto".'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        help=(
+            'Serve prometheus metrics on http://127.0.0.1:<port>/metrics. '
+            'mq:archive workers use the following ports.'
+        ),
+    )
+    parser.add_argument(
+        '--metrics-file',
+        help='Append a json line of every metric to this file periodically.',
+    )
+    parser.add_argument(
+        '--metrics-interval',
+        type=asduration,
+        default=timedelta(seconds=10),
+        help='How often to write to --metrics-file.',
+    )
+
+def output_options(parser):
+    parser.add_argument(
+        '--output-path-prefix',
+        help=(
+            'Store the data compressed to disk. '
+            'Helpful for debugging or redundancy.'
+        ),
+    )
+    parser.add_argument(
+        '--output-frame-records',
+        type=int,
+        help=(
+            'Close a zstd frame every N records and write a seekable '
+            'index next to each output file.'
+        ),
+    )
+    parser.add_argument(
+        '--output-frame-bytes',
+        type=int,
+        help=(
+            'Close a zstd frame every N uncompressed bytes and write a '
+            'seekable index next to each output file.'
+        ),
+    )
+    parser.add_argument(
+        '--output-dictionary',
+        help='Compress output files with a trained zstd dictionary.',
+    )
+    parser.add_argument(
+        '--output-flush-records',
+        type=int,
+        help=(
+            'Flush compressed data to the output file every N records so '
+            'it can be recovered after a crash.'
+        ),
+    )
+    parser.add_argument(
+        '--output-flush-interval',
+        type=asduration,
+        help=(
+            'Flush compressed data to the output file at least this often, '
+            'in seconds (e.g. 0.5).'
+        ),
+    )
+    parser.add_argument(
+        '--output-flush-frames',
+        action='store_true',
+        help='Flush the output file whenever a zstd frame is closed.',
+    )
+    parser.add_argument(
+        '--output-fsync',
+        action='store_true',
+        help='Also fsync the output file on every flush.',
+    )
+    parser.add_argument(
+        '--output-rotate-interval',
+        type=asduration,
+        help=(
+            'Start a new output file at the start of every bucket of this '
+            'length (e.g. 1h), named after the start of the bucket.'
+        ),
+    )
+    parser.add_argument(
+        '--output-rotate-bytes',
+        type=int,
+        help=(
+            'Start a new output file once it reaches about this compressed '
+            'size. zstd buffers up to 128KB before writing to the file.'
+        ),
+    )
+    parser.add_argument(
+        '--output-rotate-records',
+        type=int,
+        help='Start a new output file after this many records.',
+    )
+    parser.add_argument(
+        '--output-compact-level',
+        type=int,
+        help=(
+            'Recompress each closed output file at this zstd level in a '
+            'background process.'
+        ),
+    )
+    parser.add_argument(
+        '--sqlite-path',
+        help=(
+            'Store statuses in a local sqlite database indexed for '
+            'querying with store:query.'
+        ),
+    )
+
+def fanout_and_route_options(parser):
+    parser.add_argument(
+        '--fanout-queue-size',
+        type=int,
+        help=(
+            'Write to each output stream from its own thread with a queue '
+            'of up to this many statuses, so a slow stream does not hold '
+            'up the others.'
+        ),
+    )
+    parser.add_argument(
+        '--fanout-overflow',
+        choices=['block', 'drop-oldest', 'spill'],
+        default='block',
+        help='What to do with new statuses when a stream\'s queue is full.',
+    )
+    parser.add_argument(
+        '--fanout-spill-path-prefix',
+        help='Where to spill statuses to disk with --fanout-overflow=spill.',
+    )
+    parser.add_argument(
+        '--routes-file',
+        help=(
+            'A yaml file of routes deciding which of the output streams, '
+            'or which extra rabbitmq routing keys, each status is written '
+            'to. Statuses matching no route are dropped.'
+        ),
+    )
+
+def dedupe_options(parser, *, dedupe_help=None):
+    if dedupe_help is None:
+        dedupe_help = (
+            'Drop statuses with an id that was already written to the '
+            'output streams.'
+        )
+    parser.add_argument('--dedupe', action='store_true', help=dedupe_help)
+    parser.add_argument(
+        '--dedupe-window',
+        type=asduration,
+        help='Remember status ids for at least this long. Defaults to 1h.',
+    )
+    parser.add_argument(
+        '--dedupe-max-size',
+        type=int,
+        help=(
+            'The most status ids to remember, which bounds memory use '
+            'before the window. Defaults to 1000000.'
+        ),
+    )
+    parser.add_argument(
+        '--dedupe-path',
+        help='Save the remembered status ids here across restarts.',
+    )
 
 @command('.tweet_stream', 'twitter:stream')
 def tweet_stream(parser):
@@ -18,22 +190,77 @@ def tweet_stream(parser):
     when a SIGHUP is received locally. The resulting files can then be
     concatenated together and/or ingested into the database for querying.
 
+    When several filter files or a directory of them are given, each filter
+    runs as its own stream on a separate thread and they all share the
+    output streams. On SIGHUP the filter files are read again and streams
+    are added, restarted or stopped to match them.
+
+    Twitter allows one filter stream per set of credentials, so each filter
+    file names its own with a "credentials" key referring to the
+    twitter_credentials of the profile. A filter file without one uses the
+    twitter credentials.
+
     """
-    parser.add_argument('filter_file')
+    parser.add_argument(
+        'filter_files',
+        nargs='+',
+        metavar='filter_file',
+        help='A yaml file of filter parameters or a directory of them.',
+    )
+    parser.add_argument(
+        '--asyncio',
+        action='store_true',
+        help=(
+            'Run the filter streams and output streams on an asyncio event '
+            'loop instead of threads. The --queue-* and --fanout-* options '
+            'do not apply.'
+        ),
+    )
+    parser.add_argument(
+        '--keep-retweets',
+        action='store_true',
+        help=(
+            'Write retweets to the output streams instead of dropping them, '
+            'routes can still match them with is_retweet.'
+        ),
+    )
     parser.add_argument(
         '--report-interval',
         type=asduration,
         default=default_report_interval,
     )
+    output_options(parser)
+    parser.add_argument('--rabbitmq-exchange', default='')
+    parser.add_argument('--rabbitmq-routing-key')
     parser.add_argument(
-        '--output-path-prefix',
+        '--rabbitmq-batch-size',
+        type=int,
         help=(
-            'Store the data compressed to disk. '
-            'Helpful for debugging or redundancy.'
+            'Publish statuses in batches of this size using publisher '
+            'confirms instead of one at a time.'
         ),
     )
-    parser.add_argument('--rabbitmq-exchange', default='')
-    parser.add_argument('--rabbitmq-routing-key')
+    fanout_and_route_options(parser)
+    dedupe_options(parser)
+    parser.add_argument(
+        '--queue-size',
+        type=int,
+        help=(
+            'Buffer up to this many statuses between the twitter connection '
+            'and the output streams, which are written from a separate '
+            'thread. Defaults to 10000 when running several filter streams.'
+        ),
+    )
+    parser.add_argument(
+        '--queue-overflow',
+        choices=['block', 'drop-oldest', 'spill'],
+        default='block',
+        help='What to do with new statuses when the queue is full.',
+    )
+    parser.add_argument(
+        '--queue-spill-path-prefix',
+        help='Where to spill statuses to disk with --queue-overflow=spill.',
+    )
 
 @command('.mq_archiver', 'mq:archive')
 def mq_archiver(parser):
@@ -42,20 +269,67 @@ def mq_archiver(parser):
 
     """
     parser.add_argument('--queue', required=True)
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=1,
+        help=(
+            'Run this many consumer processes, each with its own channel '
+            'and output streams. File outputs are written to '
+            '"<output-path-prefix>.w<n>", sqlite to "<sqlite-path>.w<n>" '
+            'and metrics to "<metrics-file>.w<n>". Use with --prefetch to '
+            'spread messages evenly.'
+        ),
+    )
     parser.add_argument(
         '--report-interval',
         type=asduration,
         default=default_report_interval,
     )
+    output_options(parser)
+    parser.add_argument('--gcp-image-bucket')
+    parser.add_argument('--gcp-firestore-collection')
+    fanout_and_route_options(parser)
+    dedupe_options(parser, dedupe_help=(
+        'Drop statuses with an id that was already written to the '
+        'output streams. Each worker only dedupes the messages it '
+        'receives and saves its ids to "<dedupe-path>.w<n>".'
+    ))
+    parser.add_argument(
+        '--asyncio',
+        action='store_true',
+        help=(
+            'Consume with aio-pika and write to the output streams on an '
+            'asyncio event loop so publishing, firestore writes and media '
+            'downloads overlap. The --fanout-* options do not apply.'
+        ),
+    )
     parser.add_argument(
-        '--output-path-prefix',
+        '--prefetch',
+        type=int,
         help=(
-            'Store the data compressed to disk. '
-            'Helpful for debugging or redundancy.'
+            'The maximum number of unacknowledged messages to receive, at '
+            'least --ack-batch-size.'
+        ),
+    )
+    parser.add_argument(
+        '--ack-batch-size',
+        type=int,
+        default=1,
+        help=(
+            'Flush the output stream and acknowledge messages together '
+            'after this many have been received.'
+        ),
+    )
+    parser.add_argument(
+        '--ack-interval',
+        type=asduration,
+        default=timedelta(seconds=1),
+        help=(
+            'The longest to wait before flushing and acknowledging a '
+            'partial batch when --ack-batch-size is used.'
         ),
     )
-    parser.add_argument('--gcp-image-bucket')
-    parser.add_argument('--gcp-firestore-collection')
 
 @command('.mq_replay', 'mq:replay')
 def mq_replay(parser):
@@ -66,3 +340,391 @@ def mq_replay(parser):
     parser.add_argument('--exchange', default='')
     parser.add_argument('--routing-key', required=True)
     parser.add_argument('--files', nargs='+', required=True)
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        help=(
+            'Publish statuses in batches of this size using publisher '
+            'confirms instead of one at a time.'
+        ),
+    )
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        default=1,
+        help=(
+            'Decompress files, or the frames of indexed files, in this many '
+            'processes. Without --order every process also publishes on '
+            'its own connection.'
+        ),
+    )
+    parser.add_argument(
+        '--order',
+        choices=['none', 'id', 'created_at'],
+        default='none',
+        help=(
+            'Merge the files by status id or creation time. Each file is '
+            'assumed to already be in order. Unindexed files are streamed '
+            'without using the other processes.'
+        ),
+    )
+    parser.add_argument(
+        '--rate',
+        type=float,
+        help='The maximum number of statuses to publish per second.',
+    )
+    parser.add_argument(
+        '--checkpoint-file',
+        help=(
+            'Record progress in this file after publishes are confirmed. '
+            'Publishes in batches of 100 with confirms unless --batch-size '
+            'is set.'
+        ),
+    )
+    parser.add_argument(
+        '--checkpoint-interval',
+        type=int,
+        default=10000,
+        help='Checkpoint after this many records within a file or frame.',
+    )
+    parser.add_argument(
+        '--resume',
+        action='store_true',
+        help='Continue from the progress saved in --checkpoint-file.',
+    )
+    parser.add_argument(
+        '--dictionary',
+        help='The zstd dictionary the files were compressed with.',
+    )
+
+@command('.bench:main_rabbitmq', 'bench:rabbitmq')
+def bench_rabbitmq(parser):
+    """
+    Benchmark the rabbitmq output stream against an in-process broker.
+
+    """
+    parser.add_argument('--count', type=int, default=10000)
+    parser.add_argument('--batch-size', type=int, nargs='+', default=[1, 100])
+    parser.add_argument(
+        '--rtt',
+        type=float,
+        default=0.5,
+        help='Simulated broker round-trip time in milliseconds.',
+    )
+    parser.add_argument(
+        '--write-latency',
+        type=float,
+        default=0.05,
+        help='Simulated cost of flushing the socket in milliseconds.',
+    )
+
+@command('.bench:main_passthrough', 'bench:passthrough')
+def bench_passthrough(parser):
+    """
+    Compare the cpu cost of parsing statuses against passing raw bytes.
+
+    """
+    parser.add_argument('--count', type=int, default=100000)
+
+@command('.bench:main_json', 'bench:json')
+def bench_json(parser):
+    """
+    Compare the speed of the available json backends.
+
+    """
+    parser.add_argument(
+        '--file',
+        help='A zstd archive of real statuses to use instead of samples.',
+    )
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument(
+        '--backend',
+        nargs='+',
+        default=[b for b in json.backends if b != 'auto'],
+    )
+
+@command('.bench:main_pipeline', 'bench:pipeline')
+def bench_pipeline(parser):
+    """
+    Benchmark the ingestion pipeline end to end with synthetic statuses.
+
+    Each target runs in its own process against in-process stand-ins for
+    rabbitmq, firestore, cloud storage and the media servers, reporting
+    throughput, p50/p99 latency per status and peak rss.
+
+    """
+    parser.add_argument(
+        '--target',
+        nargs='+',
+        choices=['sink', 'tweet-stream', 'mq-archive', 'mq-replay'],
+        default=['sink', 'tweet-stream', 'mq-archive', 'mq-replay'],
+        help=(
+            'What to drive: the output streams directly, '
+            'TweetStream.on_data, the mq:archive consumer or mq:replay.'
+        ),
+    )
+    parser.add_argument(
+        '--sink',
+        nargs='+',
+        choices=['file', 'sqlite', 'rabbitmq', 'firestore', 'gcs'],
+        default=['file'],
+        help='The output streams to write to, combined when more than one.',
+    )
+    parser.add_argument('--count', type=int, default=100000)
+    parser.add_argument(
+        '--rate',
+        type=float,
+        help='Generate statuses at this rate per second instead of flat out.',
+    )
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument(
+        '--rtt',
+        type=float,
+        default=0.5,
+        help='Simulated rabbitmq, firestore and storage rtt in milliseconds.',
+    )
+    parser.add_argument(
+        '--media-latency',
+        type=float,
+        default=50,
+        help='Simulated time to fetch a media file in milliseconds.',
+    )
+    parser.add_argument(
+        '--media-size',
+        type=int,
+        default=200 * 1024,
+        help='The size of every simulated media file in bytes.',
+    )
+    parser.add_argument('--frame-records', type=int, default=10000)
+    parser.add_argument('--rabbitmq-batch-size', type=int, default=100)
+    parser.add_argument('--ack-batch-size', type=int, default=100)
+    parser.add_argument('--fanout-queue-size', type=int)
+    parser.add_argument(
+        '--results-file',
+        help='Append the results as json lines to compare between runs.',
+    )
+
+@command('.zstd:main_find', 'zstd:find')
+def zstd_find(parser):
+    """
+    Find a status in indexed archives without decompressing all of them.
+
+    """
+    parser.add_argument('status_id', type=int)
+    parser.add_argument('files', nargs='+')
+    parser.add_argument(
+        '--dictionary',
+        help='The zstd dictionary the files were compressed with.',
+    )
+
+def zstd_compression_options(parser):
+    parser.add_argument('--level', type=int, default=10)
+    parser.add_argument(
+        '--threads',
+        type=int,
+        default=0,
+        help='Compress using this many threads, -1 for one per core.',
+    )
+    parser.add_argument(
+        '--long',
+        action='store_true',
+        help='Enable long distance matching.',
+    )
+    parser.add_argument(
+        '--dictionary',
+        help='Compress with a dictionary from zstd:train-dictionary.',
+    )
+
+@command('.zstd:main_concat', 'zstd:concat')
+def zstd_concat(parser):
+    """
+    Concatenate zstd files into a single recompressed file.
+
+    """
+    parser.add_argument('input_files', nargs='+')
+    parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument(
+        '--input-dictionary',
+        help='The zstd dictionary the input files were compressed with.',
+    )
+    zstd_compression_options(parser)
+
+@command('.zstd:main_compress', 'zstd:compress')
+def zstd_compress(parser):
+    """
+    Compress a file with zstd.
+
+    """
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-file', default='-')
+    zstd_compression_options(parser)
+
+@command('.zstd:main_decompress', 'zstd:decompress')
+def zstd_decompress(parser):
+    """
+    Decompress a zstd file.
+
+    """
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument(
+        '--dictionary',
+        help='The zstd dictionary the file was compressed with.',
+    )
+
+@command('.zstd:main_from_gz', 'zstd:from-gz')
+def zstd_from_gz(parser):
+    """
+    Convert a gzip file to zstd.
+
+    """
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-file', default='-')
+    zstd_compression_options(parser)
+
+@command('.zstd:main_recover', 'zstd:recover')
+def zstd_recover(parser):
+    """
+    Salvage the complete records of a truncated or corrupt zstd file.
+
+    """
+    parser.add_argument('input_file')
+    parser.add_argument('-o', '--output-file', default='-')
+    parser.add_argument(
+        '--input-dictionary',
+        help='The zstd dictionary the input file was compressed with.',
+    )
+    zstd_compression_options(parser)
+
+@command('.zstd:main_train_dictionary', 'zstd:train-dictionary')
+def zstd_train_dictionary(parser):
+    """
+    Train a zstd dictionary from the statuses in zstd archives.
+
+    """
+    parser.add_argument('input_files', nargs='+')
+    parser.add_argument('-o', '--output-file', required=True)
+    parser.add_argument('--dict-size', type=int, default=112640)
+    parser.add_argument('--max-samples', type=int, default=100000)
+    parser.add_argument('--level', type=int, default=10)
+    parser.add_argument('--threads', type=int, default=0)
+
+@command('.recompact', 'zstd:recompact')
+def zstd_recompact(parser):
+    """
+    Convert and recompress gzip or zstd archives in parallel.
+
+    Every input file is written to one or more zstd files in the output
+    directory, which must not contain the inputs, optionally split into
+    fixed size chunks or buckets of creation time. With --verify the outputs
+    are read back and their record counts checked.
+
+    """
+    parser.add_argument(
+        'inputs',
+        nargs='+',
+        help='Files, globs or directories of .gz and .zstd files.',
+    )
+    parser.add_argument('--output-dir', required=True)
+    parser.add_argument(
+        '--jobs',
+        type=int,
+        help='The number of files to process at once, defaults to one per core.',
+    )
+    split = parser.add_mutually_exclusive_group()
+    split.add_argument(
+        '--records-per-file',
+        type=int,
+        help='Split each input into files of at most this many records.',
+    )
+    split.add_argument(
+        '--bucket',
+        choices=['hour', 'day'],
+        help='Split each input into files by the creation time of statuses.',
+    )
+    parser.add_argument(
+        '--frame-records',
+        type=int,
+        help='Write indexed, seekable output with frames of N records.',
+    )
+    parser.add_argument(
+        '--verify',
+        action='store_true',
+        help='Decompress every output file and check its record count.',
+    )
+    parser.add_argument(
+        '--input-dictionary',
+        help='The zstd dictionary the input files were compressed with.',
+    )
+    zstd_compression_options(parser)
+
+@command('.store:main_query', 'store:query')
+def store_query(parser):
+    """
+    Query statuses stored with --sqlite-path.
+
+    """
+    parser.add_argument('path')
+    parser.add_argument('--id', type=int)
+    parser.add_argument(
+        '--replies-to',
+        type=int,
+        help='Find replies to this status id.',
+    )
+    parser.add_argument(
+        '--quotes-of',
+        type=int,
+        help='Find statuses quoting this status id.',
+    )
+    parser.add_argument('--user-id', type=int)
+    parser.add_argument('--screen-name')
+    parser.add_argument(
+        '--since',
+        help='Only statuses created at or after this ISO 8601 time.',
+    )
+    parser.add_argument(
+        '--until',
+        help='Only statuses created before this ISO 8601 time.',
+    )
+    parser.add_argument('--limit', type=int)
+    parser.add_argument(
+        '--format',
+        choices=['json', 'text'],
+        default='json',
+    )
+
+@command('.export', 'archive:export')
+def archive_export(parser):
+    """
+    Export zstd archives to a columnar Parquet or Arrow file.
+
+    Requires pyarrow.
+
+    """
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-o', '--output-file', required=True)
+    parser.add_argument(
+        '--format',
+        choices=['parquet', 'arrow'],
+        default='parquet',
+    )
+    parser.add_argument(
+        '--row-group-size',
+        type=int,
+        default=100000,
+        help='The number of statuses to buffer and write at a time.',
+    )
+    parser.add_argument(
+        '--compression',
+        default='zstd',
+        help='The parquet compression codec.',
+    )
+    parser.add_argument(
+        '--include-json',
+        action='store_true',
+        help='Include the raw status json as a column.',
+    )
+    parser.add_argument(
+        '--dictionary',
+        help='The zstd dictionary the files were compressed with.',
+    )
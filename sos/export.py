@@ -0,0 +1,88 @@
+import logging
+import time
+
+from . import json, zstd
+from .status import status_fields
+
+log = logging.getLogger(__name__)
+
+def build_schema(pa, *, include_json=False):
+    fields = [
+        pa.field('id', pa.int64()),
+        pa.field('user_id', pa.int64()),
+        pa.field('user_sn', pa.string()),
+        pa.field('created_at', pa.string()),
+        pa.field('text', pa.string()),
+        pa.field('in_reply_to_status_id', pa.int64()),
+        pa.field('in_reply_to_user_id', pa.int64()),
+        pa.field('in_reply_to_screen_name', pa.string()),
+        pa.field('quoted_status_id', pa.int64()),
+        pa.field('lang', pa.string()),
+    ]
+    if include_json:
+        fields.append(pa.field('json', pa.string()))
+    return pa.schema(fields)
+
+def main(cli, args):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        cli.abort('pyarrow must be installed to export archives')
+
+    schema = build_schema(pa, include_json=args.include_json)
+    dict_data = None
+    if args.dictionary:
+        dict_data = zstd.load_dictionary(args.dictionary)
+
+    if args.format == 'parquet':
+        writer = pq.ParquetWriter(
+            args.output_file, schema, compression=args.compression)
+    else:
+        writer = pa.ipc.new_file(args.output_file, schema)
+
+    columns = {name: [] for name in schema.names}
+    num_rows = num_failed = 0
+    start = time.monotonic()
+
+    # only a single row group is ever held in memory
+    def flush():
+        nonlocal columns
+        if not columns['id']:
+            return
+        writer.write_batch(pa.record_batch(
+            [
+                pa.array(columns[field.name], type=field.type)
+                for field in schema
+            ],
+            schema=schema,
+        ))
+        columns = {name: [] for name in schema.names}
+
+    try:
+        for path in args.files:
+            log.info(f'exporting path={path}')
+            with cli.input_file(path, text=False) as fp:
+                for line in zstd.iter_lines(fp, dict_data=dict_data):
+                    try:
+                        fields = status_fields(json.loads(line))
+                    except Exception:
+                        log.debug(f'skipping invalid status={line}')
+                        num_failed += 1
+                        continue
+                    for name, value in fields.items():
+                        columns[name].append(value)
+                    if args.include_json:
+                        columns['json'].append(line)
+                    num_rows += 1
+                    if len(columns['id']) >= args.row_group_size:
+                        flush()
+        flush()
+    finally:
+        writer.close()
+
+    dt = time.monotonic() - start
+    log.info(
+        f'exported {num_rows} statuses to {args.output_file} in '
+        f'{dt:.2f} seconds, skipped {num_failed} invalid lines'
+    )
@@ -0,0 +1,83 @@
+import json
+import time
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+log = __import__('logging').getLogger(__name__)
+
+backends = ('auto', 'orjson', 'stdlib')
+backend = None
+loads_histogram = None
+
+def _stdlib_loads(data):
+    return json.loads(data)
+
+def _stdlib_dumps(obj):
+    data = json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
+    try:
+        return data.encode('utf8')
+    except UnicodeEncodeError:
+        # lone surrogates, as in text truncated mid emoji, cannot be utf8
+        # encoded but they can be written as escapes
+        return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+def _orjson_loads(data):
+    try:
+        return orjson.loads(data)
+    except orjson.JSONDecodeError:
+        # orjson rejects escaped lone surrogates which the stdlib accepts,
+        # anything else is invalid to both and raised again below
+        return json.loads(data)
+
+def _orjson_dumps(obj):
+    try:
+        return orjson.dumps(obj)
+    except orjson.JSONEncodeError:
+        return _stdlib_dumps(obj)
+
+# both backends produce compact utf8 output that decodes to the same
+# statuses, though the bytes may differ, for example in how floats or
+# escapes are written
+def use(name='auto'):
+    global backend, loads, dumps
+
+    if name not in backends:
+        raise ValueError(f'unknown json backend={name}')
+    if name == 'auto':
+        name = 'orjson' if orjson is not None else 'stdlib'
+    if name == 'orjson':
+        if orjson is None:
+            raise ValueError('the orjson json backend is not installed')
+        loads, dumps = _orjson_loads, _orjson_dumps
+    else:
+        loads, dumps = _stdlib_loads, _stdlib_dumps
+    if loads_histogram is not None:
+        loads = _timed(loads, loads_histogram)
+    backend = name
+    log.debug(f'using json backend={name}')
+
+def _timed(fn, histogram):
+    def timed(data):
+        start = time.perf_counter()
+        try:
+            return fn(data)
+        finally:
+            histogram.observe(time.perf_counter() - start)
+    return timed
+
+def instrument(histogram):
+    """
+    Record the time taken by every call to loads, or stop if ``histogram``
+    is None.
+
+    """
+    global loads_histogram
+    loads_histogram = histogram
+    use(backend)
+
+# loads(data) accepts str or bytes and dumps(obj) returns utf8 bytes
+loads = dumps = None
+use()
@@ -1,12 +1,19 @@
+from collections import OrderedDict
+import logging
 import posixpath
+import sqlite3
+import threading
 from urllib.parse import urlparse
 
+log = logging.getLogger(__name__)
+
 def media_info_from_status(status):
     results = {}
 
     def add_image(id, url):
         content_type, ext, url = image_info(url)
         results[id] = {
+            'id': id,
             'name': f'{status["id"]}-{len(results)}-{id}{ext}',
             'content_type': content_type,
             'url': url,
@@ -15,6 +22,7 @@ def media_info_from_status(status):
     def add_video(id, info):
         url = video_url(info)
         results[id] = {
+            'id': id,
             'name': f'{status["id"]}-{len(results)}-{id}.mp4',
             'content_type': 'video/mp4',
             'url': url,
@@ -61,3 +69,103 @@ def video_url(info):
     ):
         if variant['content_type'] == 'video/mp4':
             return variant['url']
+
+class MediaCache:
+    """
+    Remember where media has already been stored, keyed by media id and url.
+
+    Lookups are served from a bounded in-memory LRU which is optionally
+    backed by a sqlite index at ``path`` so the cache survives restarts.
+
+    Media that is still being stored is only added to the LRU, so that
+    statuses in flight at the same time do not fetch it again. It is only
+    written to the index once it was ``stored``, so media that was never
+    stored because of a crash is not skipped after a restart.
+
+    """
+    commit_interval = 1000
+
+    def __init__(self, *, max_size=100000, path=None):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.num_uncommitted = 0
+
+        self.db = None
+        if path is not None:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('pragma journal_mode=wal')
+            self.db.execute(
+                'create table if not exists media '
+                '(key text primary key, name text not null)'
+            )
+            self.db.commit()
+
+    @staticmethod
+    def key_for(info):
+        return f'{info["id"]}:{info["url"]}'
+
+    def get(self, info):
+        key = self.key_for(info)
+        with self.lock:
+            name = self.entries.get(key)
+            if name is not None:
+                self.entries.move_to_end(key)
+            elif self.db is not None:
+                row = self.db.execute(
+                    'select name from media where key = ?', (key,),
+                ).fetchone()
+                if row is not None:
+                    name = row[0]
+                    self._remember(key, name)
+            if name is not None:
+                self.hits += 1
+            else:
+                self.misses += 1
+            return name
+
+    def add(self, info):
+        key = self.key_for(info)
+        with self.lock:
+            self._remember(key, info['name'])
+
+    def stored(self, info):
+        key = self.key_for(info)
+        with self.lock:
+            self._remember(key, info['name'])
+            if self.db is not None:
+                self.db.execute(
+                    'insert or replace into media (key, name) values (?, ?)',
+                    (key, info['name']),
+                )
+                self.num_uncommitted += 1
+                if self.num_uncommitted >= self.commit_interval:
+                    self._commit()
+
+    def discard(self, info):
+        key = self.key_for(info)
+        with self.lock:
+            self.entries.pop(key, None)
+
+    def _remember(self, key, name):
+        self.entries[key] = name
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def _commit(self):
+        self.db.commit()
+        self.num_uncommitted = 0
+
+    def flush(self):
+        if self.db is not None:
+            with self.lock:
+                self._commit()
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
@@ -0,0 +1,295 @@
+"""
+Process wide counters, histograms and gauges.
+
+Metrics are disabled by default. Hot paths only pay for instrumentation
+when :func:`enable` was called, either because they check ``enabled``
+before timing anything or because the instrumented wrappers are only
+installed once metrics are enabled.
+
+"""
+from bisect import bisect_left
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import logging
+import os
+import threading
+import time
+
+from . import json
+
+log = logging.getLogger(__name__)
+
+enabled = False
+
+default_buckets = (
+    0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005,
+    0.01, 0.05, 0.1, 0.5, 1, 5,
+)
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    inner = ','.join(f'{key}="{value}"' for key, value in labels)
+    return '{' + inner + '}'
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, n=1):
+        with self.lock:
+            self.value += n
+
+    def samples(self):
+        yield self.name, self.labels, self.value
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=default_buckets):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = buckets
+        self.reset()
+
+    def reset(self):
+        self.lock = threading.Lock()
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        i = bisect_left(self.buckets, value)
+        with self.lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += value
+
+    def samples(self):
+        # a consistent copy so the buckets add up to the count
+        with self.lock:
+            counts = list(self.counts)
+            count = self.count
+            sum = self.sum
+        total = 0
+        for le, n in zip(self.buckets, counts):
+            total += n
+            yield f'{self.name}_bucket', self.labels + (('le', le),), total
+        yield f'{self.name}_bucket', self.labels + (('le', '+Inf'),), count
+        yield f'{self.name}_sum', self.labels, sum
+        yield f'{self.name}_count', self.labels, count
+
+class Gauge:
+    kind = 'gauge'
+
+    def __init__(self, name, help, labels=(), fn=None):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+        self.reset()
+
+    def reset(self):
+        self.value = 0
+
+    def set(self, value):
+        self.value = value
+
+    def samples(self):
+        value = self.fn() if self.fn is not None else self.value
+        yield self.name, self.labels, value
+
+registry = {}
+registry_lock = threading.Lock()
+
+def get_metric(cls, name, help, labels, **kw):
+    labels = tuple(sorted(labels.items()))
+    key = (name, labels)
+    with registry_lock:
+        metric = registry.get(key)
+        if metric is None:
+            metric = registry[key] = cls(name, help, labels, **kw)
+        return metric
+
+def counter(name, help, **labels):
+    return get_metric(Counter, name, help, labels)
+
+def histogram(name, help, *, buckets=default_buckets, **labels):
+    return get_metric(Histogram, name, help, labels, buckets=buckets)
+
+def gauge(name, help, *, fn=None, **labels):
+    return get_metric(Gauge, name, help, labels, fn=fn)
+
+def collect():
+    with registry_lock:
+        metrics = list(registry.values())
+    return sorted(metrics, key=lambda metric: (metric.name, metric.labels))
+
+def render_prometheus():
+    lines = []
+    last_name = None
+    for metric in collect():
+        if metric.name != last_name:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            last_name = metric.name
+        for name, labels, value in metric.samples():
+            lines.append(f'{name}{format_labels(labels)} {value}')
+    return '\n'.join(lines) + '\n'
+
+def snapshot():
+    data = {}
+    for metric in collect():
+        key = metric.name + format_labels(metric.labels)
+        if metric.kind == 'histogram':
+            samples = {name: value for name, _, value in metric.samples()}
+            data[key] = {
+                'count': samples[f'{metric.name}_count'],
+                'sum': samples[f'{metric.name}_sum'],
+            }
+        else:
+            data[key] = next(metric.samples())[2]
+    return data
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+        body = render_prometheus().encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        log.debug(format % args)
+
+def serve(port, host='127.0.0.1'):
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(
+        target=server.serve_forever,
+        name='metrics-http',
+        daemon=True,
+    )
+    thread.start()
+    log.info(f'serving metrics on http://{host}:{port}/metrics')
+    return server
+
+def write_json_lines(path, interval):
+    def run():
+        while True:
+            time.sleep(interval.total_seconds())
+            line = json.dumps({
+                'ts': datetime.utcnow().isoformat(),
+                'pid': os.getpid(),
+                'metrics': snapshot(),
+            })
+            with open(path, 'ab') as fp:
+                fp.write(line + b'\n')
+
+    thread = threading.Thread(target=run, name='metrics-json', daemon=True)
+    thread.start()
+    log.info(f'writing metrics to path={path}')
+    return thread
+
+def enable(*, port=None, path=None, interval=None):
+    global enabled
+
+    if enabled:
+        log.warning('metrics are already enabled')
+        return
+    enabled = True
+    json.instrument(histogram(
+        'sos_json_loads_seconds',
+        'Time spent parsing statuses.',
+    ))
+    if port is not None:
+        serve(port)
+    if path is not None:
+        write_json_lines(path, interval)
+
+def reset():
+    """
+    Disable metrics and zero every one of them.
+
+    A forked process inherits the values of its parent, and its locks in
+    whatever state other threads left them, but not the threads serving
+    them, so it calls this before enabling metrics of its own.
+
+    """
+    global enabled, registry_lock
+
+    enabled = False
+    registry_lock = threading.Lock()
+    for metric in registry.values():
+        metric.reset()
+    json.instrument(None)
+
+class RateReporter:
+    """
+    Count records and periodically log how many were received.
+
+    ``stats`` is an optional callable returning more details to append to
+    the message. When ``on_report`` is set it receives the count instead of
+    it being logged.
+
+    """
+    def __init__(
+        self,
+        interval,
+        *,
+        stats=None,
+        on_report=None,
+        logger=log,
+        name='records',
+    ):
+        self.interval = interval
+        self.log = logger
+        self.stats = stats
+        self.on_report = on_report
+        self.last_report_at = datetime.utcnow()
+        self.num_records_since_report = 0
+        self.records_total = counter(
+            f'sos_{name}_received_total',
+            f'The number of {name} received.',
+        )
+
+    def record(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        self.num_records_since_report += 1
+        if enabled:
+            self.records_total.inc()
+        if now - self.last_report_at >= self.interval:
+            self.report(now=now)
+
+    def report(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        dt = now - self.last_report_at
+
+        if self.on_report is not None:
+            self.on_report(self.num_records_since_report)
+        else:
+            msg = (
+                f'received {self.num_records_since_report} records since '
+                f'{dt.total_seconds():.2f} seconds ago'
+            )
+            stats = self.stats() if self.stats is not None else ''
+            if stats:
+                msg += f', {stats}'
+            self.log.info(msg)
+        self.last_report_at = now
+        self.num_records_since_report = 0
@@ -1,26 +1,131 @@
+import asyncio
 from datetime import datetime, timedelta
-import json
 import logging
+import multiprocessing
+import os
 import pika
+import queue
 import signal
+import yaml
 
-from .output_streams import output_stream_from_config
+from . import metrics
+from .output_streams import (
+    AsyncDedupeOutputStream,
+    DedupeOutputStream,
+    output_stream_from_config,
+)
+from .routing import Router
 
 log = logging.getLogger(__name__)
 
+worker_restart_delay = timedelta(seconds=5)
+
 def main(cli, args):
     profile = cli.profile
 
-    connection = pika.BlockingConnection(pika.URLParameters(profile['rabbitmq']['url']))
-    channel = connection.channel()
-    channel.queue_declare(args.queue)
+    # the broker stops delivering once prefetch messages are unacked, so a
+    # batch would only be completed by the ack interval
+    if (
+        args.ack_batch_size > 1
+        and args.prefetch
+        and args.prefetch < args.ack_batch_size
+    ):
+        cli.abort('--prefetch must be at least --ack-batch-size')
+
+    if args.workers > 1:
+        num_failed = run_workers(profile, args)
+        if num_failed:
+            cli.abort(f'{num_failed} workers exited with an error')
+    elif args.asyncio:
+        asyncio.run(consume_async(profile, args))
+    else:
+        consume(profile, args)
+
+def make_output_stream(
+    profile,
+    args,
+    *,
+    output_path_prefix,
+    sqlite_path,
+    dedupe_path,
+    fanout_spill_path_prefix,
+    asynchronous=False,
+):
+    router = None
+    if args.routes_file:
+        with open(args.routes_file, 'r', encoding='utf8') as fp:
+            router = Router.from_config(yaml.safe_load(fp))
 
     output_stream = output_stream_from_config(
         profile,
-        output_path_prefix=args.output_path_prefix,
+        output_path_prefix=output_path_prefix,
+        output_frame_records=args.output_frame_records,
+        output_frame_bytes=args.output_frame_bytes,
+        output_dictionary=args.output_dictionary,
+        output_flush_records=args.output_flush_records,
+        output_flush_interval=args.output_flush_interval,
+        output_flush_frames=args.output_flush_frames,
+        output_fsync=args.output_fsync,
+        output_rotate_interval=args.output_rotate_interval,
+        output_rotate_bytes=args.output_rotate_bytes,
+        output_rotate_records=args.output_rotate_records,
+        output_compact_level=args.output_compact_level,
+        sqlite_path=sqlite_path,
         gcp_firestore_collection=args.gcp_firestore_collection,
         gcp_image_bucket=args.gcp_image_bucket,
+        fanout_queue_size=args.fanout_queue_size,
+        fanout_overflow=args.fanout_overflow,
+        fanout_spill_path_prefix=fanout_spill_path_prefix,
+        router=router,
+        asynchronous=asynchronous,
     )
+    if args.dedupe:
+        dedupe_cls = AsyncDedupeOutputStream if asynchronous else DedupeOutputStream
+        output_stream = dedupe_cls(
+            output_stream,
+            window=args.dedupe_window,
+            max_size=args.dedupe_max_size,
+            path=dedupe_path,
+        )
+    return output_stream
+
+def consume(
+    profile,
+    args,
+    *,
+    output_path_prefix=None,
+    sqlite_path=None,
+    dedupe_path=None,
+    fanout_spill_path_prefix=None,
+    on_report=None,
+    connection=None,
+    output_stream=None,
+):
+    if output_path_prefix is None:
+        output_path_prefix = args.output_path_prefix
+    if sqlite_path is None:
+        sqlite_path = args.sqlite_path
+    if dedupe_path is None:
+        dedupe_path = args.dedupe_path
+    if fanout_spill_path_prefix is None:
+        fanout_spill_path_prefix = args.fanout_spill_path_prefix
+
+    if connection is None:
+        connection = pika.BlockingConnection(pika.URLParameters(profile['rabbitmq']['url']))
+    channel = connection.channel()
+    channel.queue_declare(args.queue)
+    if args.prefetch:
+        channel.basic_qos(prefetch_count=args.prefetch)
+
+    if output_stream is None:
+        output_stream = make_output_stream(
+            profile,
+            args,
+            output_path_prefix=output_path_prefix,
+            sqlite_path=sqlite_path,
+            dedupe_path=dedupe_path,
+            fanout_spill_path_prefix=fanout_spill_path_prefix,
+        )
 
     def on_sighup(*args):
         log.info('received SIGHUP, rotating')
@@ -30,38 +135,80 @@ def main(cli, args):
         log.info('received SIGTERM, stopping')
         channel.stop_consuming()
 
-    def report(now=None):
-        nonlocal last_report_at, num_records_since_report
+    reporter = metrics.RateReporter(
+        args.report_interval,
+        stats=getattr(output_stream, 'stats', None),
+        on_report=on_report,
+        logger=log,
+    )
+
+    def ack_pending(now=None):
+        nonlocal last_ack_at, num_unacked, requeue_pending
 
         if now is None:
             now = datetime.utcnow()
-        dt = now - last_report_at
+        last_ack_at = now
+        if not num_unacked:
+            return
 
-        log.info(
-            f'received {num_records_since_report} records since '
-            f'{dt.total_seconds():.2f} seconds ago'
-        )
-        last_report_at = now
-        num_records_since_report = 0
+        # only ack once the output stream has durably written everything
+        # up to this point - on failure requeue them to be retried, a later
+        # multiple ack would otherwise cover them too
+        try:
+            output_stream.flush()
+        except Exception:
+            log.exception(f'failed to flush {num_unacked} messages')
+            requeue_pending = True
+
+        if requeue_pending:
+            log.warning(f'requeueing {num_unacked} messages')
+            channel.basic_nack(
+                delivery_tag=last_delivery_tag,
+                multiple=True,
+                requeue=True,
+            )
+        else:
+            channel.basic_ack(delivery_tag=last_delivery_tag, multiple=True)
+        num_unacked = 0
+        requeue_pending = False
+
+    def on_ack_timer():
+        if datetime.utcnow() - last_ack_at >= args.ack_interval:
+            ack_pending()
+        connection.call_later(args.ack_interval.total_seconds(), on_ack_timer)
 
     def on_message(channel, method_frame, header_frame, body):
-        nonlocal num_records_since_report
+        nonlocal last_delivery_tag, num_unacked, requeue_pending
         now = datetime.utcnow()
-        num_records_since_report += 1
 
         try:
-            status = json.loads(body.decode('utf8'))
-            output_stream.on_status(status)
+            output_stream.on_raw(body)
         except Exception:
             log.exception(f'failed to handle message={body}')
+            # retry a failed message once, then give up on it
+            if batch_acks and not method_frame.redelivered:
+                requeue_pending = True
 
-        channel.basic_ack(delivery_tag=method_frame.delivery_tag)
+        if batch_acks:
+            last_delivery_tag = method_frame.delivery_tag
+            num_unacked += 1
+            if (
+                num_unacked >= args.ack_batch_size
+                or now - last_ack_at >= args.ack_interval
+            ):
+                ack_pending(now=now)
+        else:
+            channel.basic_ack(delivery_tag=method_frame.delivery_tag)
 
-        if now - last_report_at >= args.report_interval:
-            report(now=now)
+        reporter.record(now=now)
 
-    last_report_at = datetime.utcnow()
-    num_records_since_report = 0
+    batch_acks = args.ack_batch_size > 1
+    last_ack_at = datetime.utcnow()
+    last_delivery_tag = None
+    num_unacked = 0
+    requeue_pending = False
+    if batch_acks:
+        connection.call_later(args.ack_interval.total_seconds(), on_ack_timer)
 
     channel.basic_consume(args.queue, on_message)
     signal.signal(signal.SIGTERM, on_sigterm)
@@ -73,5 +220,337 @@ def main(cli, args):
         channel.stop_consuming()
     signal.signal(signal.SIGHUP, signal.SIG_DFL)
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    if batch_acks:
+        ack_pending()
     output_stream.close()
     connection.close()
+    reporter.report()
+
+async def consume_async(
+    profile,
+    args,
+    *,
+    output_path_prefix=None,
+    sqlite_path=None,
+    dedupe_path=None,
+    fanout_spill_path_prefix=None,
+    on_report=None,
+    connection=None,
+    output_stream=None,
+):
+    """
+    The asyncio counterpart of :func:`consume`.
+
+    Messages are handed to an asyncio output stream so that consuming
+    overlaps with publishing, firestore writes and media downloads.
+
+    """
+    if output_path_prefix is None:
+        output_path_prefix = args.output_path_prefix
+    if sqlite_path is None:
+        sqlite_path = args.sqlite_path
+    if dedupe_path is None:
+        dedupe_path = args.dedupe_path
+    if fanout_spill_path_prefix is None:
+        fanout_spill_path_prefix = args.fanout_spill_path_prefix
+
+    if connection is None:
+        # only imported here as aio-pika is only needed with --asyncio
+        import aio_pika
+        connection = await aio_pika.connect_robust(profile['rabbitmq']['url'])
+    channel = await connection.channel()
+    if args.prefetch:
+        await channel.set_qos(prefetch_count=args.prefetch)
+    queue = await channel.declare_queue(args.queue)
+
+    if output_stream is None:
+        output_stream = make_output_stream(
+            profile,
+            args,
+            output_path_prefix=output_path_prefix,
+            sqlite_path=sqlite_path,
+            dedupe_path=dedupe_path,
+            fanout_spill_path_prefix=fanout_spill_path_prefix,
+            asynchronous=True,
+        )
+
+    reporter = metrics.RateReporter(
+        args.report_interval,
+        stats=getattr(output_stream, 'stats', None),
+        on_report=on_report,
+        logger=log,
+    )
+    messages = queue.iterator()
+    ack_lock = asyncio.Lock()
+    background = set()
+
+    def run_in_background(coro):
+        task = asyncio.create_task(coro)
+        background.add(task)
+        task.add_done_callback(background.discard)
+
+    def on_sighup():
+        log.info('received SIGHUP, rotating')
+        run_in_background(output_stream.rotate())
+
+    def on_stop(name):
+        log.info(f'received {name}, stopping')
+        # ends the iteration below once the consumer is cancelled
+        run_in_background(messages.close())
+
+    async def ack_pending():
+        nonlocal last_ack_at, num_unacked, requeue_pending
+
+        async with ack_lock:
+            last_ack_at = datetime.utcnow()
+            if not num_unacked:
+                return
+            message = last_message
+            num_acked = num_unacked
+
+            # only ack once the output stream has durably written everything
+            # up to this point - on failure requeue them to be retried, a
+            # later multiple ack would otherwise cover them too
+            try:
+                await output_stream.flush()
+            except Exception:
+                log.exception(f'failed to flush {num_acked} messages')
+                requeue_pending = True
+
+            # messages received while flushing are after this one and are
+            # left for the next ack
+            if requeue_pending:
+                log.warning(f'requeueing {num_acked} messages')
+                requeue_pending = False
+                await message.nack(multiple=True, requeue=True)
+            else:
+                await message.ack(multiple=True)
+            num_unacked -= num_acked
+
+    async def ack_timer():
+        while True:
+            await asyncio.sleep(args.ack_interval.total_seconds())
+            if datetime.utcnow() - last_ack_at >= args.ack_interval:
+                await ack_pending()
+
+    batch_acks = args.ack_batch_size > 1
+    last_ack_at = datetime.utcnow()
+    last_message = None
+    num_unacked = 0
+    requeue_pending = False
+    timer = None
+    if batch_acks:
+        timer = asyncio.create_task(ack_timer())
+
+    loop = asyncio.get_running_loop()
+    loop.add_signal_handler(signal.SIGHUP, on_sighup)
+    loop.add_signal_handler(signal.SIGTERM, on_stop, 'SIGTERM')
+    loop.add_signal_handler(signal.SIGINT, on_stop, 'SIGINT')
+    try:
+        async with messages:
+            async for message in messages:
+                now = datetime.utcnow()
+
+                try:
+                    await output_stream.on_raw(message.body)
+                except Exception:
+                    log.exception(f'failed to handle message={message.body}')
+                    # retry a failed message once, then give up on it
+                    if batch_acks and not message.redelivered:
+                        requeue_pending = True
+
+                if batch_acks:
+                    last_message = message
+                    num_unacked += 1
+                    if (
+                        num_unacked >= args.ack_batch_size
+                        or now - last_ack_at >= args.ack_interval
+                    ):
+                        await ack_pending()
+                else:
+                    await message.ack()
+
+                reporter.record(now=now)
+    finally:
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            loop.remove_signal_handler(signum)
+        if timer is not None:
+            timer.cancel()
+        if background:
+            await asyncio.wait(background)
+        if batch_acks:
+            await ack_pending()
+        await output_stream.close()
+        await connection.close()
+        reporter.report()
+
+def worker_main(profile, args, worker_id, report_queue):
+    # a restarted worker inherits the handler run_workers installed
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+
+    output_path_prefix = args.output_path_prefix
+    if output_path_prefix:
+        output_path_prefix = f'{output_path_prefix}.w{worker_id}'
+    # sqlite only allows a single writer at a time
+    sqlite_path = args.sqlite_path
+    if sqlite_path:
+        sqlite_path = f'{sqlite_path}.w{worker_id}'
+    dedupe_path = args.dedupe_path
+    if dedupe_path:
+        dedupe_path = f'{dedupe_path}.w{worker_id}'
+    fanout_spill_path_prefix = args.fanout_spill_path_prefix
+    if fanout_spill_path_prefix:
+        fanout_spill_path_prefix = f'{fanout_spill_path_prefix}.w{worker_id}'
+
+    # each worker serves its own metrics on the ports after the parent's
+    # and writes them to its own file, starting from zero rather than the
+    # values it inherited from the parent
+    metrics.reset()
+    if args.metrics_port or args.metrics_file:
+        metrics_file = args.metrics_file
+        if metrics_file:
+            metrics_file = f'{metrics_file}.w{worker_id}'
+        metrics.enable(
+            port=args.metrics_port + 1 + worker_id if args.metrics_port else None,
+            path=metrics_file,
+            interval=args.metrics_interval,
+        )
+
+    def on_report(num_records):
+        report_queue.put((worker_id, num_records))
+
+    log.info(f'starting worker={worker_id} pid={os.getpid()}')
+    kw = dict(
+        output_path_prefix=output_path_prefix,
+        sqlite_path=sqlite_path,
+        dedupe_path=dedupe_path,
+        fanout_spill_path_prefix=fanout_spill_path_prefix,
+        on_report=on_report,
+    )
+    if args.asyncio:
+        asyncio.run(consume_async(profile, args, **kw))
+    else:
+        consume(profile, args, **kw)
+
+def start_worker(profile, args, worker_id, report_queue):
+    worker = multiprocessing.Process(
+        target=worker_main,
+        args=(profile, args, worker_id, report_queue),
+        name=f'mq-archive-{worker_id}',
+    )
+    worker.start()
+    return worker
+
+def run_workers(profile, args):
+    """
+    Run ``args.workers`` consumer processes until they are stopped.
+
+    A worker that exits before the workers were asked to stop is started
+    again after ``worker_restart_delay``. Returns the number of workers
+    whose last process exited with an error.
+
+    """
+    report_queue = multiprocessing.Queue()
+    workers = {
+        worker_id: start_worker(profile, args, worker_id, report_queue)
+        for worker_id in range(args.workers)
+    }
+    restart_at = {}
+    stopping = False
+
+    def forward_signal(signum):
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, signum)
+
+    def on_sighup(*args):
+        log.info('received SIGHUP, rotating workers')
+        forward_signal(signal.SIGHUP)
+
+    def on_sigterm(*args):
+        nonlocal stopping
+
+        log.info('received SIGTERM, stopping workers')
+        stopping = True
+        forward_signal(signal.SIGTERM)
+
+    def on_sigint(*args):
+        nonlocal stopping
+
+        # the workers are in the same process group and will also have
+        # received the SIGINT so just wait for them to finish
+        log.info('received SIGINT, waiting for workers to stop')
+        stopping = True
+
+    def num_alive():
+        return sum(1 for worker in workers.values() if worker.is_alive())
+
+    def restart_workers(now):
+        for worker_id, worker in workers.items():
+            if worker.is_alive():
+                continue
+            if worker_id not in restart_at:
+                worker.join()
+                log.error(
+                    f'worker={worker.name} exited with code={worker.exitcode}, '
+                    f'restarting in {worker_restart_delay.total_seconds():.0f} '
+                    'seconds'
+                )
+                restart_at[worker_id] = now + worker_restart_delay
+            elif now >= restart_at[worker_id]:
+                del restart_at[worker_id]
+                workers[worker_id] = start_worker(
+                    profile, args, worker_id, report_queue)
+
+    def report(now=None):
+        nonlocal last_report_at, num_records_since_report
+
+        if now is None:
+            now = datetime.utcnow()
+        dt = now - last_report_at
+
+        log.info(
+            f'received {num_records_since_report} records from '
+            f'{num_alive()} workers since {dt.total_seconds():.2f} seconds ago'
+        )
+        last_report_at = now
+        num_records_since_report = 0
+
+    last_report_at = datetime.utcnow()
+    num_records_since_report = 0
+
+    # handled rather than raised so that a SIGINT at any point still waits
+    # for the workers to stop
+    signal.signal(signal.SIGINT, on_sigint)
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGHUP, on_sighup)
+    while not stopping or num_alive():
+        try:
+            _, num_records = report_queue.get(timeout=0.5)
+            num_records_since_report += num_records
+        except queue.Empty:
+            pass
+
+        now = datetime.utcnow()
+        if not stopping:
+            restart_workers(now)
+        if now - last_report_at >= args.report_interval:
+            report(now=now)
+
+    while True:
+        try:
+            _, num_records = report_queue.get_nowait()
+            num_records_since_report += num_records
+        except queue.Empty:
+            break
+    num_failed = 0
+    for worker in workers.values():
+        worker.join()
+        if worker.exitcode:
+            log.error(f'worker={worker.name} exited with code={worker.exitcode}')
+            num_failed += 1
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    report()
+    return num_failed
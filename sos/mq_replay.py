@@ -1,35 +1,434 @@
-import io
-import json
+from collections import deque
+from datetime import datetime, timezone
+import heapq
+import itertools
 import logging
-import zstandard as zstd
+import multiprocessing
+import os
+import queue
+import time
 
+from . import json, zstd
 from .output_streams import output_stream_from_config
 
 log = logging.getLogger(__name__)
 
-def parse_tweet_stream(path):
+checkpoint_batch_size = 100
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.next_at = time.monotonic()
+
+    def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        if self.next_at > now:
+            time.sleep(self.next_at - now)
+        else:
+            # do not let an idle period turn into a burst
+            self.next_at = now
+        self.next_at += self.interval
+
+def units_for_file(path):
+    # indexed archives are split into frames which can be read in parallel
+    if os.path.exists(zstd.index_path_for(path)):
+        return [(path, entry) for entry in zstd.read_index(path)]
+    return [(path, None)]
+
+def iter_unit(unit, dictionary=None):
+    path, entry = unit
+    dict_data = zstd.load_dictionary(dictionary) if dictionary else None
     with open(path, 'rb') as fp:
-        dctx = zstd.ZstdDecompressor()
-        stream_reader = dctx.stream_reader(fp)
-        stream = io.TextIOWrapper(stream_reader, encoding='utf8')
-        for line in stream:
-            line = line.strip()
-            if line:
+        if entry is None:
+            yield from zstd.iter_raw_lines(fp, dict_data=dict_data)
+        else:
+            yield from zstd.iter_frame_lines(fp, entry, dict_data=dict_data)
+
+def read_unit(unit, dictionary=None):
+    return list(iter_unit(unit, dictionary))
+
+def unit_key(unit):
+    path, entry = unit
+    return (path, entry['offset'] if entry is not None else None)
+
+class Checkpoint:
+    """
+    Durable replay progress.
+
+    Units (files or frames of indexed files) that were fully published and
+    confirmed are recorded as completed along with how many records of the
+    current unit were confirmed. Resuming only has to decompress the
+    current unit, which is a single frame for indexed archives.
+
+    Progress is appended to ``path`` as json lines so a save costs the same
+    however long the run is. The file is compacted when it is opened.
+
+    """
+    def __init__(self, path, *, resume=False):
+        self.path = path
+        self.completed = set()
+        self.current = None
+        self.current_records = 0
+        self.fp = None
+        if resume and os.path.exists(path):
+            self.load()
+            log.info(
+                f'resuming from checkpoint={path} with '
+                f'{len(self.completed)} completed units'
+            )
+        self.compact()
+
+    def load(self):
+        with open(self.path, 'rb') as fp:
+            for line in fp:
                 try:
-                    yield json.loads(line)
-                except Exception as ex:
-                    log.exception(ex)
+                    entry = json.loads(line)
+                except Exception:
+                    # a save torn by a crash can only be the last line
+                    log.warning(f'ignoring partial checkpoint line={line!r}')
+                    break
+                if 'completed' in entry:
+                    key = tuple(entry['completed'])
+                    self.completed.add(key)
+                    if key == self.current:
+                        self.current = None
+                        self.current_records = 0
+                else:
+                    self.current = tuple(entry['current'])
+                    self.current_records = entry['records']
 
-def main(cli, args):
-    profile = cli.profile
+    def compact(self):
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            for key in sorted(self.completed, key=lambda k: (k[0], k[1] or 0)):
+                fp.write(json.dumps({'completed': key}) + b'\n')
+            if self.current is not None:
+                fp.write(json.dumps({
+                    'current': self.current,
+                    'records': self.current_records,
+                }) + b'\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+        self.fp = open(self.path, 'ab')
+
+    def close(self):
+        if self.fp is not None:
+            self.fp.close()
+            self.fp = None
+
+    def append(self, entry):
+        self.fp.write(json.dumps(entry) + b'\n')
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+
+    def records_done(self, key):
+        if key == self.current:
+            return self.current_records
+        return 0
+
+    def update(self, key, records):
+        self.current = key
+        self.current_records = records
+        self.append({'current': key, 'records': records})
+
+    def complete(self, key):
+        self.completed.add(key)
+        if key == self.current:
+            self.current = None
+            self.current_records = 0
+        self.append({'completed': key})
+
+def iter_unit_lines(pool, units, *, prefetch, dictionary=None):
+    """
+    Yield the lines of ``units`` in order, decompressing up to ``prefetch``
+    frames ahead in ``pool``.
+
+    Only frames of indexed files are read whole, their size is bounded by
+    the writer. Unindexed files are streamed in this process instead so
+    they are never held in memory or pickled at once.
+
+    """
+    units = iter(units)
+    pending = deque()
+
+    def fill():
+        while len(pending) < prefetch:
+            unit = next(units, None)
+            if unit is None:
+                return
+            if unit[1] is None:
+                pending.append(unit)
+            else:
+                pending.append(pool.apply_async(read_unit, (unit, dictionary)))
+
+    fill()
+    while pending:
+        item = pending.popleft()
+        if isinstance(item, tuple):
+            yield from iter_unit(item, dictionary)
+            fill()
+        else:
+            lines = item.get()
+            fill()
+            yield from lines
+
+def id_key(line):
+    m = zstd.status_id_re.search(line)
+    return int(m.group(1)) if m else 0
 
-    output_stream = output_stream_from_config(
+def created_at_key(line):
+    m = zstd.created_at_re.search(line)
+    if m:
+        try:
+            return datetime.strptime(
+                m.group(1).decode('utf8'), '%a %b %d %H:%M:%S %z %Y')
+        except ValueError:
+            pass
+    return datetime.min.replace(tzinfo=timezone.utc)
+
+order_keys = {
+    'id': id_key,
+    'created_at': created_at_key,
+}
+
+def make_output_stream(profile, args):
+    return output_stream_from_config(
         profile,
         rabbitmq_exchange=args.exchange,
         rabbitmq_routing_key=args.routing_key,
+        rabbitmq_batch_size=args.batch_size,
+    )
+
+def publish(output_stream, lines, rate_limiter):
+    num_records = 0
+    for line in lines:
+        rate_limiter.wait()
+        output_stream.on_raw(line)
+        num_records += 1
+    return num_records
+
+def publish_units(
+    output_stream,
+    units,
+    rate_limiter,
+    checkpoint,
+    interval,
+    *,
+    dictionary=None,
+):
+    num_records = 0
+    for unit in units:
+        key = unit_key(unit)
+        if key in checkpoint.completed:
+            continue
+        # unindexed files still need to be decompressed up to the record
+        skip = checkpoint.records_done(key)
+        n = 0
+        for line in iter_unit(unit, dictionary):
+            n += 1
+            if n <= skip:
+                continue
+            rate_limiter.wait()
+            output_stream.on_raw(line)
+            num_records += 1
+            if n % interval == 0:
+                output_stream.flush()
+                checkpoint.update(key, n)
+        output_stream.flush()
+        checkpoint.complete(key)
+    return num_records
+
+def main(cli, args):
+    profile = cli.profile
+    start = time.monotonic()
+
+    if args.checkpoint_file and args.order != 'none':
+        cli.abort('--checkpoint-file cannot be used with --order')
+    if args.resume and not args.checkpoint_file:
+        cli.abort('--resume requires --checkpoint-file')
+    # only confirmed publishes may be checkpointed and only batches are
+    # published with confirms
+    if args.checkpoint_file:
+        if args.batch_size is None:
+            args.batch_size = checkpoint_batch_size
+            log.info(
+                f'publishing in batches of {args.batch_size} with confirms '
+                'for --checkpoint-file'
+            )
+        elif args.batch_size <= 1:
+            cli.abort('--checkpoint-file requires a --batch-size above 1')
+
+    num_failed = 0
+    if args.jobs > 1 and args.order == 'none':
+        num_records, num_failed = replay_unordered(profile, args)
+    elif args.checkpoint_file:
+        num_records = replay_checkpointed(profile, args)
+    else:
+        num_records = replay_ordered(profile, args)
+
+    dt = time.monotonic() - start
+    log.info(
+        f'replayed {num_records} records in {dt:.2f} seconds '
+        f'({num_records / dt:.0f}/s)'
     )
+    if num_failed:
+        cli.abort(f'{num_failed} publishers exited with an error')
+
+def replay_ordered(profile, args):
+    output_stream = make_output_stream(profile, args)
+    rate_limiter = RateLimiter(args.rate)
 
+    if args.jobs <= 1 and args.order == 'none':
+        def lines():
+            for file in args.files:
+                yield from iter_unit((file, None), args.dictionary)
+        num_records = publish(output_stream, lines(), rate_limiter)
+        output_stream.close()
+        return num_records
+
+    # each file is decompressed by the pool a few frames ahead of the
+    # publisher and the files are merged by the requested key assuming
+    # each file is already in order - about --jobs frames are in flight in
+    # total, but at least one per file, so merging many files does not
+    # hold many frames of each in memory
+    prefetch = max(1, args.jobs // len(args.files))
+    with multiprocessing.Pool(args.jobs) as pool:
+        file_lines = [
+            iter_unit_lines(
+                pool,
+                units_for_file(file),
+                prefetch=prefetch,
+                dictionary=args.dictionary,
+            )
+            for file in args.files
+        ]
+        if args.order == 'none':
+            lines = itertools.chain.from_iterable(file_lines)
+        else:
+            lines = heapq.merge(*file_lines, key=order_keys[args.order])
+        num_records = publish(output_stream, lines, rate_limiter)
+    output_stream.close()
+    return num_records
+
+def replay_checkpointed(profile, args):
+    output_stream = make_output_stream(profile, args)
+    rate_limiter = RateLimiter(args.rate)
+    checkpoint = Checkpoint(args.checkpoint_file, resume=args.resume)
+    units = (
+        unit
+        for file in args.files
+        for unit in units_for_file(file)
+    )
+    try:
+        return publish_units(
+            output_stream,
+            units,
+            rate_limiter,
+            checkpoint,
+            args.checkpoint_interval,
+            dictionary=args.dictionary,
+        )
+    finally:
+        output_stream.close()
+        checkpoint.close()
+
+def publisher_main(profile, args, unit_queue, result_queue):
+    output_stream = make_output_stream(profile, args)
+    rate_limiter = RateLimiter(args.rate / args.jobs if args.rate else None)
+    try:
+        for unit in iter(unit_queue.get, None):
+            lines = iter_unit(unit, args.dictionary)
+            num_records = publish(output_stream, lines, rate_limiter)
+            # make sure the unit is confirmed before reporting it as done
+            output_stream.flush()
+            result_queue.put((unit_key(unit), num_records))
+    finally:
+        output_stream.close()
+        result_queue.put((None, os.getpid()))
+
+def replay_unordered(profile, args):
+    """
+    Publish the units of ``args.files`` from ``args.jobs`` processes.
+
+    Returns the number of records published by the publishers that
+    finished and the number of publishers that exited with an error. A
+    publisher that was killed stops the replay as it may have left the
+    queues shared with the others locked.
+
+    """
+    checkpoint = None
+    if args.checkpoint_file:
+        checkpoint = Checkpoint(args.checkpoint_file, resume=args.resume)
+
+    unit_queue = multiprocessing.Queue()
+    result_queue = multiprocessing.Queue()
     for file in args.files:
-        tweets = parse_tweet_stream(file)
-        for tweet in tweets:
-            output_stream.on_status(tweet)
+        for unit in units_for_file(file):
+            if checkpoint is not None and unit_key(unit) in checkpoint.completed:
+                continue
+            unit_queue.put(unit)
+    for _ in range(args.jobs):
+        unit_queue.put(None)
+
+    # every publisher decompresses its own units and has its own connection
+    publishers = [
+        multiprocessing.Process(
+            target=publisher_main,
+            args=(profile, args, unit_queue, result_queue),
+            name=f'mq-replay-{n}',
+        )
+        for n in range(args.jobs)
+    ]
+    for publisher in publishers:
+        publisher.start()
+
+    # a partially published unit is replayed from its start on resume
+    num_records = 0
+    finished = set()
+    while len(finished) < len(publishers):
+        # what a publisher reported is readable once it exited
+        alive = any(publisher.is_alive() for publisher in publishers)
+        try:
+            key, value = result_queue.get(block=alive, timeout=0.5)
+        except queue.Empty:
+            killed = [
+                publisher
+                for publisher in publishers
+                if not publisher.is_alive() and publisher.pid not in finished
+            ]
+            if killed:
+                # it may have held the locks of the queues the others use
+                log.error(
+                    f'publisher={killed[0].name} exited without finishing, '
+                    'stopping the other publishers'
+                )
+                for publisher in publishers:
+                    if publisher.is_alive():
+                        publisher.terminate()
+                break
+            continue
+        if key is None:
+            finished.add(value)
+            continue
+        num_records += value
+        if checkpoint is not None:
+            checkpoint.complete(key)
+
+    num_failed = 0
+    for publisher in publishers:
+        publisher.join()
+        if publisher.exitcode:
+            log.error(
+                f'publisher={publisher.name} exited with '
+                f'code={publisher.exitcode}'
+            )
+            num_failed += 1
+    if num_failed:
+        # units no publisher is left to read would block the exit
+        unit_queue.cancel_join_thread()
+    if checkpoint is not None:
+        checkpoint.close()
+    return num_records, num_failed
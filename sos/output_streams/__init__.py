@@ -1,45 +1,184 @@
+from .. import metrics
+from .asynchronous import (
+    AsyncCompositeOutputStream,
+    AsyncDedupeOutputStream,
+    AsyncRoutingOutputStream,
+    ThreadedAsyncOutputStream,
+)
 from .composite import CompositeOutputStream
+from .dedupe import DedupeOutputStream
 from .file import FileOutputStream
 from .gcp_firestore import GCPFirestoreOutputStream
 from .gcp_image_storage import GCPImageStorageOutputStream
+from .instrumented import InstrumentedOutputStream
+from .queued import QueuedOutputStream
 from .rabbitmq import RabbitMqOutputStream
+from .routing import RoutingOutputStream
+from .sqlite import SqliteOutputStream
 from .stdout import StdoutOutputStream
 
+__all__ = [
+    'AsyncCompositeOutputStream',
+    'AsyncDedupeOutputStream',
+    'AsyncRoutingOutputStream',
+    'CompositeOutputStream',
+    'DedupeOutputStream',
+    'FileOutputStream',
+    'GCPFirestoreOutputStream',
+    'GCPImageStorageOutputStream',
+    'InstrumentedOutputStream',
+    'QueuedOutputStream',
+    'RabbitMqOutputStream',
+    'RoutingOutputStream',
+    'SqliteOutputStream',
+    'StdoutOutputStream',
+    'ThreadedAsyncOutputStream',
+    'output_stream_from_config',
+]
+
 def output_stream_from_config(
     profile,
     *,
     rabbitmq_exchange=None,
     rabbitmq_routing_key=None,
+    rabbitmq_batch_size=None,
     output_path_prefix=None,
+    output_frame_records=None,
+    output_frame_bytes=None,
+    output_dictionary=None,
+    output_flush_records=None,
+    output_flush_interval=None,
+    output_flush_frames=False,
+    output_fsync=False,
+    output_rotate_interval=None,
+    output_rotate_bytes=None,
+    output_rotate_records=None,
+    output_compact_level=None,
     gcp_firestore_collection=None,
     gcp_image_bucket=None,
+    sqlite_path=None,
+    fanout_queue_size=None,
+    fanout_overflow='block',
+    fanout_spill_path_prefix=None,
+    router=None,
+    asynchronous=False,
 ):
-    streams = []
+    """
+    Build the output stream writing to every configured sink.
+
+    With ``asynchronous`` the result is an asyncio output stream. Sinks
+    without an asyncio counterpart are then run on their own thread.
+
+    """
+    if asynchronous:
+        # only imported here as aio-pika is only needed with --asyncio
+        from .async_gcp_firestore import AsyncGCPFirestoreOutputStream
+        from .async_gcp_image_storage import AsyncGCPImageStorageOutputStream
+        from .async_rabbitmq import AsyncRabbitMqOutputStream
+
+        rabbitmq_cls = AsyncRabbitMqOutputStream
+        firestore_cls = AsyncGCPFirestoreOutputStream
+        image_storage_cls = AsyncGCPImageStorageOutputStream
+    else:
+        rabbitmq_cls = RabbitMqOutputStream
+        firestore_cls = GCPFirestoreOutputStream
+        image_storage_cls = GCPImageStorageOutputStream
+    blocking_sinks = {'file', 'sqlite'}
+
+    # keyed by the sink names used in routes
+    streams = {}
 
     if output_path_prefix:
-        streams.append(FileOutputStream(output_path_prefix))
+        streams['file'] = FileOutputStream(
+            output_path_prefix,
+            frame_records=output_frame_records,
+            frame_bytes=output_frame_bytes,
+            dictionary=output_dictionary,
+            flush_records=output_flush_records,
+            flush_interval=output_flush_interval,
+            flush_frames=output_flush_frames,
+            fsync=output_fsync,
+            rotate_interval=output_rotate_interval,
+            rotate_bytes=output_rotate_bytes,
+            rotate_records=output_rotate_records,
+            compact_level=output_compact_level,
+        )
+
+    if sqlite_path:
+        streams['sqlite'] = SqliteOutputStream.from_config(profile, sqlite_path)
 
     if rabbitmq_routing_key:
-        streams.append(RabbitMqOutputStream.from_config(
+        streams['rabbitmq'] = rabbitmq_cls.from_config(
             profile['rabbitmq'],
             rabbitmq_exchange,
             rabbitmq_routing_key,
-        ))
+            batch_size=rabbitmq_batch_size,
+        )
 
     if gcp_firestore_collection:
-        streams.append(GCPFirestoreOutputStream.from_config(
+        streams['firestore'] = firestore_cls.from_config(
             profile,
             gcp_firestore_collection,
-        ))
+        )
 
     if gcp_image_bucket:
-        streams.append(GCPImageStorageOutputStream.from_config(
+        streams['gcs'] = image_storage_cls.from_config(
             profile,
             gcp_image_bucket,
-        ))
+        )
+
+    if router is not None:
+        missing = router.sinks - set(streams)
+        if missing:
+            raise ValueError(
+                f'routes write to sinks={sorted(missing)} which are not '
+                'configured'
+            )
+        for key in sorted(router.routing_keys):
+            streams[f'rabbitmq:{key}'] = rabbitmq_cls.from_config(
+                profile['rabbitmq'],
+                rabbitmq_exchange,
+                key,
+                batch_size=rabbitmq_batch_size,
+            )
+
+    if metrics.enabled:
+        # the instrumentation is blocking so asyncio streams go without it
+        streams = {
+            name: (
+                InstrumentedOutputStream(stream, name)
+                if not asynchronous or name in blocking_sinks
+                else stream
+            )
+            for name, stream in streams.items()
+        }
+
+    if asynchronous:
+        streams = {
+            name: (
+                ThreadedAsyncOutputStream(stream)
+                if name in blocking_sinks
+                else stream
+            )
+            for name, stream in streams.items()
+        }
+        if router is not None:
+            return AsyncRoutingOutputStream(router, streams)
+        if len(streams) > 1:
+            return AsyncCompositeOutputStream(streams.values())
+        if len(streams) > 0:
+            return next(iter(streams.values()))
+        return ThreadedAsyncOutputStream(StdoutOutputStream())
 
+    fanout_options = dict(
+        queue_size=fanout_queue_size,
+        overflow=fanout_overflow,
+        spill_path_prefix=fanout_spill_path_prefix,
+    )
+    if router is not None:
+        return RoutingOutputStream(router, streams, **fanout_options)
     if len(streams) > 1:
-        return CompositeOutputStream(streams)
+        return CompositeOutputStream(streams.values(), **fanout_options)
     if len(streams) > 0:
-        return streams[0]
+        return next(iter(streams.values()))
     return StdoutOutputStream()
@@ -0,0 +1,100 @@
+import asyncio
+from google.cloud import firestore
+import logging
+
+from .. import json
+from .gcp_firestore import GCPFirestoreOutputStream
+
+log = logging.getLogger(__name__)
+
+class AsyncGCPFirestoreOutputStream(GCPFirestoreOutputStream):
+    """
+    The asyncio counterpart of :class:`GCPFirestoreOutputStream`.
+
+    Full batches are committed in the background with up to
+    ``max_concurrent_writes`` commits in flight. Documents that could not
+    be written are buffered again when ``flush`` raises.
+
+    """
+    max_concurrent_writes = 4
+
+    def __init__(self, *, collection, client=None, **kw):
+        if client is None:
+            client = firestore.AsyncClient()
+        super().__init__(collection=collection, client=client, **kw)
+        self.writes = set()
+        self.failed = []
+
+    async def close(self):
+        await self.flush()
+
+    async def rotate(self):
+        await self.flush()
+
+    async def commit(self, docs):
+        batch = self.client.batch()
+        for doc, data in docs:
+            batch.set(doc, data)
+        await batch.commit()
+
+    async def write(self, docs):
+        for attempt in range(2):
+            try:
+                await self.commit(docs)
+                return []
+            except Exception:
+                log.exception(f'failed to commit batch of {len(docs)}')
+
+        failed = []
+        for doc, data in docs:
+            try:
+                await doc.set(data)
+            except Exception:
+                log.exception(f'failed to write document={doc.id}')
+                failed.append((doc, data))
+        return failed
+
+    async def write_batch(self, docs):
+        failed = await self.write(docs)
+        # collected here rather than in on_written so they are recorded
+        # before anything waiting on the write wakes up
+        self.failed.extend(failed)
+
+    def on_written(self, task):
+        self.writes.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            log.error('failed to write batch', exc_info=task.exception())
+
+    async def start_write(self, docs):
+        if len(self.writes) >= self.max_concurrent_writes:
+            await asyncio.wait(self.writes, return_when=asyncio.FIRST_COMPLETED)
+        task = asyncio.create_task(self.write_batch(docs))
+        self.writes.add(task)
+        task.add_done_callback(self.on_written)
+
+    async def flush(self):
+        docs = self.take_pending()
+        if docs:
+            await self.start_write(docs)
+        writes = list(self.writes)
+        results = await asyncio.gather(*writes, return_exceptions=True)
+        failed = self.failed
+        self.failed = []
+        if failed:
+            self.keep_pending(failed)
+            raise RuntimeError(f'failed to write {len(failed)} documents')
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+    async def on_status(self, status):
+        await self.add_document(status, json.dumps(status).decode('utf8'))
+
+    async def on_raw(self, raw, status=None):
+        if status is None:
+            status = json.loads(raw)
+        await self.add_document(status, raw.decode('utf8'))
+
+    async def add_document(self, status, raw_json):
+        if self.add_pending(status, raw_json):
+            await self.start_write(self.take_pending())
@@ -0,0 +1,191 @@
+import asyncio
+from google.api_core.exceptions import NotFound
+from google.cloud import storage
+import httpx
+import logging
+import posixpath
+import tempfile
+from urllib.parse import urlparse
+
+from .. import json
+from ..media import MediaCache, media_info_from_status
+from .gcp_image_storage import GCPImageStorageOutputStream, options_from_config
+
+log = logging.getLogger(__name__)
+
+class AsyncGCPImageStorageOutputStream:
+    """
+    The asyncio counterpart of :class:`GCPImageStorageOutputStream`.
+
+    Media is downloaded with an async httpx client into a temporary file,
+    held in memory up to ``chunk_size``, which is then uploaded from a
+    thread as the storage client is blocking.
+
+    """
+    concurrency = GCPImageStorageOutputStream.concurrency
+    per_host_concurrency = GCPImageStorageOutputStream.per_host_concurrency
+    max_pending = GCPImageStorageOutputStream.max_pending
+    chunk_size = GCPImageStorageOutputStream.chunk_size
+
+    def __init__(
+        self,
+        *,
+        bucket,
+        prefix,
+        client=None,
+        http_client=None,
+        concurrency=None,
+        per_host_concurrency=None,
+        max_pending=None,
+        media_cache=None,
+        dedupe_mode='skip',
+    ):
+        if client is None:
+            client = storage.Client()
+        self.bucket = client.bucket(bucket)
+        self.prefix = prefix
+
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if per_host_concurrency is not None:
+            self.per_host_concurrency = per_host_concurrency
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        if http_client is None:
+            http_client = httpx.AsyncClient(
+                limits=httpx.Limits(
+                    max_connections=self.concurrency,
+                    max_keepalive_connections=self.concurrency,
+                ),
+            )
+        self.http_client = http_client
+
+        self.pending = set()
+        self.num_failed = 0
+        self.error = None
+        self.slots = asyncio.BoundedSemaphore(self.max_pending)
+        self.workers = asyncio.BoundedSemaphore(self.concurrency)
+        self.host_slots = {}
+
+        if media_cache is None:
+            media_cache = MediaCache()
+        self.media_cache = media_cache
+        self.dedupe_mode = dedupe_mode
+
+    @classmethod
+    def from_config(cls, profile, bucket):
+        return cls(**options_from_config(profile, bucket))
+
+    async def close(self):
+        try:
+            await self.flush()
+        finally:
+            await self.http_client.aclose()
+            log.info(
+                f'media cache hits={self.media_cache.hits} '
+                f'misses={self.media_cache.misses}'
+            )
+            self.media_cache.close()
+
+    async def rotate(self):
+        pass
+
+    async def flush(self):
+        if self.pending:
+            await asyncio.wait(list(self.pending))
+        self.media_cache.flush()
+
+        error, num_failed = self.error, self.num_failed
+        self.error = None
+        self.num_failed = 0
+        if error is not None:
+            raise RuntimeError(f'failed to store {num_failed} media') from error
+
+    async def on_raw(self, raw, status=None):
+        if status is None:
+            # avoid parsing statuses that cannot contain any media
+            if b'"media"' not in raw:
+                return
+            status = json.loads(raw)
+        await self.on_status(status)
+
+    async def on_status(self, status):
+        for info in media_info_from_status(status):
+            source_name = self.media_cache.get(info)
+            if source_name is not None and self.dedupe_mode == 'skip':
+                log.debug(f'skipping duplicate media={info["name"]}')
+                continue
+
+            if source_name is None:
+                self.media_cache.add(info)
+
+            # hold up the consumer once too many downloads are queued
+            await self.slots.acquire()
+            task = asyncio.create_task(self.store(info, source_name))
+            self.pending.add(task)
+            task.add_done_callback(self.on_stored)
+
+    def on_stored(self, task):
+        self.pending.discard(task)
+        self.slots.release()
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+        slot = self.host_slots.get(host)
+        if slot is None:
+            slot = asyncio.BoundedSemaphore(self.per_host_concurrency)
+            self.host_slots[host] = slot
+        return slot
+
+    async def store(self, info, source_name=None):
+        try:
+            async with self.workers:
+                if source_name is not None:
+                    try:
+                        await asyncio.to_thread(self.copy, info, source_name)
+                        return
+                    except NotFound:
+                        log.debug(
+                            f'media={source_name} is missing, downloading '
+                            f'media={info["name"]} again'
+                        )
+                async with self.host_slot(info['url']):
+                    await self.upload(info)
+            self.media_cache.stored(info)
+        except Exception as ex:
+            if source_name is None:
+                self.media_cache.discard(info)
+            log.exception(f'failed to store media={info["name"]}')
+            # raised from the next flush so the statuses are not acked
+            self.num_failed += 1
+            if self.error is None:
+                self.error = ex
+
+    def copy(self, info, source_name):
+        source = self.bucket.blob(posixpath.join(self.prefix, source_name))
+        self.bucket.copy_blob(
+            source,
+            self.bucket,
+            posixpath.join(self.prefix, info['name']),
+        )
+
+    async def upload(self, info):
+        blob = self.bucket.blob(
+            posixpath.join(self.prefix, info['name']),
+            chunk_size=self.chunk_size,
+        )
+        with tempfile.SpooledTemporaryFile(max_size=self.chunk_size) as fp:
+            async with self.http_client.stream('GET', info['url']) as r:
+                # do not store an error page as the media
+                r.raise_for_status()
+                async for chunk in r.aiter_bytes(64 * 1024):
+                    fp.write(chunk)
+            size = fp.tell()
+            fp.seek(0)
+            await asyncio.to_thread(
+                blob.upload_from_file,
+                fp,
+                size=size,
+                content_type=info['content_type'],
+            )
@@ -0,0 +1,137 @@
+import aio_pika
+import asyncio
+from collections import deque
+from datetime import timedelta
+import logging
+
+from .. import json
+from ..settings import asduration
+from .rabbitmq import UnconfirmedDeliveryError, publish_retries_total
+
+log = logging.getLogger(__name__)
+
+class AsyncRabbitMqOutputStream:
+    """
+    Publish statuses with aio-pika using publisher confirms.
+
+    Up to ``max_unconfirmed`` messages are in flight before publishing
+    waits on the oldest confirm, so confirms overlap with publishing instead
+    of costing a round-trip each. Messages the broker did not confirm are
+    published once more by the next ``on_raw`` or ``flush``, which raise
+    and keep them for later if that fails too.
+
+    """
+    max_unconfirmed = 1000
+    confirm_timeout = timedelta(seconds=30)
+
+    def __init__(
+        self,
+        url,
+        exchange,
+        routing_key,
+        *,
+        max_unconfirmed=None,
+        confirm_timeout=None,
+    ):
+        self.url = url
+        self.exchange_name = exchange or ''
+        self.routing_key = routing_key
+        if max_unconfirmed is not None:
+            self.max_unconfirmed = max_unconfirmed
+        if confirm_timeout is not None:
+            self.confirm_timeout = confirm_timeout
+
+        self.connection = None
+        self.exchange = None
+        self.connect_lock = asyncio.Lock()
+        self.unconfirmed = deque()
+        self.failed = []
+
+    @classmethod
+    def from_config(cls, profile, exchange, routing_key, *, batch_size=None):
+        if batch_size is None:
+            batch_size = profile.get('batch_size')
+        return cls(
+            profile['url'],
+            exchange,
+            routing_key,
+            max_unconfirmed=batch_size,
+            confirm_timeout=asduration(
+                profile.get('confirm_timeout'), default=None),
+        )
+
+    async def connect(self):
+        async with self.connect_lock:
+            if self.exchange is not None:
+                return self.exchange
+            log.info(f'opening new rabbitmq connection={self.url}')
+            # a robust connection reconnects and restores its channels
+            self.connection = await aio_pika.connect_robust(self.url)
+            channel = await self.connection.channel(publisher_confirms=True)
+            if self.exchange_name:
+                self.exchange = await channel.get_exchange(
+                    self.exchange_name, ensure=False)
+            else:
+                self.exchange = channel.default_exchange
+            return self.exchange
+
+    async def disconnect(self):
+        if self.connection is not None:
+            try:
+                await self.connection.close()
+            except Exception:
+                log.exception('failed to close rabbitmq connection')
+            self.connection = None
+            self.exchange = None
+
+    async def close(self):
+        # raise rather than drop what could not be published
+        try:
+            await self.flush()
+        finally:
+            await self.disconnect()
+
+    async def rotate(self):
+        await self.close()
+
+    async def publish(self, raw):
+        try:
+            exchange = await self.connect()
+            await exchange.publish(
+                aio_pika.Message(raw, content_type='application/json'),
+                self.routing_key,
+                mandatory=False,
+                timeout=self.confirm_timeout.total_seconds(),
+            )
+        except Exception as ex:
+            log.warning(f'failed to publish message: {ex!r}')
+            self.failed.append(raw)
+
+    async def flush(self):
+        await asyncio.gather(*self.unconfirmed)
+        self.unconfirmed.clear()
+
+        # do a single retry of whatever the broker did not confirm
+        bodies = self.failed
+        self.failed = []
+        if bodies:
+            log.warning(f'{len(bodies)} messages were not confirmed')
+            publish_retries_total.inc(len(bodies))
+            await asyncio.gather(*(self.publish(body) for body in bodies))
+        if self.failed:
+            raise UnconfirmedDeliveryError(
+                f'broker failed to confirm {len(self.failed)} messages')
+
+    async def on_status(self, status):
+        await self.on_raw(json.dumps(status), status)
+
+    async def on_raw(self, raw, status=None):
+        self.unconfirmed.append(asyncio.create_task(self.publish(raw)))
+        while self.unconfirmed and self.unconfirmed[0].done():
+            self.unconfirmed.popleft()
+        if len(self.unconfirmed) >= self.max_unconfirmed:
+            await self.unconfirmed.popleft()
+        if self.failed:
+            # retry failures now and raise if they persist rather than
+            # carrying on until the next flush
+            await self.flush()
@@ -0,0 +1,249 @@
+"""
+Output streams for use on an asyncio event loop.
+
+These mirror the blocking output streams except that ``on_raw``,
+``on_status``, ``flush``, ``rotate`` and ``close`` are coroutines. A
+coroutine returning does not mean the status was written, only ``flush``
+waits for that, so that a slow sink overlaps with the consumer instead of
+holding it up.
+
+"""
+import asyncio
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+from .. import json
+from .composite import stream_name
+from .dedupe import DedupeOutputStream
+
+log = logging.getLogger(__name__)
+
+class ThreadedAsyncOutputStream:
+    """
+    Call a blocking output stream from the event loop on its own thread.
+
+    Every call runs in order on a single thread so ``stream`` does not need
+    to be thread safe. Up to ``max_pending`` statuses are handed off before
+    ``on_raw`` waits for the stream to catch up. Errors writing a status are
+    logged and counted, ``flush`` and ``close`` then raise so callers do not
+    treat them as written. Errors from ``flush``, ``rotate`` and ``close``
+    themselves are raised.
+
+    """
+    max_pending = 1000
+
+    def __init__(self, stream, *, max_pending=None):
+        self.stream = stream
+        self.name = stream_name(stream)
+        self.needs_status = getattr(stream, 'needs_status', False)
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=1,
+            thread_name_prefix=f'async-{self.name}',
+        )
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.num_failed = 0
+        self.error = None
+
+    def stats(self):
+        return getattr(self.stream, 'stats', lambda: '')()
+
+    async def call(self, fn, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
+
+    async def close(self):
+        try:
+            await self.call(self.stream.close)
+        finally:
+            self.executor.shutdown()
+        self.raise_failed()
+
+    async def rotate(self):
+        await self.call(self.stream.rotate)
+
+    async def flush(self):
+        await self.call(self.stream.flush)
+        self.raise_failed()
+
+    def raise_failed(self):
+        with self.lock:
+            error, num_failed = self.error, self.num_failed
+            self.error = None
+            self.num_failed = 0
+        if error is not None:
+            raise RuntimeError(
+                f'failed to write {num_failed} statuses') from error
+
+    async def on_status(self, status):
+        await self.submit(self.stream.on_status, status)
+
+    async def on_raw(self, raw, status=None):
+        await self.submit(self.stream.on_raw, raw, status)
+
+    def on_done(self, future):
+        if not future.cancelled() and future.exception() is not None:
+            log.error(
+                f'failed to write to {self.name}',
+                exc_info=future.exception(),
+            )
+            # remembered so the next flush does not report them as written
+            with self.lock:
+                self.num_failed += 1
+                if self.error is None:
+                    self.error = future.exception()
+
+    async def submit(self, fn, *args):
+        future = self.executor.submit(fn, *args)
+        future.add_done_callback(self.on_done)
+        self.pending.append(future)
+        while self.pending and self.pending[0].done():
+            self.pending.popleft()
+        if len(self.pending) > self.max_pending:
+            # errors were already recorded by on_done
+            await asyncio.wait([asyncio.wrap_future(self.pending.popleft())])
+
+class AsyncCompositeOutputStream:
+    """
+    Write every status to each of ``streams`` concurrently.
+
+    Like :class:`CompositeOutputStream` a failing stream never prevents the
+    remaining streams from receiving a status, the first error is raised
+    once all of them were called.
+
+    """
+    def __init__(self, streams=()):
+        self.streams = list(streams)
+        self.needs_status = any(
+            getattr(stream, 'needs_status', False)
+            for stream in self.streams
+        )
+
+    async def call_each(self, method, *args, streams=None):
+        if streams is None:
+            streams = self.streams
+        results = await asyncio.gather(
+            *(getattr(stream, method)(*args) for stream in streams),
+            return_exceptions=True,
+        )
+        error = None
+        for stream, result in zip(streams, results):
+            if isinstance(result, Exception):
+                log.error(
+                    f'failed to {method} {stream_name(stream)}',
+                    exc_info=result,
+                )
+                if error is None:
+                    error = result
+        if error is not None:
+            raise error
+
+    def stats(self):
+        stats = []
+        for stream in self.streams:
+            inner_stats = getattr(stream, 'stats', lambda: '')()
+            if inner_stats:
+                stats.append(inner_stats)
+        return ', '.join(stats)
+
+    async def close(self):
+        await self.call_each('close')
+
+    async def rotate(self):
+        await self.call_each('rotate')
+
+    async def flush(self):
+        await self.call_each('flush')
+
+    async def on_status(self, status):
+        await self.call_each('on_status', status)
+
+    async def on_raw(self, raw, status=None):
+        if status is None and self.needs_status:
+            status = json.loads(raw)
+        await self.call_each('on_raw', raw, status)
+
+class AsyncRoutingOutputStream(AsyncCompositeOutputStream):
+    """
+    The asyncio counterpart of :class:`RoutingOutputStream`.
+
+    """
+    def __init__(self, router, streams):
+        super().__init__(streams.values())
+        self.router = router
+        self.needs_status = True
+        self.destinations = dict(streams)
+
+    def stats(self):
+        stats = self.router.stats()
+        inner_stats = super().stats()
+        if inner_stats:
+            stats += f', {inner_stats}'
+        return stats
+
+    def streams_for(self, status):
+        sinks, routing_keys = self.router.destinations(status)
+        streams = [self.destinations[sink] for sink in sinks]
+        streams.extend(
+            self.destinations[f'rabbitmq:{key}'] for key in routing_keys)
+        return streams
+
+    async def on_status(self, status):
+        streams = self.streams_for(status)
+        if streams:
+            await self.call_each('on_status', status, streams=streams)
+
+    async def on_raw(self, raw, status=None):
+        if status is None:
+            status = json.loads(raw)
+        streams = self.streams_for(status)
+        if streams:
+            await self.call_each('on_raw', raw, status, streams=streams)
+
+class AsyncDedupeOutputStream(DedupeOutputStream):
+    """
+    The asyncio counterpart of :class:`DedupeOutputStream`.
+
+    """
+    async def close(self):
+        await self.written(self.stream.close)
+        if self.path is not None:
+            self.save()
+        log.info(f'suppressed {self.num_duplicates} duplicate statuses')
+
+    async def rotate(self):
+        await self.written(self.stream.rotate)
+        if self.path is not None:
+            self.save()
+
+    async def flush(self):
+        await self.written(self.stream.flush)
+
+    async def written(self, fn):
+        # statuses passed on while waiting are left pending for the next call
+        status_ids = set(self.pending)
+        try:
+            await fn()
+        except Exception:
+            self.forget_pending()
+            raise
+        self.remember_pending(status_ids)
+
+    async def on_status(self, status):
+        status_id = status.get('id')
+        if self.is_duplicate(status_id):
+            return
+        await self.stream.on_status(status)
+        self.add_pending(status_id)
+
+    async def on_raw(self, raw, status=None):
+        status_id = self.status_id(raw, status)
+        if self.is_duplicate(status_id):
+            return
+        await self.stream.on_raw(raw, status)
+        self.add_pending(status_id)
@@ -1,18 +1,104 @@
+import logging
+
+from .. import json
+from .queued import QueuedOutputStream
+
+log = logging.getLogger(__name__)
+
+def stream_name(stream):
+    return getattr(stream, 'name', type(stream).__name__)
+
 class CompositeOutputStream:
-    def __init__(self, streams=()):
-        self.streams = list(streams)
+    """
+    Write every status to each of ``streams``.
+
+    By default the streams are called one after the other on the calling
+    thread. When ``queue_size`` is set each stream instead gets its own
+    :class:`QueuedOutputStream` so a slow stream only holds up the others
+    once its queue is full, or never with the ``drop-oldest`` and
+    ``spill`` overflow policies.
+
+    A failing stream never prevents the remaining streams from receiving a
+    status, the first error is raised once all of them were called.
+
+    """
+    def __init__(
+        self,
+        streams=(),
+        *,
+        queue_size=None,
+        overflow='block',
+        spill_path_prefix=None,
+    ):
+        self.queue_size = queue_size
+        self.overflow = overflow
+        self.spill_path_prefix = spill_path_prefix
+        self.needs_status = False
+        self.streams = []
+        for stream in streams:
+            self.add_stream(stream)
 
     def add_stream(self, stream):
+        if getattr(stream, 'needs_status', False):
+            self.needs_status = True
+        if self.queue_size:
+            n = len(self.streams)
+            spill_path_prefix = None
+            if self.spill_path_prefix:
+                spill_path_prefix = f'{self.spill_path_prefix}.{n}'
+            stream = QueuedOutputStream(
+                stream,
+                max_size=self.queue_size,
+                overflow=self.overflow,
+                spill_path_prefix=spill_path_prefix,
+                name=f'output-stream-writer-{n}-{stream_name(stream)}',
+            )
         self.streams.append(stream)
 
-    def close(self):
+    def call_each(self, method, *args, streams=None):
+        error = None
+        for stream in self.streams if streams is None else streams:
+            try:
+                getattr(stream, method)(*args)
+            except Exception as ex:
+                log.exception(f'failed to {method} {stream_name(stream)}')
+                if error is None:
+                    error = ex
+        if error is not None:
+            raise error
+
+    def stats(self):
+        stats = []
         for stream in self.streams:
-            stream.close()
+            if self.queue_size:
+                stats.append(f'{stream_name(stream.stream)} {stream.stats()}')
+                stream = stream.stream
+            inner_stats = getattr(stream, 'stats', lambda: '')()
+            if inner_stats:
+                stats.append(inner_stats)
+        return ', '.join(stats)
+
+    def close(self):
+        # queued streams drain concurrently, closing them in turn only waits
+        # for the slowest one
+        self.call_each('close')
 
     def rotate(self):
-        for stream in self.streams:
-            stream.rotate()
+        # drain every stream before rotating so none of them rotate with
+        # statuses still buffered from before the rotation
+        if self.queue_size:
+            for stream in self.streams:
+                stream.drain()
+        self.call_each('rotate')
+
+    def flush(self):
+        self.call_each('flush')
 
     def on_status(self, status):
-        for stream in self.streams:
-            stream.on_status(status)
+        self.call_each('on_status', status)
+
+    def on_raw(self, raw, status=None):
+        # parse at most once on behalf of every stream that needs it
+        if status is None and self.needs_status:
+            status = json.loads(raw)
+        self.call_each('on_raw', raw, status)
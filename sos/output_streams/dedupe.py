@@ -0,0 +1,185 @@
+from datetime import datetime, timedelta
+import logging
+import os
+
+from .. import json, metrics, zstd
+
+log = logging.getLogger(__name__)
+
+duplicates_total = metrics.counter(
+    'sos_dedupe_duplicates_total',
+    'Statuses dropped because their id was already seen.',
+)
+
+class DedupeOutputStream:
+    """
+    Drop statuses whose id was already passed on to ``stream``.
+
+    Ids are remembered in two generations of sets. The current generation
+    becomes the previous one, and the previous one is forgotten, once it is
+    ``window`` old or holds half of ``max_size`` ids. An id is therefore
+    remembered for at least ``window`` unless the rate of statuses would
+    exceed ``max_size`` ids in memory.
+
+    An id passed on to ``stream`` is only pending until the next ``flush``,
+    ``rotate`` or ``close`` of ``stream`` succeeds, and is forgotten if that
+    fails, so statuses that are redelivered because they could not be
+    written are not dropped as duplicates. Callers that never flush have
+    their pending ids remembered once there are half of ``max_size``.
+
+    When ``path`` is set the remembered ids are saved there on rotate and
+    close, and loaded again on startup, so a restart or a replay of the
+    same statuses does not produce duplicates.
+
+    """
+    window = timedelta(hours=1)
+    max_size = 1000000
+
+    def __init__(self, stream, *, window=None, max_size=None, path=None):
+        self.stream = stream
+        if window is not None:
+            self.window = window
+        if max_size is not None:
+            self.max_size = max_size
+        self.path = path
+
+        self.pending = set()
+        self.current = set()
+        self.previous = set()
+        self.generation_started_at = datetime.utcnow()
+        self.num_duplicates = 0
+        self.num_duplicates_since_stats = 0
+
+        if path is not None and os.path.exists(path):
+            self.load()
+
+    def load(self):
+        with open(self.path, 'rb') as fp:
+            data = json.loads(fp.read())
+        started_at = datetime.utcfromtimestamp(data['generation_started_at'])
+        age = datetime.utcnow() - started_at
+        if age < self.window:
+            self.current = set(data['current'])
+            self.previous = set(data['previous'])
+            self.generation_started_at = started_at
+        elif age < 2 * self.window:
+            self.previous = set(data['current'])
+        log.info(
+            f'loaded {len(self.current) + len(self.previous)} status ids '
+            f'from path={self.path}'
+        )
+
+    def save(self):
+        data = json.dumps({
+            'generation_started_at': (
+                self.generation_started_at - datetime(1970, 1, 1)
+            ).total_seconds(),
+            'current': list(self.current),
+            'previous': list(self.previous),
+        })
+        tmp_path = f'{self.path}.tmp'
+        with open(tmp_path, 'wb') as fp:
+            fp.write(data)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        stats = (
+            f'duplicates={self.num_duplicates_since_stats} '
+            f'remembered={len(self.current) + len(self.previous)} '
+            f'pending={len(self.pending)}'
+        )
+        self.num_duplicates_since_stats = 0
+        inner_stats = getattr(self.stream, 'stats', lambda: '')()
+        if inner_stats:
+            stats += f', {inner_stats}'
+        return stats
+
+    def close(self):
+        self.written(self.stream.close)
+        if self.path is not None:
+            self.save()
+        log.info(f'suppressed {self.num_duplicates} duplicate statuses')
+
+    def rotate(self):
+        self.written(self.stream.rotate)
+        if self.path is not None:
+            self.save()
+
+    def flush(self):
+        self.written(self.stream.flush)
+
+    def written(self, fn):
+        status_ids = set(self.pending)
+        try:
+            fn()
+        except Exception:
+            self.forget_pending()
+            raise
+        self.remember_pending(status_ids)
+
+    # an id is only pending once the status was passed on, so a status that
+    # failed to be written is not dropped as a duplicate when it is retried
+    def on_status(self, status):
+        status_id = status.get('id')
+        if self.is_duplicate(status_id):
+            return
+        self.stream.on_status(status)
+        self.add_pending(status_id)
+
+    def on_raw(self, raw, status=None):
+        status_id = self.status_id(raw, status)
+        if self.is_duplicate(status_id):
+            return
+        self.stream.on_raw(raw, status)
+        self.add_pending(status_id)
+
+    def status_id(self, raw, status=None):
+        if status is not None:
+            return status.get('id')
+        # the status id is the first id in the object
+        m = zstd.status_id_re.search(raw)
+        return int(m.group(1)) if m else None
+
+    def is_duplicate(self, status_id):
+        if status_id is None:
+            return False
+        if (
+            status_id in self.pending
+            or status_id in self.current
+            or status_id in self.previous
+        ):
+            self.num_duplicates += 1
+            self.num_duplicates_since_stats += 1
+            duplicates_total.inc()
+            return True
+        return False
+
+    def add_pending(self, status_id):
+        if status_id is None:
+            return
+        self.pending.add(status_id)
+        if len(self.pending) >= self.max_size // 2:
+            self.remember_pending(set(self.pending))
+
+    def forget_pending(self):
+        if self.pending:
+            log.warning(
+                f'forgetting {len(self.pending)} status ids that failed '
+                'to be written'
+            )
+            self.pending = set()
+
+    def remember_pending(self, status_ids):
+        self.pending -= status_ids
+        now = datetime.utcnow()
+        for status_id in status_ids:
+            if (
+                now - self.generation_started_at >= self.window
+                or len(self.current) >= self.max_size // 2
+            ):
+                self.previous = self.current
+                self.current = set()
+                self.generation_started_at = now
+            self.current.add(status_id)
@@ -1,34 +1,165 @@
 from cached_property import cached_property
-from datetime import datetime
-import json
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
 import logging
+import multiprocessing
 import os
+import time
 
-from .. import zstd
+from .. import json, metrics, zstd
+from ..recompact import compact_file
 
 log = logging.getLogger(__name__)
 
+rotations_total = metrics.counter(
+    'sos_file_rotations_total',
+    'Output files closed, whether rotated or at exit.',
+)
+flush_seconds = metrics.histogram(
+    'sos_file_flush_seconds',
+    'Time spent flushing compressed data to output files.',
+)
+
 class FileOutputStream:
+    """
+    Write statuses to a zstd file at ``path_prefix``, opening a new file
+    after each rotation.
+
+    Compressed data is buffered by zstd until a flush. Besides explicit
+    calls to :meth:`flush`, the buffered data can be flushed every
+    ``flush_records`` records, every ``flush_interval``, or whenever a
+    frame is closed with ``flush_frames``. These policy flushes only end
+    the current zstd block so the compression ratio is mostly unaffected,
+    and only fsync the file when ``fsync`` is set. Everything written up to
+    the last flush can be salvaged from a truncated file with
+    ``zstd:recover``.
+
+    Files are also rotated automatically once they hold ``rotate_records``
+    records, reach ``rotate_bytes`` compressed bytes, or when the clock
+    passes the end of a ``rotate_interval`` bucket. Buckets are aligned to
+    the epoch and files are named after the start of their bucket. The
+    checks happen as statuses are written so an idle stream keeps its file
+    open until the next status.
+
+    When ``compact_level`` is set each closed file is recompressed at that
+    level by a background process and then replaces the original.
+
+    """
     path = None
     fp = None
+    index_fp = None
 
-    def __init__(self, path_prefix):
+    def __init__(
+        self,
+        path_prefix,
+        *,
+        frame_records=None,
+        frame_bytes=None,
+        dictionary=None,
+        flush_records=None,
+        flush_interval=None,
+        flush_frames=False,
+        fsync=False,
+        rotate_interval=None,
+        rotate_bytes=None,
+        rotate_records=None,
+        compact_level=None,
+    ):
         self.path_prefix = path_prefix
+        # a zstd dictionary trained on sample statuses, mostly useful for
+        # archives with small frames
+        self.dict_data = None
+        if dictionary:
+            self.dict_data = zstd.load_dictionary(dictionary)
+        # write an indexed, seekable archive when either limit is set
+        self.frame_records = frame_records
+        self.frame_bytes = frame_bytes
+
+        self.flush_records = flush_records
+        self.flush_interval = None
+        if flush_interval is not None:
+            self.flush_interval = flush_interval.total_seconds()
+        self.flush_frames = flush_frames
+        self.fsync = fsync
+
+        self.num_buffered_records = 0
+        self.num_buffered_bytes = 0
+        self.last_flush_at = time.monotonic()
+        self.last_num_frames = 0
+        self.num_flushes = 0
+        self.flush_seconds = 0
+        self.max_flush_seconds = 0
+
+        self.rotate_interval = None
+        if rotate_interval is not None:
+            self.rotate_interval = rotate_interval.total_seconds()
+        self.rotate_bytes = rotate_bytes
+        self.rotate_records = rotate_records
+        self.rotate_at = None
+        self.num_records = 0
+
+        self.dictionary = dictionary
+        self.compact_level = compact_level
+        self.compactor = None
+        self.compactions = set()
+
+    @property
+    def framed(self):
+        return bool(self.frame_records or self.frame_bytes)
+
+    def path_for(self, now):
+        return f'{self.path_prefix}.{now:%Y%m%d.%H%M%S}.zstd'
 
     @cached_property
     def writer(self):
         now = datetime.utcnow()
-        path = f'{self.path_prefix}.{now:%Y%m%d.%H%M%S}.zstd'
+        path = self.path_for(now)
+        if self.rotate_interval:
+            ts = now.replace(tzinfo=timezone.utc).timestamp()
+            bucket_start = ts - ts % self.rotate_interval
+            self.rotate_at = bucket_start + self.rotate_interval
+            bucket_path = self.path_for(datetime.utcfromtimestamp(bucket_start))
+            # a file rotated early for another reason keeps its own name
+            if not os.path.exists(bucket_path):
+                path = bucket_path
+        if os.path.exists(path) and (
+            self.compact_level is not None
+            or self.rotate_records
+            or self.rotate_bytes
+        ):
+            # never append to a file that was rotated within the same second
+            # as it may be being compacted
+            path = f'{self.path_prefix}.{now:%Y%m%d.%H%M%S.%f}.zstd'
         log.info(f'opening path={path}')
         root_path = os.path.dirname(path)
         if root_path:
             os.makedirs(root_path, exist_ok=True)
         self.fp = open(path, mode='ab')
         self.path = path
-        return zstd.writer(self.fp)
+        if self.framed:
+            self.index_fp = open(zstd.index_path_for(path), mode='ab')
+            kw = {'dict_data': self.dict_data}
+            if self.frame_records:
+                kw['frame_records'] = self.frame_records
+            if self.frame_bytes:
+                kw['frame_bytes'] = self.frame_bytes
+            return zstd.FramedWriter(self.fp, self.index_fp, **kw)
+        return zstd.writer(self.fp, dict_data=self.dict_data)
 
     def close(self):
+        self.close_file()
+        if self.compactor is not None:
+            if self.compactions:
+                log.info(
+                    f'waiting for {len(self.compactions)} files to be '
+                    'compacted'
+                )
+            self.compactor.shutdown(wait=True)
+            self.compactor = None
+
+    def close_file(self):
         if self.path is not None:
+            path = self.path
             log.info(f'closing path={self.path}')
             try:
                 self.writer.close()
@@ -38,13 +169,137 @@ class FileOutputStream:
                 self.fp.close()
             except Exception:
                 log.exception('failed to close file')
-            self.path = self.fp = None
+            if self.index_fp is not None:
+                try:
+                    self.index_fp.close()
+                except Exception:
+                    log.exception('failed to close index file')
+            self.path = self.fp = self.index_fp = None
+            self.num_buffered_records = self.num_buffered_bytes = 0
+            self.last_num_frames = 0
+            self.num_records = 0
+            self.rotate_at = None
             del self.__dict__['writer']
+            rotations_total.inc()
+            if self.compact_level is not None:
+                self.compact(path)
 
     def rotate(self):
-        self.close()
+        self.close_file()
+
+    def compact(self, path):
+        if self.compactor is None:
+            # spawn so the worker does not inherit the locks of our threads
+            self.compactor = ProcessPoolExecutor(
+                max_workers=1,
+                mp_context=multiprocessing.get_context('spawn'),
+                # a spawned process would otherwise pick its own backend
+                initializer=json.use,
+                initargs=(json.backend,),
+            )
+        frame_records = self.frame_records
+        if self.framed and not frame_records:
+            frame_records = 10000
+        future = self.compactor.submit(
+            compact_file,
+            path,
+            level=self.compact_level,
+            frame_records=frame_records,
+            dictionary=self.dictionary,
+        )
+        self.compactions.add(future)
+        future.add_done_callback(self.on_compacted)
+
+    def on_compacted(self, future):
+        self.compactions.discard(future)
+        try:
+            stats = future.result()
+        except Exception:
+            log.exception('failed to compact file')
+            return
+        log.info(
+            f'compacted path={stats["path"]} from {stats["bytes_in"]} to '
+            f'{stats["bytes_out"]} bytes in {stats["seconds"]:.2f} seconds'
+        )
+
+    def is_full(self):
+        if self.rotate_records and self.num_records >= self.rotate_records:
+            return True
+        if self.rotate_bytes and self.fp.tell() >= self.rotate_bytes:
+            return True
+        return False
+
+    def stats(self):
+        avg = self.flush_seconds / self.num_flushes if self.num_flushes else 0
+        stats = (
+            f'file buffered_bytes={self.num_buffered_bytes} '
+            f'flushes={self.num_flushes} '
+            f'flush_avg={avg * 1000:.1f}ms '
+            f'flush_max={self.max_flush_seconds * 1000:.1f}ms'
+        )
+        self.num_flushes = 0
+        self.flush_seconds = self.max_flush_seconds = 0
+        return stats
+
+    def flush(self):
+        if self.path is not None:
+            self.sync(end_frame=True, fsync=True)
+
+    def sync(self, *, end_frame=False, fsync=False):
+        start = time.monotonic()
+        if self.framed and not end_frame:
+            self.writer.flush_block()
+        else:
+            self.writer.flush()
+        self.fp.flush()
+        if fsync:
+            os.fsync(self.fp.fileno())
+            if self.index_fp is not None:
+                os.fsync(self.index_fp.fileno())
+
+        now = time.monotonic()
+        dt = now - start
+        self.num_flushes += 1
+        self.flush_seconds += dt
+        self.max_flush_seconds = max(self.max_flush_seconds, dt)
+        if metrics.enabled:
+            flush_seconds.observe(dt)
+        self.num_buffered_records = self.num_buffered_bytes = 0
+        self.last_flush_at = now
 
     def on_status(self, status):
-        write = self.writer.write
-        write(json.dumps(status).encode('utf8'))
-        write(b'\n')
+        self.on_raw(json.dumps(status), status)
+
+    def on_raw(self, raw, status=None):
+        # start the next bucket's file before writing into it
+        if self.rotate_at is not None and time.time() >= self.rotate_at:
+            self.rotate()
+
+        if self.framed:
+            self.writer.write_record(raw, status)
+        else:
+            write = self.writer.write
+            write(raw)
+            write(b'\n')
+        self.num_buffered_records += 1
+        self.num_buffered_bytes += len(raw) + 1
+        self.num_records += 1
+
+        if self.is_full():
+            self.rotate()
+            return
+
+        if self.flush_frames and self.framed:
+            # the frame was already flushed by zstd when it was closed
+            if self.writer.num_frames != self.last_num_frames:
+                self.last_num_frames = self.writer.num_frames
+                self.sync(end_frame=True, fsync=self.fsync)
+                return
+        if (
+            self.flush_records
+            and self.num_buffered_records >= self.flush_records
+        ) or (
+            self.flush_interval is not None
+            and time.monotonic() - self.last_flush_at >= self.flush_interval
+        ):
+            self.sync(fsync=self.fsync)
@@ -1,38 +1,134 @@
+from datetime import datetime, timedelta
 from google.cloud import firestore
-import json
+import logging
+
+from .. import json
+from ..settings import asduration
+from ..status import status_fields
+
+log = logging.getLogger(__name__)
 
 class GCPFirestoreOutputStream:
-    def __init__(self, *, collection, client=None):
+    needs_status = True
+
+    # firestore rejects batches with more than 500 writes
+    batch_size = 500
+    batch_latency = timedelta(seconds=1)
+
+    def __init__(
+        self,
+        *,
+        collection,
+        client=None,
+        batch_size=None,
+        batch_latency=None,
+    ):
         if client is None:
             client = firestore.Client()
+        self.client = client
         self.collection = client.collection(collection)
 
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if batch_latency is not None:
+            self.batch_latency = batch_latency
+
+        self.pending = []
+        self.pending_since = None
+
     @classmethod
     def from_config(cls, profile, collection):
-        return cls(collection=collection)
+        settings = profile.get('gcp_firestore', {})
+        return cls(
+            collection=collection,
+            batch_size=settings.get('batch_size'),
+            batch_latency=asduration(
+                settings.get('batch_latency'), default=None),
+        )
 
     def close(self):
-        pass
+        self.flush()
 
     def rotate(self):
-        pass
+        self.flush()
+
+    def commit(self, docs):
+        batch = self.client.batch()
+        for doc, data in docs:
+            batch.set(doc, data)
+        batch.commit()
+
+    def take_pending(self):
+        docs = self.pending
+        self.pending = []
+        self.pending_since = None
+        return docs
+
+    def keep_pending(self, docs):
+        # keep them buffered for the next flush instead of dropping them
+        self.pending[:0] = docs
+        if self.pending_since is None:
+            self.pending_since = datetime.utcnow()
+
+    def flush(self):
+        docs = self.take_pending()
+        if docs:
+            failed = self.write(docs)
+            if failed:
+                self.keep_pending(failed)
+                raise RuntimeError(f'failed to write {len(failed)} documents')
+
+    def write(self, docs):
+        """
+        Write ``docs`` and return those that could not be written.
+
+        """
+        # batches are atomic so a failure means none of the documents were
+        # written, retry once before isolating the documents that fail
+        for attempt in range(2):
+            try:
+                self.commit(docs)
+                return []
+            except Exception:
+                log.exception(f'failed to commit batch of {len(docs)}')
+
+        failed = []
+        for doc, data in docs:
+            try:
+                doc.set(data)
+            except Exception:
+                log.exception(f'failed to write document={doc.id}')
+                failed.append((doc, data))
+        return failed
 
     def on_status(self, status):
-        status_id = status['id']
-        user_id = status['user']['id']
-        user_sn = status['user']['screen_name']
-        doc_name = f'{status_id}-{user_id}-{user_sn}'
+        self.add_document(status, json.dumps(status).decode('utf8'))
+
+    def on_raw(self, raw, status=None):
+        if status is None:
+            status = json.loads(raw)
+        self.add_document(status, raw.decode('utf8'))
+
+    def add_document(self, status, raw_json):
+        if self.add_pending(status, raw_json):
+            self.flush()
+
+    def add_pending(self, status, raw_json):
+        """
+        Buffer a document and return whether the batch should be committed.
+
+        """
+        data = status_fields(status)
+        data['json'] = raw_json
+        doc_name = f'{data["id"]}-{data["user_id"]}-{data["user_sn"]}'
         doc = self.collection.document(doc_name)
-        doc.set({
-            'id': status_id,
-            'user_id': user_id,
-            'user_sn': user_sn,
-            'created_at': status.get('created_at'),
-            'text': status.get('text'),
-            'in_reply_to_status_id': status.get('in_reply_to_status_id'),
-            'in_reply_to_user_id': status.get('in_reply_to_user_id'),
-            'in_reply_to_screen_name': status.get('in_reply_to_screen_name'),
-            'quoted_status_id': status.get('quoted_status_id'),
-            'lang': status.get('lang'),
-            'json': json.dumps(status),
-        })
+
+        now = datetime.utcnow()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending.append((doc, data))
+
+        return (
+            len(self.pending) >= self.batch_size
+            or now - self.pending_since >= self.batch_latency
+        )
@@ -1,38 +1,249 @@
+from concurrent.futures import ThreadPoolExecutor, wait
+from google.api_core.exceptions import NotFound
 from google.cloud import storage
 import httpx
+import io
+import logging
 import posixpath
+import threading
+from urllib.parse import urlparse
 
-from ..media import media_info_from_status
+from .. import json
+from ..media import MediaCache, media_info_from_status
+
+log = logging.getLogger(__name__)
+
+# adapts a streaming httpx response into a readable file object
+class ResponseReader(io.RawIOBase):
+    def __init__(self, response, *, chunk_size):
+        self.chunks = response.iter_bytes(chunk_size)
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+def options_from_config(profile, bucket):
+    parts = bucket.split(':', 1)
+    prefix = ''
+    if len(parts) > 1:
+        bucket, prefix = parts
+
+    settings = profile.get('gcp_image_storage', {})
+    media_cache = MediaCache(
+        max_size=settings.get('dedupe_cache_size', 100000),
+        path=settings.get('dedupe_index_path'),
+    )
+    return dict(
+        bucket=bucket,
+        prefix=prefix,
+        concurrency=settings.get('concurrency'),
+        per_host_concurrency=settings.get('per_host_concurrency'),
+        max_pending=settings.get('max_pending'),
+        media_cache=media_cache,
+        dedupe_mode=settings.get('dedupe_mode', 'skip'),
+    )
 
 class GCPImageStorageOutputStream:
-    def __init__(self, *, bucket, prefix, client=None):
+    concurrency = 8
+    per_host_concurrency = 4
+    max_pending = 64
+    # must be a multiple of 256KB, larger or unknown sized media is uploaded
+    # in chunks of this size so it never has to be held in memory at once
+    chunk_size = 8 * 1024 * 1024
+
+    def __init__(
+        self,
+        *,
+        bucket,
+        prefix,
+        client=None,
+        http_client=None,
+        concurrency=None,
+        per_host_concurrency=None,
+        max_pending=None,
+        media_cache=None,
+        dedupe_mode='skip',
+    ):
         if client is None:
             client = storage.Client()
         self.bucket = client.bucket(bucket)
         self.prefix = prefix
 
+        if concurrency is not None:
+            self.concurrency = concurrency
+        if per_host_concurrency is not None:
+            self.per_host_concurrency = per_host_concurrency
+        if max_pending is not None:
+            self.max_pending = max_pending
+
+        if http_client is None:
+            http_client = httpx.Client(
+                limits=httpx.Limits(
+                    max_connections=self.concurrency,
+                    max_keepalive_connections=self.concurrency,
+                ),
+            )
+        self.http_client = http_client
+
+        self.executor = ThreadPoolExecutor(
+            max_workers=self.concurrency,
+            thread_name_prefix='gcp-image-storage',
+        )
+        self.pending = set()
+        self.pending_lock = threading.Lock()
+        self.num_failed = 0
+        self.error = None
+        self.slots = threading.BoundedSemaphore(self.max_pending)
+        self.host_slots = {}
+
+        if media_cache is None:
+            media_cache = MediaCache()
+        self.media_cache = media_cache
+        # either "skip" media that was already stored or "copy" it to the
+        # new name within the bucket without downloading it again
+        self.dedupe_mode = dedupe_mode
+
     @classmethod
     def from_config(cls, profile, bucket):
-        parts = bucket.split(':', 1)
-        prefix = ''
-        if len(parts) > 1:
-            bucket, prefix = parts
-
-        return cls(bucket=bucket, prefix=prefix)
+        return cls(**options_from_config(profile, bucket))
 
     def close(self):
-        pass
+        try:
+            self.flush()
+        finally:
+            self.executor.shutdown()
+            self.http_client.close()
+            log.info(
+                f'media cache hits={self.media_cache.hits} '
+                f'misses={self.media_cache.misses}'
+            )
+            self.media_cache.close()
 
     def rotate(self):
         pass
 
+    def flush(self):
+        with self.pending_lock:
+            pending = list(self.pending)
+        wait(pending)
+        self.media_cache.flush()
+
+        with self.pending_lock:
+            error, num_failed = self.error, self.num_failed
+            self.error = None
+            self.num_failed = 0
+        if error is not None:
+            raise RuntimeError(f'failed to store {num_failed} media') from error
+
+    def on_raw(self, raw, status=None):
+        if status is None:
+            # avoid parsing statuses that cannot contain any media
+            if b'"media"' not in raw:
+                return
+            status = json.loads(raw)
+        self.on_status(status)
+
     def on_status(self, status):
         for info in media_info_from_status(status):
-            r = httpx.get(info['url'])
-            data = r.content
-            content_type = info['content_type']
-            blob = self.bucket.blob(posixpath.join(self.prefix, info['name']))
-            blob.upload_from_string(
-                data,
-                content_type=content_type,
+            source_name = self.media_cache.get(info)
+            if source_name is not None and self.dedupe_mode == 'skip':
+                log.debug(f'skipping duplicate media={info["name"]}')
+                continue
+
+            # remember it up front so that later statuses in flight at the
+            # same time do not fetch it again, it is only persisted once it
+            # was stored
+            if source_name is None:
+                self.media_cache.add(info)
+
+            # block the consumer once too many downloads are queued
+            self.slots.acquire()
+            try:
+                future = self.executor.submit(self.store, info, source_name)
+            except Exception:
+                self.slots.release()
+                raise
+            with self.pending_lock:
+                self.pending.add(future)
+            future.add_done_callback(self.on_stored)
+
+    def on_stored(self, future):
+        with self.pending_lock:
+            self.pending.discard(future)
+        self.slots.release()
+
+    def host_slot(self, url):
+        host = urlparse(url).netloc
+        with self.pending_lock:
+            slot = self.host_slots.get(host)
+            if slot is None:
+                slot = threading.BoundedSemaphore(self.per_host_concurrency)
+                self.host_slots[host] = slot
+        return slot
+
+    def store(self, info, source_name=None):
+        try:
+            if source_name is not None:
+                try:
+                    self.copy(info, source_name)
+                    return
+                except NotFound:
+                    log.debug(
+                        f'media={source_name} is missing, downloading '
+                        f'media={info["name"]} again'
+                    )
+            with self.host_slot(info['url']):
+                self.upload(info)
+            self.media_cache.stored(info)
+        except Exception as ex:
+            if source_name is None:
+                self.media_cache.discard(info)
+            log.exception(f'failed to store media={info["name"]}')
+            # raised from the next flush so the statuses are not acked
+            with self.pending_lock:
+                self.num_failed += 1
+                if self.error is None:
+                    self.error = ex
+
+    def copy(self, info, source_name):
+        source = self.bucket.blob(posixpath.join(self.prefix, source_name))
+        self.bucket.copy_blob(
+            source,
+            self.bucket,
+            posixpath.join(self.prefix, info['name']),
+        )
+
+    def upload(self, info):
+        blob = self.bucket.blob(
+            posixpath.join(self.prefix, info['name']),
+            chunk_size=self.chunk_size,
+        )
+        with self.http_client.stream('GET', info['url']) as r:
+            # do not store an error page as the media
+            r.raise_for_status()
+            size = None
+            # the length is of the encoded body which is not what we upload
+            if 'content-encoding' not in r.headers:
+                size = r.headers.get('content-length')
+                if size is not None:
+                    size = int(size)
+            fp = io.BufferedReader(
+                ResponseReader(r, chunk_size=64 * 1024),
+                buffer_size=64 * 1024,
+            )
+            blob.upload_from_file(
+                fp,
+                size=size,
+                content_type=info['content_type'],
             )
@@ -0,0 +1,78 @@
+import time
+
+from .. import metrics
+
+class InstrumentedOutputStream:
+    """
+    Record the latency, bytes and errors of every call into ``stream``.
+
+    Only installed by :func:`output_stream_from_config` when metrics are
+    enabled so uninstrumented streams pay nothing.
+
+    """
+    def __init__(self, stream, name=None):
+        self.stream = stream
+        self.name = name or type(stream).__name__
+        self.needs_status = getattr(stream, 'needs_status', False)
+
+        labels = {'sink': self.name}
+        self.write_seconds = metrics.histogram(
+            'sos_sink_write_seconds',
+            'Time spent handing a status to a sink.',
+            **labels,
+        )
+        self.flush_seconds = metrics.histogram(
+            'sos_sink_flush_seconds',
+            'Time spent flushing a sink.',
+            **labels,
+        )
+        self.bytes_total = metrics.counter(
+            'sos_sink_bytes_total',
+            'Bytes of raw statuses handed to a sink.',
+            **labels,
+        )
+        self.errors_total = metrics.counter(
+            'sos_sink_errors_total',
+            'Calls into a sink that raised an exception.',
+            **labels,
+        )
+
+    def stats(self):
+        return getattr(self.stream, 'stats', lambda: '')()
+
+    def close(self):
+        self.stream.close()
+
+    def rotate(self):
+        self.stream.rotate()
+
+    def flush(self):
+        start = time.perf_counter()
+        try:
+            self.stream.flush()
+        except Exception:
+            self.errors_total.inc()
+            raise
+        finally:
+            self.flush_seconds.observe(time.perf_counter() - start)
+
+    def on_status(self, status):
+        start = time.perf_counter()
+        try:
+            self.stream.on_status(status)
+        except Exception:
+            self.errors_total.inc()
+            raise
+        finally:
+            self.write_seconds.observe(time.perf_counter() - start)
+
+    def on_raw(self, raw, status=None):
+        self.bytes_total.inc(len(raw))
+        start = time.perf_counter()
+        try:
+            self.stream.on_raw(raw, status)
+        except Exception:
+            self.errors_total.inc()
+            raise
+        finally:
+            self.write_seconds.observe(time.perf_counter() - start)
@@ -0,0 +1,263 @@
+from collections import deque
+from datetime import datetime
+import logging
+import os
+import threading
+import time
+
+from .. import json, metrics, zstd
+
+log = logging.getLogger(__name__)
+
+class QueuedOutputStream:
+    """
+    Hand statuses off to another output stream on a dedicated thread.
+
+    At most ``max_size`` statuses are buffered. When the buffer is full the
+    ``overflow`` policy decides what happens to a new status:
+
+    - ``block`` waits for the writer thread to make room.
+    - ``drop-oldest`` discards the oldest buffered status.
+    - ``spill`` appends it to a zstd file at ``spill_path_prefix`` which is
+      replayed into the stream once the buffer drains. Statuses are not
+      delivered in order while spilling.
+
+    Statuses the stream failed to write are logged and counted, ``flush``
+    then raises so callers do not treat them as written.
+
+    """
+    overflow_policies = ('block', 'drop-oldest', 'spill')
+
+    def __init__(
+        self,
+        stream,
+        *,
+        max_size,
+        overflow='block',
+        spill_path_prefix=None,
+        name='output-stream-writer',
+    ):
+        if overflow not in self.overflow_policies:
+            raise ValueError(f'unknown overflow policy={overflow}')
+        if overflow == 'spill' and not spill_path_prefix:
+            raise ValueError('spill_path_prefix is required to spill')
+
+        self.stream = stream
+        self.max_size = max_size
+        self.overflow = overflow
+        self.spill_path_prefix = spill_path_prefix
+
+        self.queue = deque()
+        self.cond = threading.Condition()
+        self.busy = False
+        self.stopping = False
+        self.rotate_requested = False
+        self.spill_path = None
+        self.spill_fp = None
+        self.spill_writer = None
+
+        self.high_water = 0
+        self.num_dropped = 0
+        self.num_spilled = 0
+        self.num_written = 0
+        self.num_failed = 0
+        self.error = None
+
+        if metrics.enabled:
+            metrics.gauge(
+                'sos_queue_depth',
+                'Statuses buffered for an output stream.',
+                fn=lambda: len(self.queue),
+                queue=name,
+            )
+            metrics.gauge(
+                'sos_queue_lag_seconds',
+                'Age of the oldest status buffered for an output stream.',
+                fn=self.lag,
+                queue=name,
+            )
+            self.dropped_total = metrics.counter(
+                'sos_queue_dropped_total',
+                'Statuses dropped because a queue was full.',
+                queue=name,
+            )
+
+        self.thread = threading.Thread(
+            target=self.run,
+            name=name,
+            daemon=True,
+        )
+        self.thread.start()
+
+    def lag(self):
+        # how long the oldest buffered status has been waiting
+        with self.cond:
+            if not self.queue:
+                return 0
+            return time.monotonic() - self.queue[0][2]
+
+    def stats(self):
+        lag = self.lag()
+        with self.cond:
+            stats = (
+                f'queue depth={len(self.queue)} high_water={self.high_water} '
+                f'dropped={self.num_dropped} spilled={self.num_spilled} '
+                f'written={self.num_written} lag={lag:.2f}s'
+            )
+            self.high_water = len(self.queue)
+            self.num_written = 0
+            return stats
+
+    def close(self):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        self.thread.join()
+        self.stream.close()
+
+    def rotate(self):
+        with self.cond:
+            self.rotate_requested = True
+            self.cond.notify_all()
+
+    def wait_until_idle(self):
+        while (
+            self.queue
+            or self.busy
+            or self.spill_path is not None
+            or self.rotate_requested
+        ):
+            self.cond.wait()
+
+    def drain(self):
+        with self.cond:
+            self.wait_until_idle()
+
+    def flush(self):
+        with self.cond:
+            self.wait_until_idle()
+            # the writer thread is idle and cannot pick up more work while
+            # the lock is held
+            self.stream.flush()
+
+            if self.error is not None:
+                error, num_failed = self.error, self.num_failed
+                self.error = None
+                self.num_failed = 0
+                raise RuntimeError(
+                    f'failed to write {num_failed} statuses') from error
+
+    def on_status(self, status):
+        self.on_raw(None, status)
+
+    def on_raw(self, raw, status=None):
+        item = (raw, status, time.monotonic())
+        with self.cond:
+            if len(self.queue) >= self.max_size:
+                if self.overflow == 'block':
+                    while len(self.queue) >= self.max_size:
+                        self.cond.wait()
+                elif self.overflow == 'drop-oldest':
+                    self.queue.popleft()
+                    self.num_dropped += 1
+                    if metrics.enabled:
+                        self.dropped_total.inc()
+                else:
+                    self.spill(item)
+                    self.cond.notify_all()
+                    return
+
+            self.queue.append(item)
+            if len(self.queue) > self.high_water:
+                self.high_water = len(self.queue)
+            self.cond.notify_all()
+
+    def spill(self, item):
+        if self.spill_writer is None:
+            now = datetime.utcnow()
+            path = f'{self.spill_path_prefix}.{now:%Y%m%d.%H%M%S.%f}.zstd'
+            log.info(f'spilling statuses to path={path}')
+            root_path = os.path.dirname(path)
+            if root_path:
+                os.makedirs(root_path, exist_ok=True)
+            self.spill_fp = open(path, mode='wb')
+            self.spill_writer = zstd.writer(self.spill_fp)
+            self.spill_path = path
+        raw, status, _ = item
+        if raw is None:
+            raw = json.dumps(status)
+        self.spill_writer.write(raw)
+        self.spill_writer.write(b'\n')
+        self.num_spilled += 1
+
+    def take_spill(self):
+        path = self.spill_path
+        self.spill_writer.close()
+        self.spill_fp.close()
+        self.spill_path = self.spill_fp = self.spill_writer = None
+        return path
+
+    def replay_spill(self, path):
+        log.info(f'replaying spilled statuses from path={path}')
+        with open(path, 'rb') as fp:
+            for line in zstd.iter_lines(fp):
+                self.write((line.encode('utf8'), None, None))
+        os.unlink(path)
+
+    def write(self, item):
+        raw, status, _ = item
+        try:
+            if raw is None:
+                self.stream.on_status(status)
+            else:
+                self.stream.on_raw(raw, status)
+        except Exception as ex:
+            log.exception('received exception writing status to output stream')
+            # remembered so the next flush does not report them as written
+            with self.cond:
+                self.num_failed += 1
+                if self.error is None:
+                    self.error = ex
+            return
+        with self.cond:
+            self.num_written += 1
+
+    def run(self):
+        while True:
+            item = spill_path = None
+            rotate = False
+            with self.cond:
+                while not (
+                    self.queue
+                    or self.spill_path is not None
+                    or self.rotate_requested
+                    or self.stopping
+                ):
+                    self.cond.wait()
+
+                if self.rotate_requested:
+                    self.rotate_requested = False
+                    rotate = True
+                elif self.queue:
+                    item = self.queue.popleft()
+                elif self.spill_path is not None:
+                    spill_path = self.take_spill()
+                else:
+                    self.cond.notify_all()
+                    return
+                self.busy = True
+                self.cond.notify_all()
+
+            try:
+                if rotate:
+                    self.stream.rotate()
+                elif spill_path is not None:
+                    self.replay_spill(spill_path)
+                else:
+                    self.write(item)
+            except Exception:
+                log.exception('output stream writer failed')
+            finally:
+                with self.cond:
+                    self.busy = False
+                    self.cond.notify_all()
@@ -1,71 +1,404 @@
 from cached_property import cached_property
-import json
+from contextlib import contextmanager
+from datetime import datetime, timedelta
 import logging
 import pika
+import threading
+import time
+
+from .. import json, metrics
+from ..settings import asduration
 
 log = logging.getLogger(__name__)
 
+publish_retries_total = metrics.counter(
+    'sos_rabbitmq_publish_retries_total',
+    'Messages published again after a failure or missing confirm.',
+)
+
+class ConfirmTimeoutError(pika.exceptions.AMQPError):
+    pass
+
+class UnconfirmedDeliveryError(Exception):
+    pass
+
 class RabbitMqOutputStream:
-    def __init__(self, parameters, exchange, routing_key):
+    """
+    Publish statuses to a rabbitmq exchange.
+
+    Every status is published on its own unless ``batch_size`` is above 1.
+    Batches are flushed once they hold ``batch_size`` statuses or
+    ``batch_bytes`` bytes, or are ``batch_latency`` old, which a background
+    thread checks for when no further statuses arrive until the stream is
+    closed. A batch is published back to back with publisher confirms and
+    costs a single round-trip.
+
+    """
+    batch_size = 1
+    batch_bytes = 1024 * 1024
+    batch_latency = timedelta(milliseconds=250)
+    confirm_timeout = timedelta(seconds=30)
+
+    properties = pika.BasicProperties(
+        content_type='application/json',
+    )
+
+    def __init__(
+        self,
+        parameters,
+        exchange,
+        routing_key,
+        *,
+        batch_size=None,
+        batch_bytes=None,
+        batch_latency=None,
+        confirm_timeout=None,
+    ):
         self.parameters = parameters
         self.exchange = exchange or ''
         self.routing_key = routing_key
         self.connection = None
+        self.connection_error = None
+
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if batch_bytes is not None:
+            self.batch_bytes = batch_bytes
+        if batch_latency is not None:
+            self.batch_latency = batch_latency
+        if confirm_timeout is not None:
+            self.confirm_timeout = confirm_timeout
+
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+        self.unconfirmed = {}
+        self.rejected = []
+        self.next_delivery_tag = 1
+
+        # the background flusher and the caller take turns on the
+        # connection, busy is set while it is in use
+        self.lock = threading.RLock()
+        self.busy = False
+        self.rotate_requested = False
+        self.flusher = None
+        self.flusher_stopped = None
 
     @classmethod
-    def from_config(cls, profile, exchange, routing_key):
+    def from_config(cls, profile, exchange, routing_key, *, batch_size=None):
+        if batch_size is None:
+            batch_size = profile.get('batch_size')
         return cls(
             pika.URLParameters(profile['url']),
             exchange,
             routing_key,
+            batch_size=batch_size,
+            batch_bytes=profile.get('batch_bytes'),
+            batch_latency=asduration(profile.get('batch_latency'), default=None),
+            confirm_timeout=asduration(
+                profile.get('confirm_timeout'), default=None),
+        )
+
+    @property
+    def batching(self):
+        return self.batch_size > 1
+
+    def connect(self):
+        return pika.BlockingConnection(self.parameters)
+
+    def connect_select(self, on_open):
+        return pika.SelectConnection(
+            self.parameters,
+            on_open_callback=on_open,
+            on_open_error_callback=self.on_connection_closed,
+            on_close_callback=self.on_connection_closed,
         )
 
     @cached_property
     def channel(self):
         log.info(f'opening new rabbitmq connection={self.parameters}')
-        connection = pika.BlockingConnection(self.parameters)
+        if self.batching:
+            return self.open_confirmed_channel()
+        connection = self.connect()
         connection.add_on_connection_blocked_callback(self.on_connection_blocked)
         connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
-        channel = connection.channel()
         self.connection = connection
+        return connection.channel()
+
+    def open_confirmed_channel(self):
+        # BlockingChannel.confirm_delivery waits for a confirm after every
+        # single publish so batches are published on a SelectConnection
+        # instead, whose ioloop is only run while waiting on the broker
+        opened = []
+        self.connection_error = None
+        self.connection = self.connect_select(self.resume_with(opened))
+        self.wait_until(lambda: len(opened) == 1)
+        self.connection.add_on_connection_blocked_callback(self.on_connection_blocked)
+        self.connection.add_on_connection_unblocked_callback(self.on_connection_unblocked)
+
+        self.connection.channel(on_open_callback=self.resume_with(opened))
+        self.wait_until(lambda: len(opened) == 2)
+        channel = opened[1]
+        channel.add_on_close_callback(self.on_channel_closed)
+
+        self.unconfirmed = {}
+        self.rejected = []
+        self.next_delivery_tag = 1
+        channel.confirm_delivery(
+            ack_nack_callback=self.on_delivery_confirmation,
+            callback=self.resume_with(opened),
+        )
+        self.wait_until(lambda: len(opened) == 3)
         return channel
 
+    def resume_with(self, results):
+        def callback(result):
+            results.append(result)
+            self.connection.ioloop.stop()
+        return callback
+
+    def wait_until(self, predicate):
+        """
+        Run the ioloop until ``predicate`` holds.
+
+        Every callback stops the ioloop so that ``predicate`` is checked
+        again.
+
+        """
+        ioloop = self.connection.ioloop
+        deadline = time.monotonic() + self.confirm_timeout.total_seconds()
+        while not predicate():
+            error = self.connection_error
+            if error is not None:
+                if not isinstance(error, pika.exceptions.AMQPError):
+                    raise pika.exceptions.AMQPConnectionError(error)
+                raise error
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise ConfirmTimeoutError(
+                    f'timed out waiting for {len(self.unconfirmed)} confirms')
+            timeout = ioloop.call_later(remaining, ioloop.stop)
+            try:
+                ioloop.start()
+            finally:
+                ioloop.remove_timeout(timeout)
+
     def on_connection_blocked(self, connection, method):
         log.warning('rabbit connection blocked')
 
     def on_connection_unblocked(self, connection, method):
         log.info('rabbit connection unblocked')
 
-    def close(self):
-        if self.connection is not None:
+    def on_connection_closed(self, connection, error):
+        self.connection_error = error
+        connection.ioloop.stop()
+
+    def on_channel_closed(self, channel, error):
+        self.connection_error = error
+        self.connection.ioloop.stop()
+
+    def on_delivery_confirmation(self, frame):
+        method = frame.method
+        if method.multiple:
+            tags = [t for t in self.unconfirmed if t <= method.delivery_tag]
+        else:
+            tags = [method.delivery_tag]
+        acked = isinstance(method, pika.spec.Basic.Ack)
+        for tag in tags:
+            body = self.unconfirmed.pop(tag, None)
+            if body is not None and not acked:
+                self.rejected.append(body)
+        self.connection.ioloop.stop()
+
+    def disconnect(self):
+        connection = self.connection
+        if connection is None:
+            return
+        if not self.batching:
             try:
                 self.channel.close()
             except Exception:
                 log.exception('failed to close rabbitmq channel')
+        try:
+            if not connection.is_closed:
+                connection.close()
+                if self.batching:
+                    self.wait_until(lambda: connection.is_closed)
+        except Exception:
+            log.exception('failed to close rabbitmq connection')
+        self.connection = None
+        self.__dict__.pop('channel', None)
+
+    def close(self):
+        self.stop_flusher()
+        self.flush_and_disconnect()
+
+    def flush_and_disconnect(self):
+        # raise rather than drop what could not be published
+        with self.lock:
             try:
-                self.connection.close()
-            except Exception:
-                log.exception('failed to close rabbitmq connection')
-            self.connection = None
-            del self.__dict__['channel']
+                self.flush()
+            finally:
+                self.disconnect()
 
     def rotate(self):
-        self.close()
+        if self.busy:
+            # a SIGHUP interrupted a publish on this thread or the flusher
+            # is publishing, close the connection once that is done instead
+            # of underneath it
+            self.rotate_requested = True
+            return
+        self.flush_and_disconnect()
+
+    @contextmanager
+    def using_connection(self):
+        with self.lock:
+            self.busy = True
+            try:
+                yield
+            finally:
+                self.busy = False
+                if self.rotate_requested:
+                    self.rotate_requested = False
+                    self.disconnect()
 
-    def on_status(self, status, *, retry=True):
+    def publish_batch(self, bodies):
         try:
-            self.channel.basic_publish(
+            channel = self.channel
+        except pika.exceptions.AMQPError:
+            # none of them were published
+            self.rejected = list(bodies)
+            self.unconfirmed = {}
+            raise
+        self.rejected = []
+        self.unconfirmed = {}
+        # register every body up front so that a failure part way through
+        # the batch still knows which messages were never confirmed
+        for body in bodies:
+            self.unconfirmed[self.next_delivery_tag] = body
+            self.next_delivery_tag += 1
+        for body in bodies:
+            channel.basic_publish(
                 self.exchange,
                 self.routing_key,
-                json.dumps(status).encode('utf8'),
-                properties=pika.BasicProperties(
-                    content_type='application/json',
-                ),
+                body,
+                properties=self.properties,
             )
+        self.wait_until(lambda: not self.unconfirmed)
+
+    def take_unconfirmed(self):
+        bodies = self.rejected + list(self.unconfirmed.values())
+        self.rejected = []
+        self.unconfirmed = {}
+        return bodies
+
+    def flush(self):
+        with self.using_connection():
+            self.publish_pending()
+
+    def publish_pending(self):
+        bodies = self.pending
+        self.pending = []
+        self.pending_bytes = 0
+        self.pending_since = None
+
+        # do a single retry of whatever the broker did not confirm
+        for attempt in range(2):
+            if not bodies:
+                return
+            try:
+                self.publish_batch(bodies)
+            except pika.exceptions.AMQPError:
+                log.exception(f'failed to publish batch of {len(bodies)}')
+                self.disconnect()
+            bodies = self.take_unconfirmed()
+            if bodies:
+                log.warning(f'{len(bodies)} messages were not confirmed')
+                publish_retries_total.inc(len(bodies))
+
+        if bodies:
+            # keep them buffered for the next flush instead of dropping them
+            self.pending[:0] = bodies
+            self.pending_bytes += sum(len(body) for body in bodies)
+            if self.pending_since is None:
+                self.pending_since = datetime.utcnow()
+            raise UnconfirmedDeliveryError(
+                f'broker failed to confirm {len(bodies)} messages')
+
+    def start_flusher(self):
+        self.flusher_stopped = threading.Event()
+        self.flusher = threading.Thread(
+            target=self.run_flusher,
+            args=(self.flusher_stopped,),
+            name=f'rabbitmq-flusher-{self.routing_key}',
+            daemon=True,
+        )
+        self.flusher.start()
+
+    def stop_flusher(self):
+        if self.flusher is None:
+            return
+        self.flusher_stopped.set()
+        self.flusher.join()
+        self.flusher = None
+
+    def run_flusher(self, stopped):
+        # flush batches that reached batch_latency while no further statuses
+        # arrived to trigger it
+        delay = self.batch_latency
+        while not stopped.wait(delay.total_seconds()):
+            delay = self.batch_latency
+            with self.lock:
+                if self.pending_since is not None:
+                    age = datetime.utcnow() - self.pending_since
+                    if age < self.batch_latency:
+                        delay = self.batch_latency - age
+                    else:
+                        try:
+                            self.flush()
+                        except Exception:
+                            log.exception(
+                                f'failed to flush {len(self.pending)} '
+                                'pending messages'
+                            )
+
+    def on_status(self, status):
+        self.on_raw(json.dumps(status), status)
+
+    def on_raw(self, raw, status=None, *, retry=True):
+        if self.batching:
+            with self.lock:
+                self.add_pending(raw)
+            return
+
+        try:
+            with self.using_connection():
+                self.channel.basic_publish(
+                    self.exchange,
+                    self.routing_key,
+                    raw,
+                    properties=self.properties,
+                )
         except pika.exceptions.AMQPError:
             if not retry:
                 raise
 
             # do a single retry on an unknown failure
-            self.rotate()
-            self.on_status(status, retry=False)
+            publish_retries_total.inc()
+            self.disconnect()
+            self.on_raw(raw, status, retry=False)
+
+    def add_pending(self, raw):
+        if self.flusher is None:
+            self.start_flusher()
+        now = datetime.utcnow()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending.append(raw)
+        self.pending_bytes += len(raw)
+        if (
+            len(self.pending) >= self.batch_size
+            or self.pending_bytes >= self.batch_bytes
+            or now - self.pending_since >= self.batch_latency
+        ):
+            self.flush()
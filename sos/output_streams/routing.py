@@ -0,0 +1,48 @@
+from .. import json
+from .composite import CompositeOutputStream
+
+class RoutingOutputStream(CompositeOutputStream):
+    """
+    Write each status only to the streams its matching routes point at.
+
+    ``streams`` maps destination names, the sink names and
+    ``rabbitmq:<routing key>``, to output streams. Statuses matching no
+    route are dropped.
+
+    """
+    needs_status = True
+
+    def __init__(self, router, streams, **kw):
+        self.router = router
+        super().__init__(**kw)
+        self.needs_status = True
+        self.destinations = {}
+        for destination, stream in streams.items():
+            self.add_stream(stream)
+            self.destinations[destination] = self.streams[-1]
+
+    def stats(self):
+        stats = self.router.stats()
+        inner_stats = super().stats()
+        if inner_stats:
+            stats += f', {inner_stats}'
+        return stats
+
+    def streams_for(self, status):
+        sinks, routing_keys = self.router.destinations(status)
+        streams = [self.destinations[sink] for sink in sinks]
+        streams.extend(
+            self.destinations[f'rabbitmq:{key}'] for key in routing_keys)
+        return streams
+
+    def on_status(self, status):
+        streams = self.streams_for(status)
+        if streams:
+            self.call_each('on_status', status, streams=streams)
+
+    def on_raw(self, raw, status=None):
+        if status is None:
+            status = json.loads(raw)
+        streams = self.streams_for(status)
+        if streams:
+            self.call_each('on_raw', raw, status, streams=streams)
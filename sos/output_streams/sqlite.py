@@ -0,0 +1,172 @@
+from datetime import datetime, timedelta
+import logging
+import os
+import sqlite3
+
+from .. import json
+from ..settings import asduration
+from ..status import status_fields
+
+log = logging.getLogger(__name__)
+
+columns = (
+    'id',
+    'user_id',
+    'user_sn',
+    'created_at',
+    'text',
+    'in_reply_to_status_id',
+    'in_reply_to_user_id',
+    'in_reply_to_screen_name',
+    'quoted_status_id',
+    'lang',
+    'json',
+)
+
+schema = (
+    'create table if not exists statuses ('
+    'id integer primary key, '
+    'user_id integer not null, '
+    'user_sn text not null, '
+    'created_at integer, '
+    'text text, '
+    'in_reply_to_status_id integer, '
+    'in_reply_to_user_id integer, '
+    'in_reply_to_screen_name text, '
+    'quoted_status_id integer, '
+    'lang text, '
+    'json blob'
+    ')',
+    'create index if not exists statuses_user_id '
+    'on statuses (user_id)',
+    'create index if not exists statuses_user_sn '
+    'on statuses (user_sn collate nocase)',
+    'create index if not exists statuses_in_reply_to_status_id '
+    'on statuses (in_reply_to_status_id) '
+    'where in_reply_to_status_id is not null',
+    'create index if not exists statuses_quoted_status_id '
+    'on statuses (quoted_status_id) '
+    'where quoted_status_id is not null',
+    'create index if not exists statuses_created_at '
+    'on statuses (created_at)',
+)
+
+insert_sql = (
+    f'insert or ignore into statuses ({", ".join(columns)}) '
+    f'values ({", ".join("?" for _ in columns)})'
+)
+
+def parse_created_at(value):
+    if value is None:
+        return None
+    try:
+        return int(datetime.strptime(
+            value, '%a %b %d %H:%M:%S %z %Y').timestamp())
+    except ValueError:
+        return None
+
+def connect(path, *, readonly=False):
+    if readonly:
+        db = sqlite3.connect(f'file:{path}?mode=ro', uri=True)
+    else:
+        root_path = os.path.dirname(path)
+        if root_path:
+            os.makedirs(root_path, exist_ok=True)
+        # several archiver workers may share a store and take turns writing
+        db = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        db.execute('pragma journal_mode=wal')
+        # in wal mode a crash can only lose the last few transactions
+        db.execute('pragma synchronous=normal')
+        for sql in schema:
+            db.execute(sql)
+        db.commit()
+    return db
+
+class SqliteOutputStream:
+    """
+    Store statuses in a local sqlite database indexed by status id, user,
+    reply and quote ids and creation time.
+
+    Rows are inserted in batches of ``batch_size`` statuses, or after
+    ``batch_latency``, inside a single transaction. Statuses that are
+    already stored are ignored.
+
+    """
+    needs_status = True
+
+    batch_size = 1000
+    batch_latency = timedelta(seconds=1)
+
+    def __init__(
+        self,
+        path,
+        *,
+        batch_size=None,
+        batch_latency=None,
+        include_json=True,
+    ):
+        self.path = path
+        self.include_json = include_json
+        if batch_size is not None:
+            self.batch_size = batch_size
+        if batch_latency is not None:
+            self.batch_latency = batch_latency
+
+        self.db = connect(path)
+        self.pending = []
+        self.pending_since = None
+
+    @classmethod
+    def from_config(cls, profile, path):
+        settings = profile.get('sqlite', {})
+        return cls(
+            path,
+            batch_size=settings.get('batch_size'),
+            batch_latency=asduration(
+                settings.get('batch_latency'), default=None),
+            include_json=settings.get('include_json', True),
+        )
+
+    def close(self):
+        if self.db is not None:
+            self.flush()
+            self.db.close()
+            self.db = None
+
+    def rotate(self):
+        self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # a failed transaction is rolled back so the rows stay pending until
+        # they are committed by a later flush
+        with self.db:
+            self.db.executemany(insert_sql, self.pending)
+        self.pending = []
+        self.pending_since = None
+
+    def on_status(self, status):
+        self.add_row(status, json.dumps(status))
+
+    def on_raw(self, raw, status=None):
+        if status is None:
+            status = json.loads(raw)
+        self.add_row(status, raw)
+
+    def add_row(self, status, raw):
+        data = status_fields(status)
+        data['created_at'] = parse_created_at(data['created_at'])
+        data['json'] = raw if self.include_json else None
+
+        now = datetime.utcnow()
+        if self.pending_since is None:
+            self.pending_since = now
+        self.pending.append(tuple(data[name] for name in columns))
+
+        if (
+            len(self.pending) >= self.batch_size
+            or now - self.pending_since >= self.batch_latency
+        ):
+            self.flush()
@@ -1,4 +1,6 @@
-import json
+import sys
+
+from .. import json
 
 class StdoutOutputStream:
     def close(self):
@@ -7,5 +9,11 @@ class StdoutOutputStream:
     def rotate(self):
         pass
 
+    def flush(self):
+        sys.stdout.flush()
+
     def on_status(self, status):
-        print(json.dumps(status))
+        print(json.dumps(status).decode('utf8'))
+
+    def on_raw(self, raw, status=None):
+        print(raw.decode('utf8'))
@@ -0,0 +1,279 @@
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
+import glob
+import gzip
+import logging
+import os
+import time
+
+from . import zstd
+
+log = logging.getLogger(__name__)
+
+bucket_formats = {
+    'hour': '%Y%m%d.%H0000',
+    'day': '%Y%m%d',
+}
+
+def find_input_files(patterns):
+    paths = []
+    for pattern in patterns:
+        if os.path.isdir(pattern):
+            for name in sorted(os.listdir(pattern)):
+                if name.endswith(('.gz', '.zstd')):
+                    paths.append(os.path.join(pattern, name))
+        else:
+            paths.extend(sorted(glob.glob(pattern)))
+    return paths
+
+def stem_for(path):
+    name = os.path.basename(path)
+    for ext in ('.gz', '.zstd'):
+        if name.endswith(ext):
+            return name[:-len(ext)]
+    return name
+
+def iter_input_lines(path, *, dict_data=None):
+    with open(path, 'rb') as fp:
+        if path.endswith('.gz'):
+            with gzip.open(fp, mode='rb') as gz_fp:
+                for line in gz_fp:
+                    line = line.strip()
+                    if line:
+                        yield line
+        else:
+            yield from zstd.iter_raw_lines(fp, dict_data=dict_data)
+
+def bucket_for(line, fmt):
+    m = zstd.created_at_re.search(line)
+    if m:
+        try:
+            created_at = datetime.strptime(
+                m.group(1).decode('utf8'), '%a %b %d %H:%M:%S %z %Y')
+            return f'{created_at:{fmt}}'
+        except ValueError:
+            pass
+    return 'unknown'
+
+class OutputFiles:
+    def __init__(self, output_dir, stem, options):
+        self.output_dir = output_dir
+        self.stem = stem
+        self.options = options
+        self.dict_data = None
+        if options['dictionary']:
+            self.dict_data = zstd.load_dictionary(options['dictionary'])
+        self.files = {}
+        self.records = {}
+        self.paths = []
+
+    def path_for(self, key):
+        name = self.stem if key is None else f'{key}.{self.stem}'
+        return os.path.join(self.output_dir, f'{name}.zstd')
+
+    def open(self, key):
+        path = self.path_for(key)
+        fp = open(path, 'wb')
+        if self.options['frame_records']:
+            index_fp = open(zstd.index_path_for(path), 'wb')
+            writer = zstd.FramedWriter(
+                fp,
+                index_fp,
+                level=self.options['level'],
+                frame_records=self.options['frame_records'],
+                threads=self.options['threads'],
+                long_distance=self.options['long'],
+                dict_data=self.dict_data,
+            )
+        else:
+            index_fp = None
+            writer = zstd.writer(
+                fp,
+                level=self.options['level'],
+                threads=self.options['threads'],
+                long_distance=self.options['long'],
+                dict_data=self.dict_data,
+            )
+        self.files[key] = (fp, index_fp, writer)
+        self.records[path] = 0
+        self.paths.append(path)
+        return self.files[key]
+
+    def write(self, key, line):
+        entry = self.files.get(key)
+        if entry is None:
+            entry = self.open(key)
+        _, _, writer = entry
+        if self.options['frame_records']:
+            writer.write_record(line)
+        else:
+            writer.write(line)
+            writer.write(b'\n')
+        self.records[self.path_for(key)] += 1
+
+    def close(self, key):
+        fp, index_fp, writer = self.files.pop(key)
+        writer.close()
+        fp.close()
+        if index_fp is not None:
+            index_fp.close()
+
+    def close_all(self):
+        for key in list(self.files):
+            self.close(key)
+
+def recompact_file(path, options):
+    start = time.monotonic()
+    stem = stem_for(path)
+    input_dict_data = None
+    if options['input_dictionary']:
+        input_dict_data = zstd.load_dictionary(options['input_dictionary'])
+
+    outputs = OutputFiles(options['output_dir'], stem, options)
+    records_in = 0
+    chunk = None
+    try:
+        for line in iter_input_lines(path, dict_data=input_dict_data):
+            if options['bucket']:
+                key = bucket_for(line, bucket_formats[options['bucket']])
+            elif options['records_per_file']:
+                key = f'{records_in // options["records_per_file"]:05d}'
+                # chunks are written in order so close the previous one
+                if chunk is not None and key != chunk:
+                    outputs.close(chunk)
+                chunk = key
+            else:
+                key = None
+            outputs.write(key, line)
+            records_in += 1
+    finally:
+        outputs.close_all()
+
+    # the outputs are re-read since counting the records handed to the
+    # writers would only count what was read
+    if options['verify']:
+        for out_path, expected in outputs.records.items():
+            with open(out_path, 'rb') as fp:
+                actual = sum(1 for _ in zstd.iter_raw_lines(
+                    fp, dict_data=outputs.dict_data))
+            if actual != expected:
+                raise RuntimeError(
+                    f'verification failed for path={out_path}, '
+                    f'expected {expected} records but found {actual}'
+                )
+
+    return {
+        'path': path,
+        'outputs': outputs.paths,
+        'records': records_in,
+        'bytes_in': os.path.getsize(path),
+        'bytes_out': sum(os.path.getsize(p) for p in outputs.paths),
+        'seconds': time.monotonic() - start,
+    }
+
+def compact_file(
+    path,
+    *,
+    level,
+    frame_records=None,
+    dictionary=None,
+    threads=0,
+    long_distance=False,
+):
+    """
+    Recompress a closed archive in place, along with its index.
+
+    The archive is rewritten next to the original and only replaces it once
+    every record was verified. The old index is removed before the archive
+    is replaced, so a crash in between leaves an archive without an index,
+    which readers read whole, rather than an index of different data.
+
+    """
+    output_dir = os.path.join(os.path.dirname(path), '.compact')
+    os.makedirs(output_dir, exist_ok=True)
+    stats = recompact_file(path, {
+        'output_dir': output_dir,
+        'level': level,
+        'threads': threads,
+        'long': long_distance,
+        'dictionary': dictionary,
+        'input_dictionary': dictionary,
+        'records_per_file': None,
+        'bucket': None,
+        'frame_records': frame_records,
+        'verify': True,
+    })
+    index_path = zstd.index_path_for(path)
+    for out_path in stats['outputs']:
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        os.replace(out_path, path)
+        if frame_records:
+            os.replace(zstd.index_path_for(out_path), index_path)
+    return stats
+
+def format_stats(stats):
+    ratio = stats['bytes_out'] / stats['bytes_in'] if stats['bytes_in'] else 0
+    rate = stats['bytes_in'] / stats['seconds'] / 1e6 if stats['seconds'] else 0
+    return (
+        f'{stats["records"]} records, read {stats["bytes_in"]} bytes, '
+        f'wrote {stats["bytes_out"]} bytes, ratio={ratio:.3f}, '
+        f'{rate:.1f} MB/s'
+    )
+
+def overlaps(output_dir, path):
+    output_dir = os.path.realpath(output_dir)
+    path = os.path.realpath(path)
+    return output_dir in (path, os.path.dirname(path))
+
+def main(cli, args):
+    paths = find_input_files(args.inputs)
+    if not paths:
+        cli.abort('no input files found')
+    # outputs are named after their input and could replace it
+    for path in paths:
+        if overlaps(args.output_dir, path):
+            cli.abort(
+                f'--output-dir must not contain the input files, '
+                f'found path={path}'
+            )
+    os.makedirs(args.output_dir, exist_ok=True)
+
+    options = {
+        'output_dir': args.output_dir,
+        'level': args.level,
+        'threads': args.threads,
+        'long': args.long,
+        'dictionary': args.dictionary,
+        'input_dictionary': args.input_dictionary,
+        'records_per_file': args.records_per_file,
+        'bucket': args.bucket,
+        'frame_records': args.frame_records,
+        'verify': args.verify,
+    }
+    if len(set(map(stem_for, paths))) != len(paths):
+        cli.abort('input files must have unique names')
+
+    start = time.monotonic()
+    totals = {'records': 0, 'bytes_in': 0, 'bytes_out': 0}
+    num_failed = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as pool:
+        futures = {
+            pool.submit(recompact_file, path, options): path
+            for path in paths
+        }
+        for future in as_completed(futures):
+            try:
+                stats = future.result()
+            except Exception:
+                log.exception(f'failed to recompact path={futures[future]}')
+                num_failed += 1
+                continue
+            log.info(f'path={stats["path"]}: {format_stats(stats)}')
+            for key in totals:
+                totals[key] += stats[key]
+
+    totals['seconds'] = time.monotonic() - start
+    log.info(f'total for {len(paths)} files: {format_stats(totals)}')
+    if num_failed:
+        cli.abort(f'failed to recompact {num_failed} files')
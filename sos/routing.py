@@ -0,0 +1,211 @@
+"""
+Match statuses against routes and decide where they should be written.
+
+A routes file is a list of routes, each with an optional ``match`` and the
+``sinks`` and/or rabbitmq ``routing_keys`` that matching statuses go to::
+
+  - name: politics
+    match:
+      keywords: [potus, white house]
+      regex: ['\\bvot(e|ing)\\b']
+      lang: [en, es]
+      has_media: true
+    sinks: [file]
+    routing_keys: [politics]
+
+  - name: replies-to-friends
+    match:
+      user_ids: [1234, 5678]
+      is_reply: true
+    sinks: [sqlite]
+
+Keywords are matched case-insensitively and never as part of a longer word,
+so ``#potus``, ``@jack`` and ``c++`` work as keywords too. All of the
+keywords and regexes of a route are compiled into a single regex. Every
+condition of a ``match`` must hold, a route without one matches every
+status. ``is_retweet``, ``is_reply``, ``is_quote`` and ``has_media`` can be
+``true`` or ``false``.
+
+"""
+import logging
+import re
+
+log = logging.getLogger(__name__)
+
+sink_names = ('file', 'sqlite', 'rabbitmq', 'firestore', 'gcs')
+
+match_keys = (
+    'keywords',
+    'regex',
+    'lang',
+    'user_ids',
+    'screen_names',
+    'is_retweet',
+    'is_reply',
+    'is_quote',
+    'has_media',
+)
+
+def status_text(status):
+    extended = status.get('extended_tweet')
+    if extended is not None:
+        return extended.get('full_text', '')
+    return status.get('text') or ''
+
+def is_retweet(status):
+    return 'retweeted_status' in status
+
+def is_reply(status):
+    return status.get('in_reply_to_status_id') is not None
+
+def is_quote(status):
+    return bool(
+        status.get('is_quote_status')
+        or status.get('quoted_status_id') is not None
+    )
+
+def has_media(status):
+    return bool(
+        status.get('extended_entities', {}).get('media')
+        or status.get('entities', {}).get('media')
+    )
+
+flag_predicates = {
+    'is_retweet': is_retweet,
+    'is_reply': is_reply,
+    'is_quote': is_quote,
+    'has_media': has_media,
+}
+
+def keyword_pattern(keyword):
+    words = keyword.split()
+    pattern = r'\s+'.join(map(re.escape, words))
+    # \b only works next to a word character, so "#potus", "@jack" and "c++"
+    # are bounded by not touching another word character instead
+    if re.match(r'\w', words[0]):
+        pattern = r'(?<!\w)' + pattern
+    if re.search(r'\w$', words[-1]):
+        pattern += r'(?!\w)'
+    return pattern
+
+def compile_text_pattern(keywords, regexes):
+    patterns = [
+        keyword_pattern(keyword)
+        for keyword in keywords
+        if keyword.strip()
+    ]
+    patterns.extend(regexes)
+    if not patterns:
+        return None
+    return re.compile('|'.join(f'(?:{p})' for p in patterns), re.IGNORECASE)
+
+class Route:
+    def __init__(self, name, *, match=None, sinks=(), routing_keys=()):
+        match = match or {}
+        unknown = set(match) - set(match_keys)
+        if unknown:
+            raise ValueError(
+                f'unknown match conditions={sorted(unknown)} in route={name}')
+        unknown = set(sinks) - set(sink_names)
+        if unknown:
+            raise ValueError(f'unknown sinks={sorted(unknown)} in route={name}')
+        if not sinks and not routing_keys:
+            raise ValueError(f'route={name} has no sinks or routing_keys')
+
+        self.name = name
+        self.sinks = tuple(sinks)
+        self.routing_keys = tuple(routing_keys)
+        self.num_matched = 0
+
+        # the cheapest checks go first
+        self.checks = []
+        for key, predicate in flag_predicates.items():
+            if key in match:
+                expected = bool(match[key])
+                self.checks.append(
+                    lambda status, p=predicate, e=expected: p(status) is e)
+        if 'lang' in match:
+            langs = frozenset(match['lang'])
+            self.checks.append(lambda status: status.get('lang') in langs)
+        if 'user_ids' in match:
+            user_ids = frozenset(int(user_id) for user_id in match['user_ids'])
+            self.checks.append(
+                lambda status: status['user']['id'] in user_ids)
+        if 'screen_names' in match:
+            screen_names = frozenset(
+                name.lower().lstrip('@') for name in match['screen_names'])
+            self.checks.append(
+                lambda status:
+                    status['user']['screen_name'].lower() in screen_names)
+        pattern = compile_text_pattern(
+            match.get('keywords', ()),
+            match.get('regex', ()),
+        )
+        if pattern is not None:
+            search = pattern.search
+            self.checks.append(
+                lambda status: search(status_text(status)) is not None)
+
+    def matches(self, status):
+        for check in self.checks:
+            if not check(status):
+                return False
+        return True
+
+class Router:
+    def __init__(self, routes):
+        self.routes = list(routes)
+        self.num_unmatched = 0
+
+    @classmethod
+    def from_config(cls, config):
+        routes = []
+        for n, route in enumerate(config):
+            routes.append(Route(
+                route.get('name', f'route{n}'),
+                match=route.get('match'),
+                sinks=route.get('sinks', ()),
+                routing_keys=route.get('routing_keys', ()),
+            ))
+        return cls(routes)
+
+    @property
+    def sinks(self):
+        return {sink for route in self.routes for sink in route.sinks}
+
+    @property
+    def routing_keys(self):
+        return {
+            key
+            for route in self.routes
+            for key in route.routing_keys
+        }
+
+    def destinations(self, status):
+        """
+        Return the names of the sinks and the routing keys for ``status``.
+
+        """
+        sinks = set()
+        routing_keys = set()
+        matched = False
+        for route in self.routes:
+            if route.matches(status):
+                matched = True
+                route.num_matched += 1
+                sinks.update(route.sinks)
+                routing_keys.update(route.routing_keys)
+        if not matched:
+            self.num_unmatched += 1
+        return sinks, routing_keys
+
+    def stats(self):
+        stats = ' '.join(
+            f'{route.name}={route.num_matched}'
+            for route in self.routes
+        )
+        stats = f'routes {stats} unmatched={self.num_unmatched}'
+        for route in self.routes:
+            route.num_matched = 0
+        self.num_unmatched = 0
+        return stats
@@ -0,0 +1,13 @@
+def status_fields(status):
+    return {
+        'id': status['id'],
+        'user_id': status['user']['id'],
+        'user_sn': status['user']['screen_name'],
+        'created_at': status.get('created_at'),
+        'text': status.get('text'),
+        'in_reply_to_status_id': status.get('in_reply_to_status_id'),
+        'in_reply_to_user_id': status.get('in_reply_to_user_id'),
+        'in_reply_to_screen_name': status.get('in_reply_to_screen_name'),
+        'quoted_status_id': status.get('quoted_status_id'),
+        'lang': status.get('lang'),
+    }
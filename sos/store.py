@@ -0,0 +1,67 @@
+from datetime import datetime, timezone
+import logging
+
+from .output_streams.sqlite import connect
+
+log = logging.getLogger(__name__)
+
+def parse_time(value):
+    created_at = datetime.fromisoformat(value)
+    if created_at.tzinfo is None:
+        created_at = created_at.replace(tzinfo=timezone.utc)
+    return int(created_at.timestamp())
+
+def build_query(args):
+    where, params = [], []
+    if args.id is not None:
+        where.append('id = ?')
+        params.append(args.id)
+    if args.replies_to is not None:
+        where.append('in_reply_to_status_id = ?')
+        params.append(args.replies_to)
+    if args.quotes_of is not None:
+        where.append('quoted_status_id = ?')
+        params.append(args.quotes_of)
+    if args.user_id is not None:
+        where.append('user_id = ?')
+        params.append(args.user_id)
+    if args.screen_name is not None:
+        where.append('user_sn = ? collate nocase')
+        params.append(args.screen_name.lstrip('@'))
+    if args.since is not None:
+        where.append('created_at >= ?')
+        params.append(parse_time(args.since))
+    if args.until is not None:
+        where.append('created_at < ?')
+        params.append(parse_time(args.until))
+
+    sql = 'select id, user_sn, text, json from statuses'
+    if where:
+        sql += ' where ' + ' and '.join(where)
+    sql += ' order by id'
+    if args.limit:
+        sql += ' limit ?'
+        params.append(args.limit)
+    return sql, params
+
+def main_query(cli, args):
+    db = connect(args.path, readonly=True)
+    sql, params = build_query(args)
+    log.debug(f'running query="{sql}" params={params}')
+
+    num_rows = 0
+    try:
+        for status_id, user_sn, text, raw in db.execute(sql, params):
+            if args.format == 'json':
+                if raw is None:
+                    cli.abort('the store was written without the status json')
+                if isinstance(raw, bytes):
+                    raw = raw.decode('utf8')
+                cli.out(raw)
+            else:
+                text = (text or '').replace('\n', ' ')
+                cli.out(f'{status_id}\t@{user_sn}\t{text}')
+            num_rows += 1
+    finally:
+        db.close()
+    log.info(f'found {num_rows} statuses')
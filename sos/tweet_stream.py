@@ -1,50 +1,95 @@
+import asyncio
 from datetime import datetime, timedelta
-import json
 import logging
+import os
 import signal
+import time
 import tweepy
 import yaml
 
-from .output_streams import output_stream_from_config
+from . import json, metrics
+from .routing import Router
+from .output_streams import (
+    DedupeOutputStream,
+    QueuedOutputStream,
+    output_stream_from_config,
+)
 
 log = logging.getLogger(__name__)
 
+STATUS_KEY = b'"in_reply_to_status_id":'
+RETWEET_KEY = b'"retweeted_status":'
+
+shared_queue_size = 10000
+
+def make_reporter(output_stream, report_interval, name=None):
+    # streams sharing an output stream leave its stats to the supervisor
+    # since reading them resets the counters
+    if name is None:
+        return metrics.RateReporter(
+            report_interval,
+            stats=getattr(output_stream, 'stats', None),
+            logger=log,
+        )
+    return metrics.RateReporter(report_interval, logger=log.getChild(name))
+
+def is_status(raw_data):
+    # a quote inside of the tweet text is always escaped so these keys
+    # can only match the keys of the status object itself
+    return STATUS_KEY in raw_data
+
+def is_retweet(raw_data):
+    return RETWEET_KEY in raw_data
+
 class TweetStream(tweepy.Stream):
-    last_report_at = None
-    num_records_since_report = 0
     report_interval = timedelta(seconds=1)
 
-    def __init__(self, *args, output_stream, report_interval=None, **kw):
+    def __init__(
+        self,
+        *args,
+        output_stream,
+        report_interval=None,
+        drop_retweets=True,
+        name=None,
+        **kw
+    ):
         super().__init__(*args, **kw)
         self.output_stream = output_stream
+        self.drop_retweets = drop_retweets
         if report_interval is not None:
             self.report_interval = report_interval
-        self.last_report_at = datetime.utcnow()
-        self.num_records_since_report = 0
+        self.reporter = make_reporter(output_stream, self.report_interval, name)
 
     def on_disconnect(self):
         super().on_disconnect()
-        self.report()
+        self.reporter.report()
 
     # explitly overriding tweepy.Stream.on_data here to avoid inefficiencies
     # in extra parsing of the tweets - just want to grab them and shoot them
-    # into the output stream as quickly as possible without parsing into
-    # a full Status object
+    # into the output stream as quickly as possible without parsing them at
+    # all, sinks that need the fields will parse the raw bytes themselves
     def on_data(self, raw_data):
-        now = datetime.utcnow()
-        self.num_records_since_report += 1
+        self.reporter.record()
 
-        data = json.loads(raw_data)
+        if isinstance(raw_data, str):
+            raw_data = raw_data.encode('utf8')
+        raw_data = raw_data.strip()
 
-        if 'in_reply_to_status_id' in data:
+        if is_status(raw_data):
             # explicitly filter out retweets
-            if 'retweeted_status' in data:
+            if self.drop_retweets and is_retweet(raw_data):
                 return
             try:
-                self.output_stream.on_status(data)
+                self.output_stream.on_raw(raw_data)
             except Exception:
                 log.exception('received exception writing status to output stream')
-        elif 'warning' in data:
+        else:
+            self.on_control_message(raw_data)
+
+    def on_control_message(self, raw_data):
+        data = json.loads(raw_data)
+
+        if 'warning' in data:
             self.on_warning(data['warning'])
         elif 'limit' in data:
             self.on_limit(data['limit']['track'])
@@ -53,41 +98,386 @@ class TweetStream(tweepy.Stream):
         else:
             log.debug(f'ignoring unknown message={raw_data}')
 
-        if now - self.last_report_at >= self.report_interval:
-            self.report(now=now)
+def load_filters(paths):
+    """
+    Read the filter parameters of each file in ``paths`` keyed by path.
+
+    Directories contribute every ``.yml`` and ``.yaml`` file in them.
+
+    """
+    filter_paths = []
+    for path in paths:
+        if os.path.isdir(path):
+            filter_paths.extend(sorted(
+                os.path.join(path, name)
+                for name in os.listdir(path)
+                if name.endswith(('.yml', '.yaml'))
+            ))
+        else:
+            filter_paths.append(path)
+
+    filters = {}
+    for path in filter_paths:
+        with open(path, 'r', encoding='utf8') as fp:
+            filters[path] = yaml.safe_load(fp)
+    return filters
+
+def credentials_name(filters):
+    return filters.get('credentials', 'twitter')
+
+def twitter_credentials(profile, name):
+    """
+    Return the twitter credentials called ``name``.
+
+    A filter file may name a set of credentials under ``twitter_credentials``
+    in the profile with a ``credentials`` key, otherwise the ``twitter``
+    credentials are used.
+
+    """
+    if name == 'twitter':
+        return profile['twitter']
+    credentials = profile.get('twitter_credentials', {}).get(name)
+    if credentials is None:
+        raise ValueError(f'unknown twitter credentials={name}')
+    return credentials
 
-    def report(self, now=None):
+def stream_filters(filters):
+    return {k: v for k, v in filters.items() if k != 'credentials'}
+
+class SupervisedStream:
+    def __init__(self, path, filters, *, start_at):
+        self.path = path
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        self.filters = filters
+        self.credentials = credentials_name(filters)
+        self.stream = None
+        self.started_at = None
+        self.restart_at = start_at
+        self.num_failures = 0
+
+class FilterStreamSupervisor:
+    """
+    Run a :class:`TweetStream` per filter file on its own thread.
+
+    All of the streams write to the same ``output_stream``, which must be
+    safe to call from several threads such as a
+    :class:`QueuedOutputStream`. A stream that stops is reconnected after a
+    delay doubling from ``backoff_initial`` up to ``backoff_max``, the delay
+    is reset once a stream stayed connected for ``backoff_max``.
+
+    Twitter allows one filter stream per set of credentials and a second
+    connection disconnects the first, so every filter file needs its own
+    ``credentials`` (see :func:`twitter_credentials`). A filter sharing them
+    with another one is not started, and a changed filter only reconnects
+    once its old stream has disconnected.
+
+    """
+    backoff_initial = timedelta(seconds=5)
+    backoff_max = timedelta(seconds=320)
+    poll_interval = 0.5
+    join_timeout = 5
+
+    def __init__(
+        self,
+        profile,
+        paths,
+        *,
+        output_stream,
+        report_interval,
+        drop_retweets=True,
+    ):
+        self.profile = profile
+        self.paths = paths
+        self.output_stream = output_stream
+        self.report_interval = report_interval
+        self.drop_retweets = drop_retweets
+        self.supervised = {}
+        self.stopped_streams = []
+        self.reload_requested = False
+        self.stopping = False
+        self.last_report_at = datetime.utcnow()
+
+    def make_stream(self, name, credentials):
+        twitter = twitter_credentials(self.profile, credentials)
+        return TweetStream(
+            twitter['consumer_key'],
+            twitter['consumer_secret'],
+            twitter['access_token'],
+            twitter['access_token_secret'],
+            output_stream=self.output_stream,
+            report_interval=self.report_interval,
+            drop_retweets=self.drop_retweets,
+            name=name,
+            daemon=True,
+        )
+
+    def connect(self, stream, filters):
+        stream.filter(**filters, stall_warnings=True, threaded=True)
+
+    def is_running(self, stream):
+        return stream.thread.is_alive()
+
+    def start(self, supervised, now):
+        log.info(f'connecting filter={supervised.name}')
+        supervised.stream = self.make_stream(
+            supervised.name, supervised.credentials)
+        self.connect(supervised.stream, stream_filters(supervised.filters))
+        supervised.started_at = now
+
+    def stop(self, supervised):
+        if supervised.stream is not None:
+            supervised.stream.disconnect()
+            self.stopped_streams.append(
+                (supervised.credentials, supervised.stream))
+            supervised.stream = None
+
+    def usable_filters(self, filters):
+        """
+        Drop the filters that cannot connect from ``filters``.
+
+        """
+        usable = {}
+        owners = {}
+        for path, path_filters in filters.items():
+            name = credentials_name(path_filters)
+            try:
+                twitter_credentials(self.profile, name)
+            except ValueError:
+                log.exception(f'not starting filter={path}')
+                continue
+            if name in owners:
+                log.error(
+                    f'not starting filter={path}, it uses the same '
+                    f'credentials={name} as filter={owners[name]} and '
+                    'twitter allows one filter stream per credentials'
+                )
+                continue
+            owners[name] = path
+            usable[path] = path_filters
+        return usable
+
+    def reload(self, now=None):
         if now is None:
             now = datetime.utcnow()
-        dt = now - self.last_report_at
+        try:
+            filters = load_filters(self.paths)
+        except Exception:
+            log.exception('failed to read filter files, keeping the old filters')
+            return
+        filters = self.usable_filters(filters)
+
+        for path in list(self.supervised):
+            if path not in filters:
+                log.info(f'removing filter={self.supervised[path].name}')
+                self.stop(self.supervised.pop(path))
 
-        log.info(
-            f'received {self.num_records_since_report} records since '
-            f'{dt.total_seconds():.2f} seconds ago'
+        for path, path_filters in filters.items():
+            supervised = self.supervised.get(path)
+            if supervised is not None:
+                if supervised.filters == path_filters:
+                    continue
+                log.info(f'changing filter={supervised.name}')
+                self.stop(supervised)
+            else:
+                log.info(f'adding filter={path}')
+            self.supervised[path] = SupervisedStream(
+                path, path_filters, start_at=now)
+
+    def check(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        self.stopped_streams = [
+            (credentials, stream)
+            for credentials, stream in self.stopped_streams
+            if self.is_running(stream)
+        ]
+        # credentials are still in use until their old stream noticed it was
+        # disconnected and connecting again would disconnect it instead
+        disconnecting = {
+            credentials
+            for credentials, stream in self.stopped_streams
+        }
+        for supervised in self.supervised.values():
+            stream = supervised.stream
+            if stream is not None:
+                if self.is_running(stream):
+                    continue
+                if now - supervised.started_at >= self.backoff_max:
+                    supervised.num_failures = 0
+                delay = min(
+                    self.backoff_initial * 2 ** supervised.num_failures,
+                    self.backoff_max,
+                )
+                supervised.num_failures += 1
+                supervised.restart_at = now + delay
+                supervised.stream = None
+                log.warning(
+                    f'filter={supervised.name} stopped, reconnecting in '
+                    f'{delay.total_seconds():.0f} seconds'
+                )
+            if (
+                now >= supervised.restart_at
+                and supervised.credentials not in disconnecting
+            ):
+                self.start(supervised, now)
+
+    def report(self):
+        num_connected = sum(
+            1
+            for supervised in self.supervised.values()
+            if supervised.stream is not None
+            and self.is_running(supervised.stream)
         )
-        self.last_report_at = now
-        self.num_records_since_report = 0
+        msg = f'{num_connected}/{len(self.supervised)} filters connected'
+        stats = getattr(self.output_stream, 'stats', lambda: '')()
+        if stats:
+            msg += f', {stats}'
+        log.info(msg)
 
-def main(cli, args):
-    profile = cli.profile
+    def step(self, now=None):
+        if now is None:
+            now = datetime.utcnow()
+        if self.reload_requested:
+            self.reload_requested = False
+            self.reload(now=now)
+        self.check(now=now)
+        if now - self.last_report_at >= self.report_interval:
+            self.report()
+            self.last_report_at = now
 
-    with open(args.filter_file, 'r', encoding='utf8') as fp:
-        filters = yaml.safe_load(fp)
+    def run(self):
+        self.reload()
+        while not self.stopping:
+            try:
+                self.step()
+                time.sleep(self.poll_interval)
+            except KeyboardInterrupt:
+                log.info('received SIGINT, stopping')
+                self.stopping = True
+
+        for supervised in self.supervised.values():
+            self.stop(supervised)
+        # a stream only notices it was disconnected once it receives data
+        # or a keep-alive, the threads are daemons so do not wait forever
+        for _, stream in self.stopped_streams:
+            if stream.thread is not None:
+                stream.thread.join(self.join_timeout)
 
-    output_stream = output_stream_from_config(
+def make_output_stream(profile, args, router, *, asynchronous=False):
+    return output_stream_from_config(
         profile,
         output_path_prefix=args.output_path_prefix,
+        output_frame_records=args.output_frame_records,
+        output_frame_bytes=args.output_frame_bytes,
+        output_dictionary=args.output_dictionary,
+        output_flush_records=args.output_flush_records,
+        output_flush_interval=args.output_flush_interval,
+        output_flush_frames=args.output_flush_frames,
+        output_fsync=args.output_fsync,
+        output_rotate_interval=args.output_rotate_interval,
+        output_rotate_bytes=args.output_rotate_bytes,
+        output_rotate_records=args.output_rotate_records,
+        output_compact_level=args.output_compact_level,
+        sqlite_path=args.sqlite_path,
         rabbitmq_exchange=args.rabbitmq_exchange,
         rabbitmq_routing_key=args.rabbitmq_routing_key,
+        rabbitmq_batch_size=args.rabbitmq_batch_size,
+        fanout_queue_size=args.fanout_queue_size,
+        fanout_overflow=args.fanout_overflow,
+        fanout_spill_path_prefix=args.fanout_spill_path_prefix,
+        router=router,
+        asynchronous=asynchronous,
+    )
+
+def main(cli, args):
+    profile = cli.profile
+
+    router = None
+    if args.routes_file:
+        with open(args.routes_file, 'r', encoding='utf8') as fp:
+            router = Router.from_config(yaml.safe_load(fp))
+
+    if args.asyncio:
+        # only imported here as aiohttp is only needed with --asyncio
+        from .async_tweet_stream import main_async
+        asyncio.run(main_async(profile, args, router))
+        return
+
+    supervise = (
+        len(args.filter_files) > 1
+        or os.path.isdir(args.filter_files[0])
     )
+    output_stream = make_output_stream(profile, args, router)
+
+    def dedupe(output_stream):
+        return DedupeOutputStream(
+            output_stream,
+            window=args.dedupe_window,
+            max_size=args.dedupe_max_size,
+            path=args.dedupe_path,
+        )
+
+    queue_size = args.queue_size
+    if supervise:
+        # the queue is what makes the output streams safe to share between
+        # the filter streams, anything behind it only runs on its thread
+        if not queue_size:
+            queue_size = shared_queue_size
+        if args.dedupe:
+            output_stream = dedupe(output_stream)
+    if queue_size:
+        output_stream = QueuedOutputStream(
+            output_stream,
+            max_size=queue_size,
+            overflow=args.queue_overflow,
+            spill_path_prefix=args.queue_spill_path_prefix,
+        )
+    # dedupe before queueing so duplicates do not take up room in the queue
+    if args.dedupe and not supervise:
+        output_stream = dedupe(output_stream)
+
+    if supervise:
+        supervisor = FilterStreamSupervisor(
+            profile,
+            args.filter_files,
+            output_stream=output_stream,
+            report_interval=args.report_interval,
+            drop_retweets=not args.keep_retweets,
+        )
+        run_supervisor(supervisor, output_stream)
+    else:
+        run_stream(profile, args, output_stream)
+    output_stream.close()
+
+def run_supervisor(supervisor, output_stream):
+    def on_sighup(*args):
+        log.info('received SIGHUP, rotating and reloading filters')
+        output_stream.rotate()
+        supervisor.reload_requested = True
+
+    def on_sigterm(*args):
+        log.info('received SIGTERM, stopping')
+        supervisor.stopping = True
+
+    signal.signal(signal.SIGTERM, on_sigterm)
+    signal.signal(signal.SIGHUP, on_sighup)
+    supervisor.run()
+    signal.signal(signal.SIGHUP, signal.SIG_DFL)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+def run_stream(profile, args, output_stream):
+    with open(args.filter_files[0], 'r', encoding='utf8') as fp:
+        filters = yaml.safe_load(fp)
+    twitter = twitter_credentials(profile, credentials_name(filters))
 
     tweet_stream = TweetStream(
-        profile['twitter']['consumer_key'],
-        profile['twitter']['consumer_secret'],
-        profile['twitter']['access_token'],
-        profile['twitter']['access_token_secret'],
+        twitter['consumer_key'],
+        twitter['consumer_secret'],
+        twitter['access_token'],
+        twitter['access_token_secret'],
         output_stream=output_stream,
         report_interval=args.report_interval,
+        drop_retweets=not args.keep_retweets,
     )
 
     def on_sighup(*args):
@@ -101,11 +491,10 @@ def main(cli, args):
     signal.signal(signal.SIGTERM, on_sigterm)
     signal.signal(signal.SIGHUP, on_sighup)
     try:
-        tweet_stream.filter(**filters, stall_warnings=True)
+        tweet_stream.filter(**stream_filters(filters), stall_warnings=True)
     except KeyboardInterrupt:
         log.info('received SIGINT, stopping')
         tweet_stream.disconnect()
 
     signal.signal(signal.SIGHUP, signal.SIG_DFL)
     signal.signal(signal.SIGTERM, signal.SIG_DFL)
-    output_stream.close()
@@ -1,13 +1,51 @@
 from contextlib import ExitStack
+from functools import lru_cache
 import gzip
 import io
+import os
+import re
 import zstandard as zstd
 
+from . import json
+
 log = __import__('logging').getLogger(__name__)
 
-def iter_lines(fp, *, filter_empty_lines=True):
-    dctx = zstd.ZstdDecompressor()
-    stream_reader = dctx.stream_reader(fp)
+@lru_cache(maxsize=None)
+def load_dictionary(path):
+    with open(path, 'rb') as fp:
+        return zstd.ZstdCompressionDict(fp.read())
+
+def compressor(*, level=10, threads=0, long_distance=False, dict_data=None):
+    if threads or long_distance:
+        params = zstd.ZstdCompressionParameters.from_level(
+            level,
+            threads=threads,
+            enable_ldm=long_distance,
+        )
+        return zstd.ZstdCompressor(
+            compression_params=params,
+            dict_data=dict_data,
+        )
+    return zstd.ZstdCompressor(level=level, dict_data=dict_data)
+
+def decompressor(*, dict_data=None):
+    # long distance matching may use windows beyond the default limit
+    return zstd.ZstdDecompressor(
+        dict_data=dict_data,
+        max_window_size=2 ** 31,
+    )
+
+def train_dictionary(samples, *, dict_size=112640, level=10, threads=0):
+    return zstd.train_dictionary(
+        dict_size,
+        list(samples),
+        level=level,
+        threads=threads,
+    )
+
+def iter_lines(fp, *, filter_empty_lines=True, dict_data=None):
+    dctx = decompressor(dict_data=dict_data)
+    stream_reader = dctx.stream_reader(fp, read_across_frames=True)
     stream = io.TextIOWrapper(stream_reader, encoding='utf8')
     for line in stream:
         if filter_empty_lines:
@@ -17,23 +55,293 @@ def iter_lines(fp, *, filter_empty_lines=True):
         else:
             yield line
 
-def writer(fp, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
-    compressor = cctx.stream_writer(fp)
-    return compressor
+def iter_raw_lines(
+    fp,
+    *,
+    offset=None,
+    filter_empty_lines=True,
+    dict_data=None,
+):
+    if offset is not None:
+        fp.seek(offset)
+    dctx = decompressor(dict_data=dict_data)
+    stream_reader = dctx.stream_reader(fp, read_across_frames=True)
+    stream = io.BufferedReader(stream_reader)
+    for line in stream:
+        if filter_empty_lines:
+            line = line.strip()
+            if line:
+                yield line
+        else:
+            yield line
+
+def writer(fp, *, level=10, threads=0, long_distance=False, dict_data=None):
+    cctx = compressor(
+        level=level,
+        threads=threads,
+        long_distance=long_distance,
+        dict_data=dict_data,
+    )
+    return cctx.stream_writer(fp)
+
+# tolerate the ": " separators of json.dumps, which wrote older archives
+status_id_re = re.compile(rb'"id"\s*:\s*(\d+)')
+created_at_re = re.compile(rb'"created_at"\s*:\s*"([^"]*)"')
+
+def index_path_for(path):
+    return f'{path}.idx'
+
+class FramedWriter:
+    """
+    Write records into a zstd stream, closing a frame every
+    ``frame_records`` records or ``frame_bytes`` uncompressed bytes.
+
+    Each frame is described by a line in ``index_fp`` so that readers can
+    seek straight to the frame holding a status without decompressing the
+    frames before it.
+
+    """
+    def __init__(
+        self,
+        fp,
+        index_fp,
+        *,
+        level=10,
+        frame_records=10000,
+        frame_bytes=16 * 1024 * 1024,
+        threads=0,
+        long_distance=False,
+        dict_data=None,
+    ):
+        self.fp = fp
+        self.index_fp = index_fp
+        self.frame_records = frame_records
+        self.frame_bytes = frame_bytes
+        self.num_frames = 0
+        self.writer = writer(
+            fp,
+            level=level,
+            threads=threads,
+            long_distance=long_distance,
+            dict_data=dict_data,
+        )
+        self.start_frame()
+
+    def start_frame(self):
+        self.frame_offset = self.fp.tell()
+        self.num_records = 0
+        self.num_bytes = 0
+        self.first_id = self.last_id = None
+        self.min_id = self.max_id = None
+        self.first_created_at = self.last_created_at = None
+
+    def write_record(self, raw, status=None):
+        if status is not None:
+            status_id = status.get('id')
+            created_at = status.get('created_at')
+        else:
+            m = status_id_re.search(raw)
+            status_id = int(m.group(1)) if m else None
+            m = created_at_re.search(raw)
+            created_at = m.group(1).decode('utf8') if m else None
+
+        if status_id is not None:
+            if self.first_id is None:
+                self.first_id = self.min_id = self.max_id = status_id
+            self.min_id = min(self.min_id, status_id)
+            self.max_id = max(self.max_id, status_id)
+            self.last_id = status_id
+        if created_at is not None:
+            if self.first_created_at is None:
+                self.first_created_at = created_at
+            self.last_created_at = created_at
+
+        self.writer.write(raw)
+        self.writer.write(b'\n')
+        self.num_records += 1
+        self.num_bytes += len(raw) + 1
+
+        if (
+            self.num_records >= self.frame_records
+            or self.num_bytes >= self.frame_bytes
+        ):
+            self.end_frame()
+
+    def end_frame(self):
+        if not self.num_records:
+            return
+        self.writer.flush(zstd.FLUSH_FRAME)
+        offset = self.fp.tell()
+        self.index_fp.write(json.dumps({
+            'offset': self.frame_offset,
+            'length': offset - self.frame_offset,
+            'records': self.num_records,
+            'first_id': self.first_id,
+            'last_id': self.last_id,
+            'min_id': self.min_id,
+            'max_id': self.max_id,
+            'first_created_at': self.first_created_at,
+            'last_created_at': self.last_created_at,
+        }) + b'\n')
+        self.index_fp.flush()
+        self.num_frames += 1
+        self.start_frame()
 
-def concat_streams(out_fp, streams, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
-    dctx = zstd.ZstdDecompressor()
+    def flush_block(self):
+        # make everything written so far decodable without ending the frame
+        self.writer.flush(zstd.FLUSH_BLOCK)
+
+    def flush(self):
+        self.end_frame()
+
+    def close(self):
+        self.end_frame()
+        self.writer.close()
+
+def read_index(path):
+    index = []
+    with open(index_path_for(path), 'rb') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                index.append(json.loads(line))
+    return index
+
+def read_frame(fp, entry, *, dict_data=None):
+    fp.seek(entry['offset'])
+    data = fp.read(entry['length'])
+    dctx = decompressor(dict_data=dict_data)
+    return dctx.decompressobj().decompress(data)
+
+def iter_frame_lines(fp, entry, *, dict_data=None):
+    for line in read_frame(fp, entry, dict_data=dict_data).split(b'\n'):
+        if line:
+            yield line
+
+def find_status(path, status_id, *, index=None, dict_data=None):
+    if index is None:
+        index = read_index(path)
+    with open(path, 'rb') as fp:
+        for entry in index:
+            if entry['min_id'] is None:
+                continue
+            if not entry['min_id'] <= status_id <= entry['max_id']:
+                continue
+            for line in iter_frame_lines(fp, entry, dict_data=dict_data):
+                m = status_id_re.search(line)
+                if m and int(m.group(1)) == status_id:
+                    return line
+
+class RecoveryStats:
+    def __init__(self):
+        self.frames = 0
+        self.records = 0
+        self.truncated = False
+        self.bytes_discarded = 0
+
+def iter_recovered_lines(
+    fp,
+    *,
+    dict_data=None,
+    chunk_size=1024 * 1024,
+    stats=None,
+):
+    """
+    Yield every complete line of a possibly truncated or corrupt zstd file.
+
+    Complete frames are always recovered. Of a frame that was cut short
+    only the lines in blocks that were flushed before the truncation can
+    be recovered, the trailing partial line is discarded.
+
+    """
+    if stats is None:
+        stats = RecoveryStats()
+    dctx = decompressor(dict_data=dict_data)
+    dobj = dctx.decompressobj()
+    in_frame = False
+    buffer = b''
+    pending = b''
+    while True:
+        if not pending:
+            pending = fp.read(chunk_size)
+            if not pending:
+                break
+        try:
+            buffer += dobj.decompress(pending)
+        except zstd.ZstdError:
+            log.warning(f'stopping at corrupt data after {stats.frames} frames')
+            break
+        in_frame = True
+        pending = b''
+
+        *lines, buffer = buffer.split(b'\n')
+        for line in lines:
+            if line:
+                stats.records += 1
+                yield line
+
+        if dobj.eof:
+            stats.frames += 1
+            if buffer:
+                # frames written by sos always end with a newline
+                stats.records += 1
+                yield buffer
+                buffer = b''
+            pending = dobj.unused_data
+            dobj = dctx.decompressobj()
+            in_frame = False
+
+    stats.truncated = in_frame
+    stats.bytes_discarded = len(buffer)
+
+def main_recover(cli, args):
+    dict_data = None
+    if args.input_dictionary:
+        dict_data = load_dictionary(args.input_dictionary)
+    cctx = compressor_from_args(args)
+    stats = RecoveryStats()
+    with ExitStack() as stack:
+        out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
+        in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
+        with cctx.stream_writer(out_fp, closefd=False) as writer:
+            for line in iter_recovered_lines(
+                in_fp, dict_data=dict_data, stats=stats,
+            ):
+                writer.write(line)
+                writer.write(b'\n')
+    log.info(
+        f'recovered {stats.records} records from {stats.frames} complete '
+        f'frames, truncated={stats.truncated} '
+        f'discarded_bytes={stats.bytes_discarded}'
+    )
+
+def main_find(cli, args):
+    dict_data = load_dictionary(args.dictionary) if args.dictionary else None
+    for path in args.files:
+        if not os.path.exists(index_path_for(path)):
+            log.warning(f'skipping unindexed path={path}')
+            continue
+        line = find_status(path, args.status_id, dict_data=dict_data)
+        if line is not None:
+            cli.out(line.decode('utf8'))
+            return
+    cli.abort(f'status={args.status_id} not found')
+
+def concat_streams(out_fp, streams, *, cctx=None, dctx=None):
+    if cctx is None:
+        cctx = compressor()
+    if dctx is None:
+        dctx = decompressor()
     bytes_out = 0
     for stream in streams:
-        with dctx.stream_reader(stream) as reader:
+        with dctx.stream_reader(stream, read_across_frames=True) as reader:
             _, write_bytes = cctx.copy_stream(reader, out_fp)
             bytes_out += write_bytes
     return bytes_out
 
-def compress_streams(out_fp, streams, *, level=10):
-    cctx = zstd.ZstdCompressor(level=level)
+def compress_streams(out_fp, streams, *, cctx=None):
+    if cctx is None:
+        cctx = compressor()
     bytes_in, bytes_out = 0, 0
     for stream in streams:
         read_bytes, write_bytes = cctx.copy_stream(stream, out_fp)
@@ -41,34 +349,54 @@ def compress_streams(out_fp, streams, *, level=10):
         bytes_out += write_bytes
     return bytes_in, bytes_out
 
+def compressor_from_args(args):
+    dict_data = None
+    if getattr(args, 'dictionary', None):
+        dict_data = load_dictionary(args.dictionary)
+    return compressor(
+        level=args.level,
+        threads=args.threads,
+        long_distance=args.long,
+        dict_data=dict_data,
+    )
+
+def decompressor_from_args(args, *, name='dictionary'):
+    dict_data = None
+    if getattr(args, name, None):
+        dict_data = load_dictionary(getattr(args, name))
+    return decompressor(dict_data=dict_data)
+
 def main_concat(cli, args):
+    cctx = compressor_from_args(args)
+    dctx = decompressor_from_args(args, name='input_dictionary')
     with cli.output_file(args.output_file, text=False) as out_fp:
         def streams():
             for path in args.input_files:
-                log.debug('concatenating stream="{path}"')
+                log.debug(f'concatenating stream="{path}"')
                 with cli.input_file(path, text=False) as in_fp:
                     yield in_fp
         stream_iter = streams()
-        bytes_out = concat_streams(out_fp, stream_iter, level=args.level)
+        bytes_out = concat_streams(out_fp, stream_iter, cctx=cctx, dctx=dctx)
     log.info(f'wrote {bytes_out} bytes')
 
 def main_compress(cli, args):
+    cctx = compressor_from_args(args)
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
 
-        bytes_in, bytes_out = compress_streams(out_fp, [in_fp], level=args.level)
+        bytes_in, bytes_out = compress_streams(out_fp, [in_fp], cctx=cctx)
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
         f'ratio={bytes_out / bytes_in}'
     )
 
 def main_decompress(cli, args):
+    dctx = decompressor_from_args(args)
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
 
-        dctx = zstd.ZstdDecompressor()
         bytes_in, bytes_out = dctx.copy_stream(in_fp, out_fp)
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
@@ -76,13 +404,38 @@ def main_decompress(cli, args):
     )
 
 def main_from_gz(cli, args):
+    cctx = compressor_from_args(args)
     with ExitStack() as stack:
         out_fp = stack.enter_context(cli.output_file(args.output_file, text=False))
         in_fp = stack.enter_context(cli.input_file(args.input_file, text=False))
         gz_in_fp = stack.enter_context(gzip.open(in_fp, mode='rb'))
 
-        bytes_in, bytes_out = compress_streams(out_fp, [gz_in_fp])
+        bytes_in, bytes_out = compress_streams(out_fp, [gz_in_fp], cctx=cctx)
     log.info(
         f'read {bytes_in} bytes, wrote {bytes_out} bytes, '
         f'ratio={bytes_out / bytes_in}'
     )
+
+def main_train_dictionary(cli, args):
+    def samples():
+        num_samples = 0
+        for path in args.input_files:
+            with cli.input_file(path, text=False) as in_fp:
+                for line in iter_raw_lines(in_fp):
+                    yield line
+                    num_samples += 1
+                    if num_samples >= args.max_samples:
+                        return
+
+    dict_data = train_dictionary(
+        samples(),
+        dict_size=args.dict_size,
+        level=args.level,
+        threads=args.threads,
+    )
+    with cli.output_file(args.output_file, text=False) as out_fp:
+        out_fp.write(dict_data.as_bytes())
+    log.info(
+        f'wrote dictionary id={dict_data.dict_id()} '
+        f'of {len(dict_data)} bytes'
+    )
@@ -0,0 +1,105 @@
+import argparse
+from collections import deque
+from datetime import timedelta
+import pika
+import subparse
+
+from sos import commands
+from sos.cli import context_factory
+
+def command_args(*argv):
+    """
+    Parse ``argv`` with the options of the ``sos`` commands, so tests run a
+    command's ``main`` with the same defaults as the command line.
+
+    """
+    cli = subparse.CLI(prog='sos', context_factory=context_factory)
+    cli.add_generic_options(commands.generic_options)
+    cli.load_commands(commands)
+    _, args = subparse.parse_args(cli, [str(arg) for arg in argv])
+    return args
+
+def archive_args(**kw):
+    # the output stream options are unused as the stream is passed in
+    args = argparse.Namespace(
+        queue='test',
+        report_interval=timedelta(seconds=5),
+        prefetch=None,
+        ack_batch_size=1,
+        ack_interval=timedelta(seconds=1),
+        output_path_prefix=None,
+        sqlite_path=None,
+        dedupe_path=None,
+        fanout_spill_path_prefix=None,
+    )
+    vars(args).update(kw)
+    return args
+
+class FakeConsumerConnection:
+    """
+    Stands in for the ``pika.BlockingConnection`` consumed by
+    ``mq:archive``, delivering ``messages`` and then stopping.
+
+    Acks and nacks are recorded. With ``redeliver`` the messages nacked with
+    ``requeue`` are delivered again, flagged as redelivered, before stopping.
+
+    """
+    def __init__(self, messages, *, redeliver=False):
+        self.queue = deque((body, False) for body in messages)
+        self.redeliver = redeliver
+        self.unacked = {}
+        self.next_delivery_tag = 1
+        self.acks = []
+        self.nacks = []
+        self.on_message = None
+        self.stopped = False
+
+    def channel(self):
+        return self
+
+    def queue_declare(self, queue):
+        pass
+
+    def basic_qos(self, prefetch_count):
+        pass
+
+    def basic_consume(self, queue, on_message):
+        self.on_message = on_message
+
+    def settle(self, delivery_tag, multiple):
+        tags = [
+            tag for tag in self.unacked
+            if tag == delivery_tag or (multiple and tag < delivery_tag)
+        ]
+        return [self.unacked.pop(tag) for tag in sorted(tags)]
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acks.append((delivery_tag, multiple))
+        self.settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag, multiple=False, requeue=True):
+        self.nacks.append((delivery_tag, multiple))
+        bodies = self.settle(delivery_tag, multiple)
+        if requeue and self.redeliver:
+            self.queue.extend((body, True) for body in bodies)
+
+    def call_later(self, delay, callback):
+        pass
+
+    def start_consuming(self):
+        while self.queue and not self.stopped:
+            body, redelivered = self.queue.popleft()
+            delivery_tag = self.next_delivery_tag
+            self.next_delivery_tag += 1
+            self.unacked[delivery_tag] = body
+            method_frame = pika.spec.Basic.Deliver(
+                delivery_tag=delivery_tag,
+                redelivered=redelivered,
+            )
+            self.on_message(self, method_frame, None, body)
+
+    def stop_consuming(self):
+        self.stopped = True
+
+    def close(self):
+        pass
@@ -0,0 +1,57 @@
+import asyncio
+import pytest
+
+from sos.output_streams.async_rabbitmq import AsyncRabbitMqOutputStream
+from sos.output_streams.rabbitmq import UnconfirmedDeliveryError
+
+class FakeExchange:
+    def __init__(self):
+        self.bodies = []
+        self.fail = 0
+
+    async def publish(self, message, routing_key, **kw):
+        if self.fail:
+            self.fail -= 1
+            raise ConnectionError('connection lost')
+        self.bodies.append(message.body)
+
+class FakeAsyncRabbitMqOutputStream(AsyncRabbitMqOutputStream):
+    def __init__(self, exchange, **kw):
+        super().__init__('amqp://', '', 'test', **kw)
+        self.fake_exchange = exchange
+
+    async def connect(self):
+        return self.fake_exchange
+
+    async def disconnect(self):
+        pass
+
+def test_failed_publish_is_retried_by_the_next_message():
+    async def main():
+        exchange = FakeExchange()
+        stream = FakeAsyncRabbitMqOutputStream(exchange, max_unconfirmed=1)
+        exchange.fail = 1
+        await stream.on_raw(b'1')
+        await stream.on_raw(b'2')
+        assert sorted(exchange.bodies) == [b'1', b'2']
+        assert stream.failed == []
+
+    asyncio.run(main())
+
+def test_persistent_failure_raises_promptly():
+    async def main():
+        exchange = FakeExchange()
+        stream = FakeAsyncRabbitMqOutputStream(exchange, max_unconfirmed=1)
+        exchange.fail = 4
+        # the first failure is found waiting on its confirm, retried and
+        # fails again
+        with pytest.raises(UnconfirmedDeliveryError):
+            await stream.on_raw(b'1')
+        assert stream.failed == [b'1']
+
+        with pytest.raises(UnconfirmedDeliveryError):
+            await stream.on_raw(b'2')
+        await stream.close()
+        assert sorted(exchange.bodies) == [b'1', b'2']
+
+    asyncio.run(main())
@@ -0,0 +1,127 @@
+import asyncio
+import pytest
+
+from fakes import FakeConsumerConnection, archive_args
+from sos import mq_archiver
+from sos.output_streams import (
+    AsyncDedupeOutputStream,
+    CompositeOutputStream,
+    DedupeOutputStream,
+)
+
+class FailOnceOutputStream:
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.lines = []
+
+    def on_raw(self, raw, status=None):
+        if raw in self.fail_on:
+            self.fail_on.discard(raw)
+            raise ValueError(raw)
+        self.lines.append(raw)
+
+class AsyncFailOnceOutputStream(FailOnceOutputStream):
+    async def on_raw(self, raw, status=None):
+        super().on_raw(raw, status)
+
+    async def flush(self):
+        pass
+
+class BufferedOutputStream:
+    """
+    Only keeps what was written once a flush succeeds, a failed flush loses
+    what it buffered.
+
+    """
+    def __init__(self, fail_flushes=()):
+        self.fail_flushes = set(fail_flushes)
+        self.num_flushes = 0
+        self.buffered = []
+        self.lines = []
+
+    def on_raw(self, raw, status=None):
+        self.buffered.append(raw)
+
+    def flush(self):
+        self.num_flushes += 1
+        buffered, self.buffered = self.buffered, []
+        if self.num_flushes in self.fail_flushes:
+            raise RuntimeError('flush failed')
+        self.lines.extend(buffered)
+
+    def rotate(self):
+        self.flush()
+
+    def close(self):
+        self.flush()
+
+def test_failed_write_is_not_remembered():
+    inner = FailOnceOutputStream(fail_on={b'{"id":2}'})
+    stream = DedupeOutputStream(inner)
+    for raw in (b'{"id":1}', b'{"id":2}'):
+        try:
+            stream.on_raw(raw)
+        except ValueError:
+            pass
+    for raw in (b'{"id":1}', b'{"id":2}'):
+        stream.on_raw(raw)
+    assert inner.lines == [b'{"id":1}', b'{"id":2}']
+    assert stream.num_duplicates == 1
+
+def test_async_failed_write_is_not_remembered():
+    async def main():
+        inner = AsyncFailOnceOutputStream(fail_on={b'{"id":2}'})
+        stream = AsyncDedupeOutputStream(inner)
+        with pytest.raises(ValueError):
+            await stream.on_raw(b'{"id":2}')
+        await stream.on_raw(b'{"id":2}')
+        await stream.on_raw(b'{"id":2}')
+        assert inner.lines == [b'{"id":2}']
+        assert stream.num_duplicates == 1
+
+    asyncio.run(main())
+
+def test_ids_are_forgotten_when_the_flush_fails():
+    inner = BufferedOutputStream(fail_flushes={1})
+    stream = DedupeOutputStream(inner)
+    stream.on_raw(b'{"id":1}')
+    stream.on_raw(b'{"id":1}')
+    with pytest.raises(RuntimeError):
+        stream.flush()
+    stream.on_raw(b'{"id":1}')
+    stream.flush()
+    stream.on_raw(b'{"id":1}')
+    stream.close()
+    assert inner.lines == [b'{"id":1}']
+    assert stream.num_duplicates == 2
+
+def test_requeued_statuses_are_written_when_redelivered():
+    inner = BufferedOutputStream(fail_flushes={1})
+    stream = DedupeOutputStream(CompositeOutputStream([inner], queue_size=10))
+    messages = [b'{"id":%d}' % n for n in range(1, 5)]
+    connection = FakeConsumerConnection(messages, redeliver=True)
+    mq_archiver.consume(
+        {},
+        archive_args(ack_batch_size=2),
+        connection=connection,
+        output_stream=stream,
+    )
+    assert connection.nacks == [(2, True)]
+    assert connection.acks == [(4, True), (6, True)]
+    assert sorted(inner.lines) == messages
+    assert stream.num_duplicates == 0
+
+def test_async_ids_are_pending_until_flushed():
+    async def main():
+        inner = AsyncFailOnceOutputStream()
+        stream = AsyncDedupeOutputStream(inner)
+        await stream.on_raw(b'{"id":1}')
+        await stream.on_raw(b'{"id":1}')
+        assert stream.pending == {1}
+        await stream.flush()
+        assert stream.pending == set()
+        assert stream.current == {1}
+        assert inner.lines == [b'{"id":1}']
+        assert stream.num_duplicates == 1
+
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+import json as stdlib_json
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pytest
+
+from fakes import command_args
+from sos import export, zstd
+from sos.bench import sample_status
+from sos.cli import App
+
+statuses = [sample_status(n) for n in range(5)]
+statuses[3]['in_reply_to_status_id'] = statuses[1]['id']
+
+def write_archive(path, lines, *, dict_data=None):
+    with open(path, 'wb') as fp:
+        writer = zstd.writer(fp, dict_data=dict_data)
+        for line in lines:
+            writer.write(line + b'\n')
+        writer.close()
+
+def status_lines():
+    return [stdlib_json.dumps(status).encode('utf8') for status in statuses]
+
+def run_export(*argv):
+    args = command_args('archive:export', *argv)
+    export.main(App(args.profile), args)
+
+def assert_exported(table, *, include_json=False):
+    assert table.column('id').to_pylist() == [s['id'] for s in statuses]
+    assert table.column('user_sn').to_pylist() \
+        == [s['user']['screen_name'] for s in statuses]
+    assert table.column('in_reply_to_status_id').to_pylist() \
+        == [s['in_reply_to_status_id'] for s in statuses]
+    assert ('json' in table.column_names) == include_json
+
+@pytest.mark.parametrize('include_json', [False, True])
+def test_parquet_export_round_trip(tmp_path, include_json):
+    path = tmp_path / 'in.zstd'
+    lines = status_lines()
+    # invalid lines are skipped rather than failing the export
+    write_archive(path, lines[:2] + [b'{"id":', b'{"id":7}'] + lines[2:])
+    out = tmp_path / 'out.parquet'
+    argv = [path, '-o', out, '--row-group-size', 2]
+    if include_json:
+        argv.append('--include-json')
+    run_export(*argv)
+
+    parquet_file = pq.ParquetFile(out)
+    assert parquet_file.metadata.num_row_groups == 3
+    table = parquet_file.read()
+    assert_exported(table, include_json=include_json)
+    if include_json:
+        assert [
+            stdlib_json.loads(line) for line in table.column('json').to_pylist()
+        ] == statuses
+
+def test_arrow_export_of_several_files(tmp_path):
+    lines = status_lines()
+    paths = [tmp_path / 'a.zstd', tmp_path / 'b.zstd']
+    write_archive(paths[0], lines[:3])
+    write_archive(paths[1], lines[3:])
+    out = tmp_path / 'out.arrow'
+    run_export(*paths, '-o', out, '--format', 'arrow')
+
+    with pa.ipc.open_file(out) as reader:
+        assert_exported(reader.read_all())
+
+def test_export_with_a_dictionary(tmp_path):
+    lines = status_lines()
+    dict_path = tmp_path / 'statuses.dict'
+    samples = [
+        stdlib_json.dumps(sample_status(n)).encode('utf8') for n in range(1000)
+    ]
+    dict_data = zstd.train_dictionary(samples, dict_size=4096)
+    dict_path.write_bytes(dict_data.as_bytes())
+    path = tmp_path / 'in.zstd'
+    write_archive(path, lines, dict_data=zstd.load_dictionary(dict_path))
+    out = tmp_path / 'out.parquet'
+    run_export(path, '-o', out, '--dictionary', dict_path)
+
+    assert_exported(pq.read_table(out))
@@ -0,0 +1,136 @@
+from datetime import timedelta
+import os
+import pytest
+
+from sos import recompact, zstd
+from sos.mq_replay import read_unit, units_for_file
+from sos.output_streams import FileOutputStream
+
+def lines_of(path):
+    return [
+        line
+        for unit in units_for_file(path)
+        for line in read_unit(unit)
+    ]
+
+def archive_paths(tmp_path):
+    return sorted(str(path) for path in tmp_path.glob('out.*.zstd'))
+
+def test_files_are_rotated_after_rotate_records(tmp_path):
+    stream = FileOutputStream(str(tmp_path / 'out'), rotate_records=3)
+    lines = [b'{"id":%d}' % n for n in range(7)]
+    for line in lines:
+        stream.on_raw(line)
+    stream.close()
+    paths = archive_paths(tmp_path)
+    assert len(paths) == 3
+    # files rotated within the same second sort apart from their order
+    assert sorted(line for path in paths for line in lines_of(path)) \
+        == sorted(lines)
+
+def test_closed_files_are_compacted_with_their_index(tmp_path):
+    stream = FileOutputStream(
+        str(tmp_path / 'out'),
+        frame_records=2,
+        rotate_records=5,
+        compact_level=19,
+    )
+    lines = [b'{"id":%d}' % n for n in range(10)]
+    for line in lines:
+        stream.on_raw(line)
+    stream.close()
+    paths = archive_paths(tmp_path)
+    assert len(paths) == 2
+    for path in paths:
+        assert len(zstd.read_index(path)) == 3
+    # files rotated within the same second sort apart from their order
+    assert sorted(line for path in paths for line in lines_of(path)) \
+        == sorted(lines)
+    assert os.listdir(tmp_path / '.compact') == []
+
+def write_archive(path, lines, *, frame_records=None):
+    with open(path, 'wb') as fp:
+        if frame_records:
+            with open(zstd.index_path_for(path), 'wb') as index_fp:
+                writer = zstd.FramedWriter(
+                    fp, index_fp, frame_records=frame_records)
+                for line in lines:
+                    writer.write_record(line)
+                writer.close()
+        else:
+            writer = zstd.writer(fp)
+            for line in lines:
+                writer.write(line + b'\n')
+            writer.close()
+
+def test_compacting_without_frames_drops_the_old_index(tmp_path):
+    path = str(tmp_path / 'out.zstd')
+    lines = [b'{"id":%d}' % n for n in range(10)]
+    write_archive(path, lines, frame_records=3)
+    recompact.compact_file(path, level=19)
+    assert not os.path.exists(zstd.index_path_for(path))
+    assert lines_of(path) == lines
+
+def test_crash_while_compacting_leaves_no_stale_index(tmp_path, monkeypatch):
+    path = str(tmp_path / 'out.zstd')
+    lines = [b'{"id":%d}' % n for n in range(10)]
+    write_archive(path, lines, frame_records=3)
+
+    def replace(src, dst):
+        raise KeyboardInterrupt
+
+    monkeypatch.setattr(recompact.os, 'replace', replace)
+    with pytest.raises(KeyboardInterrupt):
+        recompact.compact_file(path, level=19, frame_records=5)
+    # the old archive is still there and read whole
+    assert not os.path.exists(zstd.index_path_for(path))
+    assert lines_of(path) == lines
+
+def recovered(path):
+    stats = zstd.RecoveryStats()
+    with open(path, 'rb') as fp:
+        lines = list(zstd.iter_recovered_lines(fp, stats=stats))
+    return lines, stats
+
+def test_flush_records_makes_records_recoverable(tmp_path):
+    stream = FileOutputStream(str(tmp_path / 'out'), flush_records=2)
+    lines = [b'{"id":%d}' % n for n in range(5)]
+    for line in lines:
+        stream.on_raw(line)
+    # the process dies here, only what was flushed is in the file
+    recovered_lines, stats = recovered(stream.path)
+    assert recovered_lines == lines[:4]
+    assert stats.truncated
+    stream.close()
+
+def test_flush_interval_flushes_every_record(tmp_path):
+    stream = FileOutputStream(
+        str(tmp_path / 'out'), flush_interval=timedelta(0))
+    lines = [b'{"id":%d}' % n for n in range(3)]
+    for line in lines:
+        stream.on_raw(line)
+    assert recovered(stream.path)[0] == lines
+    stream.close()
+
+def test_flush_frames_writes_complete_frames(tmp_path):
+    stream = FileOutputStream(
+        str(tmp_path / 'out'), frame_records=2, flush_frames=True)
+    lines = [b'{"id":%d}' % n for n in range(5)]
+    for line in lines:
+        stream.on_raw(line)
+    recovered_lines, stats = recovered(stream.path)
+    assert recovered_lines == lines[:4]
+    assert stats.frames == 2
+    stream.close()
+
+def test_truncated_archive_recovers_complete_frames(tmp_path):
+    path = str(tmp_path / 'out.zstd')
+    lines = [b'{"id":%d}' % n for n in range(10)]
+    write_archive(path, lines, frame_records=3)
+    last_frame = zstd.read_index(path)[-1]
+    with open(path, 'r+b') as fp:
+        fp.truncate(last_frame['offset'] + last_frame['length'] // 2)
+    recovered_lines, stats = recovered(path)
+    assert recovered_lines == lines[:9]
+    assert stats.frames == 3
+    assert stats.truncated
@@ -0,0 +1,122 @@
+import asyncio
+import pytest
+
+from sos import json
+from sos.bench import sample_status
+from sos.output_streams import GCPFirestoreOutputStream
+from sos.output_streams.async_gcp_firestore import AsyncGCPFirestoreOutputStream
+
+class FakeClient:
+    """
+    Stores documents by name. Batches fail while any of their documents is
+    in ``fail_on`` and so do writes of those documents.
+
+    """
+    def __init__(self):
+        self.docs = {}
+        self.fail_on = set()
+        self.num_commits = 0
+
+    def collection(self, name):
+        return self
+
+    def document(self, name):
+        return FakeDocument(self, name)
+
+    def batch(self):
+        return FakeBatch(self)
+
+class FakeDocument:
+    def __init__(self, client, id):
+        self.client = client
+        self.id = id
+
+    def set(self, data):
+        if self.id in self.client.fail_on:
+            raise RuntimeError(f'failed to write {self.id}')
+        self.client.docs[self.id] = data
+
+class FakeBatch:
+    def __init__(self, client):
+        self.client = client
+        self.docs = []
+
+    def set(self, doc, data):
+        self.docs.append((doc, data))
+
+    def commit(self):
+        if any(doc.id in self.client.fail_on for doc, data in self.docs):
+            raise RuntimeError('failed to commit')
+        self.client.num_commits += 1
+        for doc, data in self.docs:
+            self.client.docs[doc.id] = data
+
+class FakeAsyncDocument(FakeDocument):
+    async def set(self, data):
+        super().set(data)
+
+class FakeAsyncBatch(FakeBatch):
+    async def commit(self):
+        super().commit()
+
+class FakeAsyncClient(FakeClient):
+    def document(self, name):
+        return FakeAsyncDocument(self, name)
+
+    def batch(self):
+        return FakeAsyncBatch(self)
+
+def doc_name(status):
+    user = status['user']
+    return f'{status["id"]}-{user["id"]}-{user["screen_name"]}'
+
+def test_flush_commits_a_batch():
+    client = FakeClient()
+    stream = GCPFirestoreOutputStream(collection='c', client=client)
+    statuses = [sample_status(n) for n in range(3)]
+    for status in statuses:
+        stream.on_raw(json.dumps(status))
+    assert client.docs == {}
+    stream.flush()
+    assert client.num_commits == 1
+    assert sorted(client.docs) == sorted(map(doc_name, statuses))
+    assert json.loads(client.docs[doc_name(statuses[0])]['json']) == statuses[0]
+
+def test_flush_keeps_failed_documents():
+    client = FakeClient()
+    stream = GCPFirestoreOutputStream(collection='c', client=client)
+    statuses = [sample_status(n) for n in range(3)]
+    client.fail_on.add(doc_name(statuses[1]))
+    for status in statuses:
+        stream.on_status(status)
+    with pytest.raises(RuntimeError):
+        stream.flush()
+    # the other documents were written one at a time
+    assert sorted(client.docs) == sorted(
+        doc_name(status) for status in statuses if status is not statuses[1])
+
+    client.fail_on.clear()
+    stream.flush()
+    assert sorted(client.docs) == sorted(map(doc_name, statuses))
+    assert stream.pending == []
+
+def test_async_flush_keeps_failed_documents():
+    async def main():
+        client = FakeAsyncClient()
+        stream = AsyncGCPFirestoreOutputStream(
+            collection='c', client=client, batch_size=2)
+        statuses = [sample_status(n) for n in range(5)]
+        client.fail_on.add(doc_name(statuses[1]))
+        # the first two are written in the background as a full batch
+        for status in statuses:
+            await stream.on_status(status)
+        with pytest.raises(RuntimeError):
+            await stream.flush()
+        assert doc_name(statuses[1]) not in client.docs
+        assert len(client.docs) == 4
+
+        client.fail_on.clear()
+        await stream.flush()
+        assert sorted(client.docs) == sorted(map(doc_name, statuses))
+
+    asyncio.run(main())
@@ -0,0 +1,68 @@
+import asyncio
+import httpx
+import pytest
+
+from sos.bench import FakeStorageClient, sample_status
+from sos.output_streams import GCPImageStorageOutputStream
+from sos.output_streams.async_gcp_image_storage import (
+    AsyncGCPImageStorageOutputStream,
+)
+
+def status_with_media(n):
+    status = sample_status(n)
+    media = [{
+        'id': n,
+        'id_str': str(n),
+        'media_url_https': f'https://pbs.twimg.com/media/{n}.jpg',
+        'type': 'photo',
+    }]
+    status['entities']['media'] = media
+    status['extended_entities'] = {'media': media}
+    return status
+
+def handler(request):
+    if request.url.path.endswith('/2.jpg'):
+        return httpx.Response(404, content=b'not found')
+    return httpx.Response(200, content=b'jpeg')
+
+def test_flush_raises_failed_downloads():
+    client = FakeStorageClient(rtt=0)
+    stream = GCPImageStorageOutputStream(
+        bucket='b',
+        prefix='',
+        client=client,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+    )
+    for n in (1, 2, 3):
+        stream.on_status(status_with_media(n))
+    with pytest.raises(RuntimeError):
+        stream.flush()
+    # the error page was not stored
+    assert client.num_uploads == 2
+
+    # the failure is only reported once
+    stream.on_status(status_with_media(4))
+    stream.close()
+    assert client.num_uploads == 3
+
+def test_async_flush_raises_failed_downloads():
+    async def main():
+        client = FakeStorageClient(rtt=0)
+        stream = AsyncGCPImageStorageOutputStream(
+            bucket='b',
+            prefix='',
+            client=client,
+            http_client=httpx.AsyncClient(
+                transport=httpx.MockTransport(handler)),
+        )
+        for n in (1, 2, 3):
+            await stream.on_status(status_with_media(n))
+        with pytest.raises(RuntimeError):
+            await stream.flush()
+        assert client.num_uploads == 2
+
+        await stream.on_status(status_with_media(4))
+        await stream.close()
+        assert client.num_uploads == 3
+
+    asyncio.run(main())
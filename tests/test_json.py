@@ -0,0 +1,23 @@
+import pytest
+
+from sos import json
+
+@pytest.fixture(params=['orjson', 'stdlib'])
+def backend(request):
+    json.use(request.param)
+    yield request.param
+    json.use('auto')
+
+def test_lone_surrogate_round_trips(backend):
+    status = json.loads(b'{"id":1,"text":"truncated \\ud83d"}')
+    assert status['text'] == 'truncated \ud83d'
+    data = json.dumps(status)
+    assert json.loads(data) == status
+
+def test_dumps_is_compact_utf8(backend):
+    assert json.dumps({'text': 'caf\xe9', 'id': 1}) == (
+        '{"text":"caf\xe9","id":1}'.encode('utf8'))
+
+def test_invalid_json_raises(backend):
+    with pytest.raises(ValueError):
+        json.loads(b'{"id":')
@@ -0,0 +1,62 @@
+import httpx
+
+from sos.bench import FakeStorageClient
+from sos.media import MediaCache, media_info_from_status
+from sos.output_streams import GCPImageStorageOutputStream
+
+from test_gcp_image_storage import handler, status_with_media
+
+def media_info(n):
+    info, = media_info_from_status(status_with_media(n))
+    return info
+
+def test_only_stored_media_is_persisted(tmp_path):
+    path = str(tmp_path / 'media.db')
+    cache = MediaCache(path=path)
+    cache.add(media_info(1))
+    cache.add(media_info(2))
+    cache.stored(media_info(2))
+    assert cache.get(media_info(1)) == media_info(1)['name']
+    cache.close()
+
+    # media that was in flight when the process stopped is fetched again
+    cache = MediaCache(path=path)
+    assert cache.get(media_info(1)) is None
+    assert cache.get(media_info(2)) == media_info(2)['name']
+    assert (cache.hits, cache.misses) == (1, 1)
+    cache.close()
+
+def test_discarded_media_is_fetched_again():
+    cache = MediaCache(max_size=2)
+    cache.add(media_info(1))
+    cache.discard(media_info(1))
+    assert cache.get(media_info(1)) is None
+
+    for n in (2, 3, 4):
+        cache.stored(media_info(n))
+    # the least recently used entry is evicted
+    assert cache.get(media_info(2)) is None
+    assert cache.get(media_info(4)) == media_info(4)['name']
+
+def test_failed_uploads_are_not_persisted(tmp_path):
+    path = str(tmp_path / 'media.db')
+    client = FakeStorageClient(rtt=0)
+    stream = GCPImageStorageOutputStream(
+        bucket='b',
+        prefix='',
+        client=client,
+        http_client=httpx.Client(transport=httpx.MockTransport(handler)),
+        media_cache=MediaCache(path=path),
+    )
+    for n in (1, 2, 1):
+        stream.on_status(status_with_media(n))
+    try:
+        stream.close()
+    except RuntimeError:
+        pass
+    assert client.num_uploads == 1
+
+    cache = MediaCache(path=path)
+    assert cache.get(media_info(1)) is not None
+    assert cache.get(media_info(2)) is None
+    cache.close()
@@ -0,0 +1,37 @@
+import threading
+
+from sos import json, metrics
+
+def test_concurrent_updates_are_counted():
+    counter = metrics.counter('sos_test_updates_total', 'Test updates.')
+    histogram = metrics.histogram('sos_test_update_seconds', 'Test updates.')
+
+    def run():
+        for _ in range(10000):
+            counter.inc()
+            histogram.observe(0.001)
+
+    threads = [threading.Thread(target=run) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert counter.value == 40000
+    assert histogram.count == 40000
+    assert sum(histogram.counts) == 40000
+
+def test_reset_disables_and_zeroes():
+    counter = metrics.counter('sos_test_reset_total', 'Test resets.')
+    counter.inc(3)
+    metrics.enabled = True
+    json.instrument(metrics.histogram('sos_test_loads_seconds', 'Test loads.'))
+    try:
+        assert json.loads is not json._orjson_loads
+        metrics.reset()
+        assert not metrics.enabled
+        assert counter.value == 0
+        # loads is no longer timed
+        assert json.loads in (json._orjson_loads, json._stdlib_loads)
+        assert metrics.snapshot()['sos_test_reset_total'] == 0
+    finally:
+        metrics.reset()
@@ -0,0 +1,132 @@
+from datetime import timedelta
+import pytest
+import signal
+import threading
+
+from fakes import FakeConsumerConnection, archive_args
+from sos import mq_archiver
+from sos.cli import AbortCLI
+
+class FailingFlushOutputStream:
+    def __init__(self, fail_flushes):
+        self.fail_flushes = fail_flushes
+        self.num_flushes = 0
+
+    def on_raw(self, raw, status=None):
+        pass
+
+    def flush(self):
+        self.num_flushes += 1
+        if self.num_flushes in self.fail_flushes:
+            raise RuntimeError('flush failed')
+
+    def close(self):
+        pass
+
+def consume(messages, output_stream):
+    connection = FakeConsumerConnection(messages)
+    mq_archiver.consume(
+        {},
+        archive_args(ack_batch_size=2),
+        connection=connection,
+        output_stream=output_stream,
+    )
+    return connection
+
+def test_failed_flush_requeues_instead_of_acking():
+    connection = consume(
+        [b'{"id":1}', b'{"id":2}', b'{"id":3}', b'{"id":4}'],
+        FailingFlushOutputStream(fail_flushes={1}),
+    )
+    assert connection.nacks == [(2, True)]
+    assert connection.acks == [(4, True)]
+
+def test_successful_flushes_ack():
+    connection = consume(
+        [b'{"id":1}', b'{"id":2}', b'{"id":3}'],
+        FailingFlushOutputStream(fail_flushes=()),
+    )
+    assert connection.nacks == []
+    assert connection.acks == [(2, True), (3, True)]
+
+class FakeCLI:
+    profile = {}
+
+    def abort(self, error, code=1):
+        raise AbortCLI(error, code)
+
+def test_prefetch_below_ack_batch_size_is_rejected():
+    with pytest.raises(AbortCLI):
+        mq_archiver.main(FakeCLI(), archive_args(prefetch=10, ack_batch_size=100))
+
+class FakeProcess:
+    def __init__(self, worker_id, *, exitcode=None):
+        self.name = f'mq-archive-{worker_id}'
+        self.pid = worker_id
+        self.exitcode = exitcode
+
+    def is_alive(self):
+        return self.exitcode is None
+
+    def join(self):
+        pass
+
+def run_fake_workers(monkeypatch, exitcodes, *, stop_signal=signal.SIGTERM):
+    """
+    Run workers whose processes exit with each of ``exitcodes`` in turn,
+    the last one runs until it is stopped by ``stop_signal`` once it
+    started. A SIGTERM is forwarded to the workers, a SIGINT is received
+    by the whole process group.
+
+    """
+    started = []
+    exitcodes = list(exitcodes)
+
+    def stop_all():
+        for process in started:
+            if process.exitcode is None:
+                process.exitcode = 0
+
+    def start_worker(profile, args, worker_id, report_queue):
+        process = FakeProcess(worker_id, exitcode=exitcodes.pop(0))
+        started.append(process)
+        if not exitcodes:
+            threading.Timer(0.1, signal.raise_signal, [stop_signal]).start()
+            if stop_signal == signal.SIGINT:
+                threading.Timer(0.3, stop_all).start()
+        return process
+
+    def kill(pid, signum):
+        for process in started:
+            if process.pid == pid and process.exitcode is None:
+                process.exitcode = 0
+
+    monkeypatch.setattr(mq_archiver, 'start_worker', start_worker)
+    monkeypatch.setattr(mq_archiver, 'worker_restart_delay', timedelta(0))
+    monkeypatch.setattr(mq_archiver.os, 'kill', kill)
+    num_failed = mq_archiver.run_workers({}, archive_args(workers=1))
+    return started, num_failed
+
+def test_dead_workers_are_restarted(monkeypatch):
+    started, num_failed = run_fake_workers(monkeypatch, [1, -9, None])
+    assert [p.exitcode for p in started] == [1, -9, 0]
+    assert num_failed == 0
+
+def test_sigint_waits_for_workers_to_stop(monkeypatch):
+    started, num_failed = run_fake_workers(
+        monkeypatch, [None], stop_signal=signal.SIGINT)
+    assert [p.exitcode for p in started] == [0]
+    assert num_failed == 0
+
+def test_workers_write_their_own_sqlite_files(monkeypatch):
+    calls = []
+    monkeypatch.setattr(
+        mq_archiver, 'consume', lambda profile, args, **kw: calls.append(kw))
+    args = archive_args(
+        sqlite_path='statuses.db',
+        metrics_port=None,
+        metrics_file=None,
+        asyncio=False,
+    )
+    mq_archiver.worker_main({}, args, 1, None)
+    assert calls[0]['sqlite_path'] == 'statuses.db.w1'
@@ -0,0 +1,145 @@
+import argparse
+import os
+
+from sos import mq_replay, zstd
+from sos.mq_replay import Checkpoint
+
+def test_checkpoint_resumes_progress(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    checkpoint = Checkpoint(path)
+    checkpoint.complete(('a.zstd', 0))
+    checkpoint.update(('a.zstd', 100), 5)
+    checkpoint.update(('a.zstd', 100), 10)
+    checkpoint.close()
+
+    checkpoint = Checkpoint(path, resume=True)
+    assert checkpoint.completed == {('a.zstd', 0)}
+    assert checkpoint.records_done(('a.zstd', 100)) == 10
+    checkpoint.complete(('a.zstd', 100))
+    checkpoint.close()
+
+    checkpoint = Checkpoint(path, resume=True)
+    assert checkpoint.completed == {('a.zstd', 0), ('a.zstd', 100)}
+    assert checkpoint.current is None
+    checkpoint.close()
+
+def test_checkpoint_saves_append(tmp_path):
+    path = tmp_path / 'checkpoint'
+    checkpoint = Checkpoint(str(path))
+    for n in range(100):
+        checkpoint.complete(('b.zstd', n))
+    size = path.stat().st_size
+    checkpoint.update(('b.zstd', 100), 1)
+    # a save only appends its own entry
+    assert path.stat().st_size - size < 100
+    checkpoint.close()
+
+def test_checkpoint_ignores_torn_line(tmp_path):
+    path = tmp_path / 'checkpoint'
+    checkpoint = Checkpoint(str(path))
+    checkpoint.complete(('c.zstd', None))
+    checkpoint.close()
+    with open(path, 'ab') as fp:
+        fp.write(b'{"completed": ["c.zs')
+
+    checkpoint = Checkpoint(str(path), resume=True)
+    assert checkpoint.completed == {('c.zstd', None)}
+    checkpoint.close()
+
+def write_archive(path, ids, *, frame_records=3):
+    with open(path, 'wb') as fp, open(zstd.index_path_for(path), 'wb') as index_fp:
+        writer = zstd.FramedWriter(fp, index_fp, frame_records=frame_records)
+        for status_id in ids:
+            writer.write_record(b'{"id":%d}' % status_id)
+        writer.close()
+    return str(path)
+
+class FileOutputStream:
+    """
+    Append the published lines to a file per process, failing on or exiting
+    straight away at the given lines.
+
+    """
+    def __init__(self, path, *, fail_on=(), exit_on=()):
+        self.path = f'{path}.{os.getpid()}'
+        self.fail_on = fail_on
+        self.exit_on = exit_on
+
+    def on_raw(self, raw, status=None):
+        if raw in self.exit_on:
+            os._exit(1)
+        if raw in self.fail_on:
+            raise ValueError(raw)
+        with open(self.path, 'ab') as fp:
+            fp.write(raw + b'\n')
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def replay(monkeypatch, tmp_path, files, **kw):
+    out_path = tmp_path / 'out'
+    fail_on = kw.pop('fail_on', ())
+    exit_on = kw.pop('exit_on', ())
+    monkeypatch.setattr(
+        mq_replay,
+        'make_output_stream',
+        lambda profile, args: FileOutputStream(
+            out_path, fail_on=fail_on, exit_on=exit_on),
+    )
+    args = argparse.Namespace(
+        files=files,
+        jobs=1,
+        order='none',
+        rate=None,
+        dictionary=None,
+        checkpoint_file=None,
+        resume=False,
+    )
+    vars(args).update(kw)
+    return args, out_path
+
+def published(out_path):
+    lines = []
+    for path in sorted(out_path.parent.glob(f'{out_path.name}.*')):
+        lines.extend(path.read_bytes().splitlines())
+    return lines
+
+def test_parallel_replay_publishes_every_record(monkeypatch, tmp_path):
+    files = [
+        write_archive(tmp_path / 'a.zstd', range(0, 10)),
+        write_archive(tmp_path / 'b.zstd', range(10, 20)),
+    ]
+    args, out_path = replay(monkeypatch, tmp_path, files, jobs=3)
+    num_records, num_failed = mq_replay.replay_unordered({}, args)
+    assert (num_records, num_failed) == (20, 0)
+    assert sorted(mq_replay.id_key(line) for line in published(out_path)) \
+        == list(range(20))
+
+def test_ordered_replay_merges_files_by_id(monkeypatch, tmp_path):
+    files = [
+        write_archive(tmp_path / 'a.zstd', range(0, 20, 2)),
+        write_archive(tmp_path / 'b.zstd', range(1, 20, 2)),
+    ]
+    args, out_path = replay(monkeypatch, tmp_path, files, jobs=2, order='id')
+    assert mq_replay.replay_ordered({}, args) == 20
+    assert [mq_replay.id_key(line) for line in published(out_path)] \
+        == list(range(20))
+
+def test_failed_publishers_are_counted(monkeypatch, tmp_path):
+    files = [write_archive(tmp_path / 'a.zstd', range(10))]
+    args, _ = replay(
+        monkeypatch, tmp_path, files, jobs=2, fail_on={b'{"id":4}'})
+    _, num_failed = mq_replay.replay_unordered({}, args)
+    assert num_failed == 1
+
+def test_killed_publishers_do_not_hang_the_replay(monkeypatch, tmp_path):
+    files = [write_archive(tmp_path / 'a.zstd', range(10))]
+    args, out_path = replay(
+        monkeypatch, tmp_path, files, jobs=2, exit_on={b'{"id":4}'})
+    _, num_failed = mq_replay.replay_unordered({}, args)
+    # the other publisher is stopped too if it was still running
+    assert num_failed >= 1
+    assert b'{"id":4}' not in published(out_path)
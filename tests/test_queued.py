@@ -0,0 +1,68 @@
+import asyncio
+import pytest
+
+from sos.output_streams import CompositeOutputStream, QueuedOutputStream
+from sos.output_streams.asynchronous import ThreadedAsyncOutputStream
+
+class FlakyOutputStream:
+    def __init__(self, fail_on=()):
+        self.fail_on = set(fail_on)
+        self.lines = []
+        self.num_flushes = 0
+
+    def on_raw(self, raw, status=None):
+        if raw in self.fail_on:
+            raise ValueError(raw)
+        self.lines.append(raw)
+
+    def flush(self):
+        self.num_flushes += 1
+
+    def rotate(self):
+        pass
+
+    def close(self):
+        pass
+
+def test_flush_raises_after_failed_writes():
+    inner = FlakyOutputStream(fail_on={b'2'})
+    stream = QueuedOutputStream(inner, max_size=10)
+    for raw in (b'1', b'2', b'3'):
+        stream.on_raw(raw)
+    with pytest.raises(RuntimeError):
+        stream.flush()
+    assert inner.lines == [b'1', b'3']
+
+    # the failure is only reported once
+    stream.on_raw(b'4')
+    stream.flush()
+    stream.close()
+
+def test_composite_flush_sees_fanout_failures():
+    good = FlakyOutputStream()
+    bad = FlakyOutputStream(fail_on={b'1'})
+    stream = CompositeOutputStream([good, bad], queue_size=10)
+    stream.on_raw(b'1')
+    stream.rotate()
+    with pytest.raises(RuntimeError):
+        stream.flush()
+    assert good.lines == [b'1']
+    stream.close()
+
+def test_threaded_async_flush_raises_after_failed_writes():
+    async def main():
+        inner = FlakyOutputStream(fail_on={b'2'})
+        stream = ThreadedAsyncOutputStream(inner)
+        for raw in (b'1', b'2', b'3'):
+            await stream.on_raw(raw)
+        with pytest.raises(RuntimeError):
+            await stream.flush()
+        assert inner.lines == [b'1', b'3']
+
+        # the failure is only reported once, close raises for later ones
+        await stream.flush()
+        await stream.on_raw(b'2')
+        with pytest.raises(RuntimeError):
+            await stream.close()
+
+    asyncio.run(main())
@@ -0,0 +1,93 @@
+from datetime import timedelta
+import pytest
+import time
+
+from sos.bench import FakeBrokerConnection, FakeBrokerOutputStream
+from sos.output_streams.rabbitmq import UnconfirmedDeliveryError
+
+def make_stream(**kw):
+    connection = FakeBrokerConnection(rtt=0, write_latency=0)
+    return connection, FakeBrokerOutputStream(connection, **kw)
+
+def test_batches_are_confirmed_together():
+    connection, stream = make_stream(batch_size=3)
+    for raw in (b'1', b'2', b'3', b'4'):
+        stream.on_raw(raw)
+    assert connection.num_messages == 3
+    assert stream.pending == [b'4']
+    stream.close()
+    assert connection.num_messages == 4
+    assert connection.is_closed
+
+def test_pending_batch_is_flushed_after_latency():
+    connection, stream = make_stream(
+        batch_size=10, batch_latency=timedelta(milliseconds=20))
+    stream.on_raw(b'1')
+    deadline = time.monotonic() + 5
+    while not connection.num_messages and time.monotonic() < deadline:
+        time.sleep(0.01)
+    assert stream.pending == []
+    assert connection.num_messages == 1
+
+def test_close_stops_the_flusher():
+    connection, stream = make_stream(
+        batch_size=10, batch_latency=timedelta(milliseconds=20))
+    stream.on_raw(b'1')
+    flusher = stream.flusher
+    assert flusher.is_alive()
+    stream.close()
+    assert not flusher.is_alive()
+    assert stream.flusher is None
+    assert connection.num_messages == 1
+
+def test_rotate_keeps_the_flusher():
+    connection, stream = make_stream(batch_size=10)
+    stream.on_raw(b'1')
+    flusher = stream.flusher
+    stream.rotate()
+    assert connection.num_messages == 1
+    assert stream.flusher is flusher and flusher.is_alive()
+    stream.close()
+    assert not flusher.is_alive()
+
+def test_rejected_messages_are_retried_and_kept():
+    connection, stream = make_stream(batch_size=10)
+    connection.reject.add(b'2')
+    for raw in (b'1', b'2', b'3'):
+        stream.on_raw(raw)
+    with pytest.raises(UnconfirmedDeliveryError):
+        stream.flush()
+    # published, rejected, published once more and rejected again
+    assert connection.num_messages == 4
+    assert stream.pending == [b'2']
+
+    # close raises instead of dropping them
+    with pytest.raises(UnconfirmedDeliveryError):
+        stream.close()
+    assert stream.pending == [b'2']
+
+    connection.reject.clear()
+    stream.close()
+    assert stream.pending == []
+
+def test_rotate_during_flush_waits_for_it():
+    connection, stream = make_stream(batch_size=10)
+    rotated = []
+    start = connection.start
+
+    def start_and_rotate():
+        # as if a SIGHUP arrived while waiting on the broker
+        if stream.unconfirmed and not rotated:
+            rotated.append(True)
+            stream.rotate()
+        start()
+    connection.start = start_and_rotate
+
+    for raw in (b'1', b'2'):
+        stream.on_raw(raw)
+    stream.flush()
+    assert rotated
+    assert connection.num_messages == 2
+    assert stream.pending == []
+    assert connection.is_closed
+    assert stream.connection is None
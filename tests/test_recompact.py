@@ -0,0 +1,116 @@
+import gzip
+import json as stdlib_json
+import os
+import pytest
+
+from fakes import command_args
+from sos import recompact, zstd
+from sos.bench import sample_status
+from sos.cli import AbortCLI, App
+
+def status_line(n, created_at):
+    status = sample_status(n)
+    status['created_at'] = created_at
+    return stdlib_json.dumps(status).encode('utf8')
+
+lines = [
+    status_line(0, 'Mon Oct 18 12:10:00 +0000 2021'),
+    status_line(1, 'Mon Oct 18 12:50:00 +0000 2021'),
+    status_line(2, 'Mon Oct 18 13:05:00 +0000 2021'),
+    status_line(3, 'Tue Oct 19 09:00:00 +0000 2021'),
+    status_line(4, 'Tue Oct 19 09:30:00 +0000 2021'),
+]
+
+def write_gz(path, lines):
+    with gzip.open(path, 'wb') as fp:
+        for line in lines:
+            fp.write(line + b'\n')
+
+def write_zstd(path, lines):
+    with open(path, 'wb') as fp:
+        writer = zstd.writer(fp)
+        for line in lines:
+            writer.write(line + b'\n')
+        writer.close()
+
+def read_zstd(path, *, dict_data=None):
+    with open(path, 'rb') as fp:
+        return list(zstd.iter_raw_lines(fp, dict_data=dict_data))
+
+def run_recompact(*argv):
+    args = command_args('zstd:recompact', *argv, '--jobs', 1)
+    recompact.main(App(args.profile), args)
+
+@pytest.fixture
+def inputs(tmp_path):
+    input_dir = tmp_path / 'in'
+    input_dir.mkdir()
+    write_gz(input_dir / 'a.gz', lines[:3])
+    write_zstd(input_dir / 'b.zstd', lines[3:])
+    return input_dir
+
+def output_names(output_dir):
+    return sorted(os.listdir(output_dir))
+
+def test_gz_and_zstd_inputs_are_recompacted(tmp_path, inputs):
+    output_dir = tmp_path / 'out'
+    run_recompact(inputs, '--output-dir', output_dir, '--level', 19, '--verify')
+    assert output_names(output_dir) == ['a.zstd', 'b.zstd']
+    assert read_zstd(output_dir / 'a.zstd') == lines[:3]
+    assert read_zstd(output_dir / 'b.zstd') == lines[3:]
+
+def test_inputs_are_split_into_records_per_file(tmp_path, inputs):
+    output_dir = tmp_path / 'out'
+    run_recompact(
+        inputs / 'a.gz',
+        '--output-dir', output_dir,
+        '--records-per-file', 2,
+        '--verify',
+    )
+    assert output_names(output_dir) == ['00000.a.zstd', '00001.a.zstd']
+    assert read_zstd(output_dir / '00000.a.zstd') == lines[:2]
+    assert read_zstd(output_dir / '00001.a.zstd') == lines[2:3]
+
+def test_inputs_are_bucketed_by_creation_time(tmp_path, inputs):
+    output_dir = tmp_path / 'out'
+    run_recompact(
+        inputs / '*',
+        '--output-dir', output_dir,
+        '--bucket', 'hour',
+        '--frame-records', 1,
+        '--verify',
+    )
+    assert output_names(output_dir) == [
+        '20211018.120000.a.zstd',
+        '20211018.120000.a.zstd.idx',
+        '20211018.130000.a.zstd',
+        '20211018.130000.a.zstd.idx',
+        '20211019.090000.b.zstd',
+        '20211019.090000.b.zstd.idx',
+    ]
+    path = str(output_dir / '20211019.090000.b.zstd')
+    assert read_zstd(path) == lines[3:]
+    status_id = sample_status(4)['id']
+    assert zstd.find_status(path, status_id) == lines[4]
+
+def test_outputs_are_compressed_with_a_dictionary(tmp_path, inputs):
+    samples = [
+        stdlib_json.dumps(sample_status(n)).encode('utf8') for n in range(1000)
+    ]
+    dict_path = tmp_path / 'statuses.dict'
+    dict_path.write_bytes(
+        zstd.train_dictionary(samples, dict_size=4096).as_bytes())
+    output_dir = tmp_path / 'out'
+    run_recompact(
+        inputs / 'b.zstd',
+        '--output-dir', output_dir,
+        '--dictionary', dict_path,
+        '--verify',
+    )
+    dict_data = zstd.load_dictionary(str(dict_path))
+    assert read_zstd(output_dir / 'b.zstd', dict_data=dict_data) == lines[3:]
+
+def test_output_dir_must_not_contain_the_inputs(inputs):
+    with pytest.raises(AbortCLI):
+        run_recompact(inputs, '--output-dir', inputs)
+    assert output_names(inputs) == ['a.gz', 'b.zstd']
@@ -0,0 +1,33 @@
+import pytest
+
+from sos.routing import compile_text_pattern
+
+@pytest.mark.parametrize('keyword, text', [
+    ('potus', 'Hello POTUS!'),
+    ('white house', 'at the white\n house today'),
+    ('#potus', 'thanks #POTUS'),
+    ('@jack', 'cc @jack.'),
+    ('c++', 'writing c++ again'),
+    ('c++', 'c++'),
+])
+def test_keyword_matches(keyword, text):
+    assert compile_text_pattern([keyword], []).search(text) is not None
+
+@pytest.mark.parametrize('keyword, text', [
+    ('potus', 'potuses'),
+    ('potus', 'xpotus'),
+    ('#potus', '#potus2024'),
+    ('@jack', '@jackson'),
+    ('c++', 'abc++'),
+])
+def test_keyword_does_not_match(keyword, text):
+    assert compile_text_pattern([keyword], []).search(text) is None
+
+def test_keywords_and_regexes_are_combined():
+    pattern = compile_text_pattern(['#potus'], [r'\bvot(e|ing)\b'])
+    assert pattern.search('go voting') is not None
+    assert pattern.search('#potus') is not None
+    assert pattern.search('vote2') is None
+
+def test_no_patterns():
+    assert compile_text_pattern([], []) is None
@@ -0,0 +1,48 @@
+import pytest
+import sqlite3
+
+from sos.bench import sample_status
+from sos.output_streams import SqliteOutputStream
+
+class FailingConnection:
+    """
+    Wraps a sqlite connection to fail the next ``executemany``.
+
+    """
+    def __init__(self, db):
+        self.db = db
+        self.fail = True
+
+    def __enter__(self):
+        return self.db.__enter__()
+
+    def __exit__(self, *exc_info):
+        return self.db.__exit__(*exc_info)
+
+    def executemany(self, sql, rows):
+        if self.fail:
+            self.fail = False
+            raise sqlite3.OperationalError('database is locked')
+        return self.db.executemany(sql, rows)
+
+    def close(self):
+        self.db.close()
+
+def count_rows(path):
+    with sqlite3.connect(path) as db:
+        return db.execute('select count(*) from statuses').fetchone()[0]
+
+def test_failed_flush_keeps_rows(tmp_path):
+    path = str(tmp_path / 'store.db')
+    stream = SqliteOutputStream(path, batch_size=10)
+    stream.db = FailingConnection(stream.db)
+    for n in range(3):
+        stream.on_status(sample_status(n))
+    with pytest.raises(sqlite3.OperationalError):
+        stream.flush()
+    assert len(stream.pending) == 3
+
+    stream.flush()
+    assert stream.pending == []
+    stream.close()
+    assert count_rows(path) == 3
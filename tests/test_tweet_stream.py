@@ -0,0 +1,271 @@
+from datetime import datetime, timedelta
+import threading
+
+from sos import json, zstd
+from sos.bench import sample_status
+from sos.output_streams import (
+    CompositeOutputStream,
+    FileOutputStream,
+    GCPFirestoreOutputStream,
+    QueuedOutputStream,
+    StdoutOutputStream,
+)
+from sos.tweet_stream import FilterStreamSupervisor, TweetStream
+
+from test_gcp_firestore import FakeClient
+
+credentials = {
+    'consumer_key': 'key',
+    'consumer_secret': 'secret',
+    'access_token': 'token',
+    'access_token_secret': 'token-secret',
+}
+
+profile = {
+    'twitter': credentials,
+    'twitter_credentials': {'cuba': credentials, 'potus': credentials},
+}
+
+class FakeStream:
+    def __init__(self, name, credentials):
+        self.name = name
+        self.credentials = credentials
+        self.filters = None
+        self.running = False
+        self.disconnected = False
+
+    def disconnect(self):
+        # keeps running until the next keep-alive
+        self.disconnected = True
+
+class FakeSupervisor(FilterStreamSupervisor):
+    def __init__(self, paths):
+        super().__init__(
+            profile,
+            paths,
+            output_stream=None,
+            report_interval=timedelta(seconds=10),
+        )
+        self.streams = []
+
+    def make_stream(self, name, credentials):
+        stream = FakeStream(name, credentials)
+        self.streams.append(stream)
+        return stream
+
+    def connect(self, stream, filters):
+        stream.filters = filters
+        stream.running = True
+
+    def is_running(self, stream):
+        return stream.running
+
+    def running(self):
+        return {
+            supervised.name: supervised.stream.filters
+            for supervised in self.supervised.values()
+            if supervised.stream is not None and supervised.stream.running
+        }
+
+def write_filter(tmp_path, name, text):
+    path = tmp_path / f'{name}.yml'
+    path.write_text(text)
+    return path
+
+def test_reload_starts_filters_with_their_own_credentials(tmp_path):
+    write_filter(tmp_path, 'cuba', 'credentials: cuba\ntrack: [cuba]\n')
+    write_filter(tmp_path, 'potus', 'credentials: potus\ntrack: [potus]\n')
+    write_filter(tmp_path, 'shared', 'credentials: potus\ntrack: [biden]\n')
+    write_filter(tmp_path, 'unknown', 'credentials: nope\ntrack: [x]\n')
+    supervisor = FakeSupervisor([str(tmp_path)])
+    now = datetime(2021, 10, 18)
+    supervisor.reload(now=now)
+    supervisor.check(now=now)
+    assert supervisor.running() == {
+        'cuba': {'track': ['cuba']},
+        'potus': {'track': ['potus']},
+    }
+    assert [s.credentials for s in supervisor.streams] == ['cuba', 'potus']
+
+def test_reload_waits_for_the_old_stream(tmp_path):
+    path = write_filter(tmp_path, 'potus', 'track: [potus]\n')
+    write_filter(tmp_path, 'cuba', 'credentials: cuba\ntrack: [cuba]\n')
+    supervisor = FakeSupervisor([str(tmp_path)])
+    now = datetime(2021, 10, 18)
+    supervisor.reload(now=now)
+    supervisor.check(now=now)
+    old = supervisor.supervised[str(path)].stream
+
+    path.write_text('track: [potus, biden]\n')
+    (tmp_path / 'cuba.yml').unlink()
+    supervisor.reload(now=now)
+    supervisor.check(now=now)
+    assert old.disconnected
+    assert supervisor.running() == {}
+    assert len(supervisor.streams) == 2
+
+    # the old stream noticed the disconnect
+    for stream in supervisor.streams:
+        stream.running = False
+    supervisor.check(now=now)
+    assert supervisor.running() == {'potus': {'track': ['potus', 'biden']}}
+
+def test_check_reconnects_with_backoff(tmp_path):
+    path = write_filter(tmp_path, 'potus', 'track: [potus]\n')
+    supervisor = FakeSupervisor([str(tmp_path)])
+    now = datetime(2021, 10, 18)
+    supervisor.reload(now=now)
+    supervisor.check(now=now)
+    supervised = supervisor.supervised[str(path)]
+
+    delays = []
+    for n in range(3):
+        supervised.stream.running = False
+        supervisor.check(now=now)
+        assert supervised.stream is None
+        delays.append(supervised.restart_at - now)
+        supervisor.check(now=supervised.restart_at - timedelta(seconds=1))
+        assert supervised.stream is None
+        now = supervised.restart_at
+        supervisor.check(now=now)
+        assert supervised.stream.running
+    assert delays == [timedelta(seconds=5 * 2 ** n) for n in range(3)]
+
+    # the delay is reset once a stream stayed connected for backoff_max
+    now += supervisor.backoff_max
+    supervised.stream.running = False
+    supervisor.check(now=now)
+    assert supervised.restart_at - now == supervisor.backoff_initial
+
+class BlockedOutputStream:
+    """
+    Stands in for a sink that stalls, such as a blocked RabbitMQ connection,
+    until ``unblocked`` is set.
+
+    """
+    def __init__(self):
+        self.started = threading.Event()
+        self.unblocked = threading.Event()
+        self.lines = []
+
+    def on_raw(self, raw, status=None):
+        self.started.set()
+        self.unblocked.wait()
+        self.lines.append(raw)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
+
+def status_data(n):
+    return json.dumps(sample_status(n))
+
+def read_stalled(output_stream, inner, num_statuses):
+    """
+    Feed ``num_statuses`` to a :class:`TweetStream` while its sink is stalled
+    on the first one, returning once every status was read.
+
+    """
+    stream = TweetStream(
+        *credentials.values(),
+        output_stream=output_stream,
+        report_interval=timedelta(seconds=10),
+    )
+    stream.on_data(status_data(0))
+    assert inner.started.wait(5)
+    for n in range(1, num_statuses):
+        stream.on_data(status_data(n))
+
+def test_queued_stream_drops_the_oldest_statuses():
+    inner = BlockedOutputStream()
+    output_stream = QueuedOutputStream(
+        inner, max_size=2, overflow='drop-oldest')
+    read_stalled(output_stream, inner, 5)
+    stats = output_stream.stats()
+    assert 'depth=2 high_water=2 dropped=2' in stats
+
+    inner.unblocked.set()
+    output_stream.flush()
+    output_stream.close()
+    assert inner.lines == [status_data(n) for n in (0, 3, 4)]
+
+def test_queued_stream_spills_to_disk(tmp_path):
+    inner = BlockedOutputStream()
+    output_stream = QueuedOutputStream(
+        inner,
+        max_size=2,
+        overflow='spill',
+        spill_path_prefix=str(tmp_path / 'spill'),
+    )
+    read_stalled(output_stream, inner, 5)
+    assert 'spilled=2' in output_stream.stats()
+    assert len(list(tmp_path.glob('spill.*.zstd'))) == 1
+
+    inner.unblocked.set()
+    output_stream.flush()
+    output_stream.close()
+    # spilled statuses are replayed after the queue drains
+    assert sorted(inner.lines) == [status_data(n) for n in range(5)]
+    assert list(tmp_path.glob('spill.*.zstd')) == []
+
+def count_parses(monkeypatch):
+    parsed = []
+    loads = json.loads
+
+    def counting_loads(raw):
+        parsed.append(raw)
+        return loads(raw)
+
+    monkeypatch.setattr(json, 'loads', counting_loads)
+    return parsed
+
+def read_raw(output_stream, data):
+    stream = TweetStream(
+        *credentials.values(),
+        output_stream=output_stream,
+        report_interval=timedelta(seconds=10),
+    )
+    for raw in data:
+        stream.on_data(raw)
+    output_stream.close()
+
+retweet = sample_status(9)
+retweet['retweeted_status'] = sample_status(10)
+limit_message = b'{"limit":{"track":5,"timestamp_ms":"1634558400000"}}'
+stream_data = [
+    status_data(0),
+    json.dumps(retweet),
+    limit_message,
+    status_data(1),
+]
+
+def test_statuses_are_passed_through_without_parsing(
+    tmp_path, monkeypatch, capsys,
+):
+    parsed = count_parses(monkeypatch)
+    output_stream = CompositeOutputStream([
+        FileOutputStream(str(tmp_path / 'out')),
+        StdoutOutputStream(),
+    ])
+    read_raw(output_stream, stream_data)
+    # only the control message is parsed
+    assert parsed == [limit_message]
+
+    expected = [status_data(0), status_data(1)]
+    [path] = tmp_path.glob('out.*.zstd')
+    with open(path, 'rb') as fp:
+        assert list(zstd.iter_raw_lines(fp)) == expected
+    assert capsys.readouterr().out.encode('utf8').splitlines() == expected
+
+def test_statuses_are_parsed_once_for_firestore(tmp_path, monkeypatch):
+    parsed = count_parses(monkeypatch)
+    client = FakeClient()
+    output_stream = CompositeOutputStream([
+        FileOutputStream(str(tmp_path / 'out')),
+        GCPFirestoreOutputStream(collection='c', client=client),
+    ])
+    read_raw(output_stream, stream_data)
+    assert parsed == [status_data(0), limit_message, status_data(1)]
+    assert len(client.docs) == 2
@@ -0,0 +1,128 @@
+import gzip
+import io
+import json as stdlib_json
+import pytest
+import zstandard
+
+from fakes import command_args
+from sos import zstd
+from sos.bench import sample_status
+from sos.cli import App
+from sos.mq_replay import created_at_key, id_key
+from sos.output_streams import DedupeOutputStream
+from sos.recompact import bucket_for
+
+status = {
+    'created_at': 'Mon Jan 04 12:00:00 +0000 2021',
+    'id': 1346093846476464129,
+    'text': 'hello',
+    'user': {'id': 12, 'screen_name': 'someone'},
+}
+# the baseline wrote archives with the default ": " separators
+baseline_line = stdlib_json.dumps(status).encode('utf8')
+compact_line = stdlib_json.dumps(status, separators=(',', ':')).encode('utf8')
+
+def test_status_id_re_matches_both_formats():
+    for line in (baseline_line, compact_line):
+        m = zstd.status_id_re.search(line)
+        assert int(m.group(1)) == status['id']
+
+def test_created_at_re_matches_both_formats():
+    for line in (baseline_line, compact_line):
+        m = zstd.created_at_re.search(line)
+        assert m.group(1).decode('utf8') == status['created_at']
+
+def test_framed_writer_indexes_baseline_lines():
+    fp = io.BytesIO()
+    index_fp = io.BytesIO()
+    writer = zstd.FramedWriter(fp, index_fp)
+    writer.write_record(baseline_line)
+    writer.close()
+    entry = stdlib_json.loads(index_fp.getvalue().splitlines()[0])
+    assert entry['min_id'] == entry['max_id'] == status['id']
+
+def test_replay_keys_of_baseline_lines():
+    assert id_key(baseline_line) == status['id']
+    assert created_at_key(baseline_line).year == 2021
+
+def test_recompact_bucket_of_baseline_lines():
+    assert bucket_for(baseline_line, '%Y-%m-%d') == '2021-01-04'
+
+class ListOutputStream:
+    def __init__(self):
+        self.lines = []
+
+    def on_raw(self, raw, status=None):
+        self.lines.append(raw)
+
+def test_dedupe_matches_baseline_lines():
+    inner = ListOutputStream()
+    stream = DedupeOutputStream(inner)
+    stream.on_raw(baseline_line)
+    stream.on_raw(compact_line)
+    assert inner.lines == [baseline_line]
+
+def run_command(main, *argv):
+    args = command_args(*argv)
+    main(App(args.profile), args)
+
+def archive_lines(n):
+    return [
+        stdlib_json.dumps(sample_status(i)).encode('utf8') + b'\n'
+        for i in range(n)
+    ]
+
+def test_compress_round_trip_with_a_trained_dictionary(tmp_path):
+    lines = archive_lines(1000)
+    samples = tmp_path / 'samples.zstd'
+    with open(samples, 'wb') as fp:
+        writer = zstd.writer(fp)
+        writer.write(b''.join(lines))
+        writer.close()
+    dict_path = tmp_path / 'statuses.dict'
+    run_command(
+        zstd.main_train_dictionary,
+        'zstd:train-dictionary', samples, '-o', dict_path, '--dict-size', 4096,
+    )
+
+    raw = tmp_path / 'statuses.json'
+    raw.write_bytes(b''.join(lines[:100]))
+    compressed = tmp_path / 'statuses.zstd'
+    run_command(
+        zstd.main_compress,
+        'zstd:compress', raw, '-o', compressed,
+        '--dictionary', dict_path, '--threads', 2, '--long',
+    )
+    # the output cannot be read without the dictionary
+    with pytest.raises(zstandard.ZstdError):
+        with open(compressed, 'rb') as fp:
+            list(zstd.iter_raw_lines(fp))
+
+    out = tmp_path / 'out.json'
+    run_command(
+        zstd.main_decompress,
+        'zstd:decompress', compressed, '-o', out, '--dictionary', dict_path,
+    )
+    assert out.read_bytes() == raw.read_bytes()
+
+def test_concat_recompresses_gz_converted_files(tmp_path):
+    lines = archive_lines(10)
+    paths = []
+    for n, chunk in enumerate((lines[:4], lines[4:])):
+        gz_path = tmp_path / f'{n}.gz'
+        with gzip.open(gz_path, 'wb') as fp:
+            fp.write(b''.join(chunk))
+        path = tmp_path / f'{n}.zstd'
+        run_command(
+            zstd.main_from_gz,
+            'zstd:from-gz', gz_path, '-o', path, '--threads', 2,
+        )
+        paths.append(path)
+
+    out = tmp_path / 'out.zstd'
+    run_command(
+        zstd.main_concat, 'zstd:concat', *paths, '-o', out, '--level', 19)
+    with open(out, 'rb') as fp:
+        assert list(zstd.iter_raw_lines(fp)) == [
+            line.rstrip(b'\n') for line in lines
+        ]